@@ -0,0 +1,384 @@
+import os
+import json
+import asyncio
+import threading
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, Iterator, Optional
+
+import anyio
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.requests import Request
+from starlette.responses import JSONResponse, PlainTextResponse, Response, StreamingResponse
+from starlette.routing import Route, WebSocketRoute
+from starlette.websockets import WebSocket, WebSocketDisconnect
+from .chat_service import ChatService
+from .database import ROLE_AI, ROLE_HUMAN
+from .generation import Cancellation, ollama_options
+
+class _Drain:
+    """Counts in-flight turns so shutdown can wait for them to finish"""
+    
+    def __init__(self):
+        self.in_flight = 0
+        self.draining = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+    
+    def enter(self) -> bool:
+        """Admit a turn; False once shutdown has started"""
+        if self.draining:
+            return False
+        self.in_flight += 1
+        self._idle.clear()
+        return True
+    
+    def exit(self):
+        self.in_flight -= 1
+        if self.in_flight == 0:
+            self._idle.set()
+    
+    async def wait(self, timeout: float) -> bool:
+        """Refuse new turns and wait up to `timeout` seconds for running ones"""
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+
+class _BadRequest(Exception):
+    pass
+
+def _turn_request(body: Any) -> Dict[str, Any]:
+    """Validate a chat request body: message, optional session_id, owner, use_cache and options"""
+    if not isinstance(body, dict) or not isinstance(body.get("message"), str) or not body["message"].strip():
+        raise _BadRequest("'message' must be a non-empty string")
+    session_id = body.get("session_id", "default")
+    if not isinstance(session_id, str) or not session_id:
+        raise _BadRequest("'session_id' must be a non-empty string")
+    owner = body.get("owner")
+    if owner is not None and (not isinstance(owner, str) or not owner):
+        raise _BadRequest("'owner' must be a non-empty string")
+    options = body.get("options")
+    if options is not None:
+        if not isinstance(options, dict):
+            raise _BadRequest("'options' must be an object")
+        try:
+            ollama_options(options)
+        except ValueError as e:
+            raise _BadRequest(str(e))
+    return {"message": body["message"], "session_id": session_id, "use_cache": bool(body.get("use_cache", True)),
+            "options": options, "owner": owner}
+
+def _limit(request: Request, maximum: int) -> int:
+    """The `limit` query parameter (default 20): a positive integer, capped at `maximum`"""
+    try:
+        limit = int(request.query_params.get("limit", "20"))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise _BadRequest("'limit' must be a positive integer")
+    return min(limit, maximum)
+
+async def _read_turn(request: Request) -> Dict[str, Any]:
+    try:
+        body = await request.json()
+    except ValueError:
+        raise _BadRequest("Request body must be JSON")
+    return _turn_request(body)
+
+def _unavailable() -> JSONResponse:
+    return JSONResponse({"error": "Server is shutting down"}, status_code=503, headers={"Retry-After": "1"})
+
+def _turn_cancellation() -> Cancellation:
+    """Cancellation of one turn, with a CHAT_TURN_TIMEOUT deadline if set"""
+    timeout = os.getenv('CHAT_TURN_TIMEOUT')
+    return Cancellation(float(timeout) if timeout else None)
+
+async def _iterate(tokens: Iterator[str], cancel: Optional[Cancellation] = None) -> AsyncIterator[str]:
+    """
+    Pull a blocking token iterator from the threadpool; closing it saves the partial turn.
+    
+    If the consumer goes away mid-turn, `cancel` aborts the generation at
+    once instead of leaving it to run to completion in its thread.
+    """
+    sentinel = object()
+    # A generator can't be closed while another thread is inside next()
+    lock = threading.Lock()
+    
+    def pull():
+        with lock:
+            return next(tokens, sentinel)
+    
+    def close():
+        with lock:
+            tokens.close()
+    
+    finished = False
+    try:
+        while True:
+            token = await anyio.to_thread.run_sync(pull, abandon_on_cancel=True)
+            if token is sentinel:
+                finished = True
+                return
+            yield token
+    finally:
+        if not finished and cancel is not None:
+            cancel.cancel("cancelled by client")
+        # Runs even when the client disconnected and this task is being cancelled
+        with anyio.CancelScope(shield=True):
+            await run_in_threadpool(close)
+
+async def chat(request: Request) -> Response:
+    """POST /chat {message, session_id?, owner?, use_cache?, options?} -> {response}"""
+    try:
+        turn = await _read_turn(request)
+    except _BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    drain: _Drain = request.app.state.drain
+    if not drain.enter():
+        return _unavailable()
+    try:
+        cancel = _turn_cancellation()
+        response = await run_in_threadpool(request.app.state.service.chat, **turn,
+                                           cancel=cancel if cancel.deadline is not None else None)
+    finally:
+        drain.exit()
+    return JSONResponse({"response": response, "session_id": turn["session_id"]})
+
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def chat_stream(request: Request) -> Response:
+    """
+    POST /chat/stream -> Server-Sent Events: `token` events, then one `done` event.
+    
+    A single `error` event is sent instead if shutdown began before the body started.
+    """
+    try:
+        turn = await _read_turn(request)
+    except _BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    drain: _Drain = request.app.state.drain
+    if drain.draining:
+        return _unavailable()
+    
+    # The turn is admitted once the body starts: a response torn down before
+    # that never runs the generator, so it must not hold a slot
+    async def events() -> AsyncIterator[str]:
+        if not drain.enter():
+            yield _sse("error", {"error": "Server is shutting down"})
+            return
+        try:
+            parts = []
+            cancel = _turn_cancellation()
+            async for token in _iterate(request.app.state.service.chat_stream(**turn, cancel=cancel), cancel):
+                parts.append(token)
+                yield _sse("token", {"token": token})
+            yield _sse("done", {"response": "".join(parts), "session_id": turn["session_id"]})
+        finally:
+            drain.exit()
+    
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+async def chat_websocket(websocket: WebSocket):
+    """
+    WebSocket /ws/chat: send {message, session_id?, owner?, use_cache?, options?} per turn and
+    receive {"token": ...} messages followed by {"done": true, "response": ...}.
+    """
+    await websocket.accept()
+    drain: _Drain = websocket.app.state.drain
+    try:
+        while True:
+            try:
+                turn = _turn_request(await websocket.receive_json())
+            except (_BadRequest, ValueError) as e:
+                await websocket.send_json({"error": str(e)})
+                continue
+            if not drain.enter():
+                await websocket.close(code=1012, reason="Server is shutting down")
+                return
+            try:
+                parts = []
+                cancel = _turn_cancellation()
+                async for token in _iterate(websocket.app.state.service.chat_stream(**turn, cancel=cancel), cancel):
+                    parts.append(token)
+                    await websocket.send_json({"token": token})
+                await websocket.send_json({"done": True, "response": "".join(parts),
+                                           "session_id": turn["session_id"]})
+            finally:
+                drain.exit()
+    except WebSocketDisconnect:
+        pass
+
+async def history(request: Request) -> Response:
+    """GET /sessions/{session_id}/history?limit=&before_id= -> {pairs, next_before_id}"""
+    try:
+        limit = _limit(request, 200)
+        before_id = request.query_params.get("before_id")
+        before_id = int(before_id) if before_id else None
+    except _BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except ValueError:
+        return JSONResponse({"error": "'before_id' must be an integer"}, status_code=400)
+    pairs, cursor = await run_in_threadpool(
+        request.app.state.service.get_chat_history_page, request.path_params["session_id"], limit, before_id
+    )
+    return JSONResponse({"pairs": [list(pair) for pair in pairs], "next_before_id": cursor})
+
+async def clear_history(request: Request) -> Response:
+    """DELETE /sessions/{session_id}/history"""
+    await run_in_threadpool(request.app.state.service.clear_history, request.path_params["session_id"])
+    return Response(status_code=204)
+
+def _session_json(session: Any) -> Dict[str, Any]:
+    return {
+        "session_id": session.session_id,
+        "title": session.title,
+        "last_active_at": session.last_active_at.isoformat(),
+        "message_count": session.message_count,
+    }
+
+async def list_sessions(request: Request) -> Response:
+    """GET /users/{owner}/sessions?limit=&cursor= -> {sessions (most recent first), next_cursor}"""
+    try:
+        limit = _limit(request, 100)
+        sessions, cursor = await run_in_threadpool(
+            request.app.state.service.list_sessions, request.path_params["owner"], limit,
+            request.query_params.get("cursor") or None
+        )
+    except _BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except ValueError:
+        return JSONResponse({"error": "'cursor' must be a value returned by this endpoint"}, status_code=400)
+    return JSONResponse({"sessions": [_session_json(session) for session in sessions], "next_cursor": cursor})
+
+async def create_session(request: Request) -> Response:
+    """POST /users/{owner}/sessions {title?} -> 201 {session_id}"""
+    try:
+        raw = await request.body()
+        body = json.loads(raw) if raw else {}
+    except ValueError:
+        return JSONResponse({"error": "Request body must be JSON"}, status_code=400)
+    title = body.get("title") if isinstance(body, dict) else None
+    if title is not None and not isinstance(title, str):
+        return JSONResponse({"error": "'title' must be a string"}, status_code=400)
+    session_id = await run_in_threadpool(
+        request.app.state.service.create_session, request.path_params["owner"], title
+    )
+    return JSONResponse({"session_id": session_id}, status_code=201)
+
+async def _search(request: Request, **scope: str) -> Response:
+    query = request.query_params.get("q", "")
+    if not query.strip():
+        return JSONResponse({"error": "'q' must be a non-empty string"}, status_code=400)
+    try:
+        limit = _limit(request, 100)
+        hits, cursor = await run_in_threadpool(
+            request.app.state.service.search_history, query, limit=limit,
+            cursor=request.query_params.get("cursor") or None, **scope
+        )
+    except _BadRequest as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    except ValueError:
+        return JSONResponse({"error": "'cursor' must be a value returned by this endpoint"}, status_code=400)
+    return JSONResponse({
+        "hits": [
+            {
+                "session_id": hit.session_id,
+                "message_id": hit.message_id,
+                "role": "user" if hit.role == ROLE_HUMAN else "assistant" if hit.role == ROLE_AI else "system",
+                "created_at": hit.created_at.isoformat(),
+                "rank": hit.rank,
+                "snippet": hit.snippet,
+            }
+            for hit in hits
+        ],
+        "next_cursor": cursor,
+    })
+
+async def search_session(request: Request) -> Response:
+    """GET /sessions/{session_id}/search?q=&limit=&cursor= -> {hits (best first), next_cursor}"""
+    return await _search(request, session_id=request.path_params["session_id"])
+
+async def search_user(request: Request) -> Response:
+    """GET /users/{owner}/search?q=&limit=&cursor= -> {hits (best first), next_cursor}"""
+    return await _search(request, owner=request.path_params["owner"])
+
+async def health(request: Request) -> Response:
+    """GET /health -> status, database connectivity and in-flight turns"""
+    drain: _Drain = request.app.state.drain
+    database = await run_in_threadpool(request.app.state.service.db_manager.check_connection)
+    return JSONResponse(
+        {"status": "draining" if drain.draining else "ok", "database": database, "in_flight": drain.in_flight},
+        status_code=503 if drain.draining else 200
+    )
+
+async def metrics(request: Request) -> Response:
+    """GET /metrics -> Prometheus text"""
+    return PlainTextResponse(request.app.state.service.metrics.render(),
+                             media_type="text/plain; version=0.0.4")
+
+def create_app(service_factory: Callable[[], Any] = ChatService) -> Starlette:
+    """
+    Build the ASGI app serving ChatService over HTTP, SSE and WebSocket.
+    
+    Key responsibilities:
+    - Create one service per worker process at startup (shared by every
+      request of that process: DB pool, caches, scheduler, Ollama session)
+    - Run the blocking service calls in the threadpool (API_THREADS threads)
+    - Abort a streamed generation when its client disconnects, and any
+      turn after CHAT_TURN_TIMEOUT seconds (unset means no limit)
+    - On shutdown, refuse new turns with 503 and wait up to API_DRAIN_TIMEOUT
+      seconds for in-flight generations before closing the service
+    
+    Args:
+        service_factory: Builds the service; tests pass stubs
+    """
+    @asynccontextmanager
+    async def lifespan(app: Starlette):
+        anyio.to_thread.current_default_thread_limiter().total_tokens = int(os.getenv('API_THREADS', '64'))
+        app.state.service = await run_in_threadpool(service_factory)
+        app.state.drain = _Drain()
+        try:
+            yield
+        finally:
+            drain_timeout = float(os.getenv('API_DRAIN_TIMEOUT', '30'))
+            if not await app.state.drain.wait(drain_timeout):
+                print(f"Warning: Shutting down with {app.state.drain.in_flight} turns still in flight")
+            await run_in_threadpool(app.state.service.close)
+    
+    return Starlette(
+        routes=[
+            Route("/chat", chat, methods=["POST"]),
+            Route("/chat/stream", chat_stream, methods=["POST"]),
+            WebSocketRoute("/ws/chat", chat_websocket),
+            Route("/sessions/{session_id}/history", history, methods=["GET"]),
+            Route("/sessions/{session_id}/history", clear_history, methods=["DELETE"]),
+            Route("/users/{owner}/sessions", list_sessions, methods=["GET"]),
+            Route("/users/{owner}/sessions", create_session, methods=["POST"]),
+            Route("/sessions/{session_id}/search", search_session, methods=["GET"]),
+            Route("/users/{owner}/search", search_user, methods=["GET"]),
+            Route("/health", health, methods=["GET"]),
+            Route("/metrics", metrics, methods=["GET"]),
+        ],
+        lifespan=lifespan
+    )
+
+app = create_app()
+
+def main():
+    """Serve the API with uvicorn: API_HOST, API_PORT and API_WORKERS (processes)"""
+    import uvicorn
+    uvicorn.run(
+        "backend.api:app",
+        host=os.getenv('API_HOST', '0.0.0.0'),
+        port=int(os.getenv('API_PORT', '8000')),
+        workers=int(os.getenv('API_WORKERS', '1')),
+        timeout_graceful_shutdown=int(float(os.getenv('API_DRAIN_TIMEOUT', '30')))
+    )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,197 @@
+import os
+import sys
+import json
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from typing import Any, Dict, IO, List, Optional, Set, Tuple
+from .generation import FailedGeneration
+
+def load_sessions(path: str) -> Dict[str, List[str]]:
+    """
+    Read a batch file: one JSON object per line.
+    
+    A line is either a whole session, {"session_id": ..., "turns": [...]},
+    or one turn, {"session_id": ..., "message": ...}. Turns of a session
+    keep file order; sessions keep the order they first appear in.
+    """
+    sessions: Dict[str, List[str]] = {}
+    with open(path, encoding="utf-8") as f:
+        for number, line in enumerate(f, 1):
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            session_id = record.get("session_id")
+            if not isinstance(session_id, str) or not session_id:
+                raise ValueError(f"{path}:{number}: 'session_id' must be a non-empty string")
+            if "turns" in record:
+                turns = record["turns"]
+            elif "message" in record:
+                turns = [record["message"]]
+            else:
+                raise ValueError(f"{path}:{number}: expected 'turns' or 'message'")
+            if not all(isinstance(turn, str) and turn.strip() for turn in turns):
+                raise ValueError(f"{path}:{number}: every turn must be a non-empty string")
+            sessions.setdefault(session_id, []).extend(turns)
+    return sessions
+
+def load_checkpoint(path: str) -> Set[Tuple[str, int]]:
+    """
+    (session_id, turn) pairs already completed in a results file.
+    
+    A line cut short by an interruption is truncated away so appending
+    resumes on a clean line. Failed turns are not counted as done.
+    """
+    if not os.path.exists(path):
+        return set()
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    done = set()
+    for line in data[:end].decode("utf-8").splitlines():
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        if "error" not in result:
+            done.add((result["session_id"], result["turn"]))
+    return done
+
+class BatchRunner:
+    """
+    Replays many sessions through a chat service for regression and evaluation.
+    
+    Key responsibilities:
+    - Run sessions in parallel, at most `concurrency` at a time, with the
+      turns of each session strictly in order
+    - Append one JSON result per turn (response, timing, or error) to the
+      output file as soon as the turn finishes
+    - Resume from the output file: turns already answered are skipped, so
+      an interrupted run continues where it stopped
+    - Stop a session at its first failed turn (later turns depend on it);
+      failed turns are retried by the next run
+    
+    `service` must provide chat(message, session_id, use_cache) and
+    clear_history(session_id), so tests can pass stubs. A turn fails when
+    chat raises or replies with a FailedGeneration (e.g. the LLM was busy).
+    """
+    
+    def __init__(self, service, concurrency: int = 4, use_cache: bool = True, fresh: bool = False):
+        self.service = service
+        self.concurrency = concurrency
+        self.use_cache = use_cache
+        self.fresh = fresh
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+    
+    def _write(self, output: IO[str], result: Dict[str, Any]):
+        with self._lock:
+            output.write(json.dumps(result) + "\n")
+            output.flush()
+    
+    def _run_session(self, session_id: str, turns: List[str], done: Set[Tuple[str, int]],
+                     output: IO[str]) -> List[Dict[str, Any]]:
+        results = []
+        # Only a session that hasn't started yet may be reset
+        if self.fresh and not any((session_id, turn) in done for turn in range(len(turns))):
+            self.service.clear_history(session_id)
+        for turn, message in enumerate(turns):
+            if self._stop.is_set():
+                break
+            if (session_id, turn) in done:
+                continue
+            result: Dict[str, Any] = {
+                "session_id": session_id,
+                "turn": turn,
+                "message": message,
+                "started_at": datetime.now(timezone.utc).isoformat(),
+            }
+            started = time.perf_counter()
+            try:
+                response = self.service.chat(message, session_id, self.use_cache)
+                if isinstance(response, FailedGeneration):
+                    result["error"] = str(response)
+                else:
+                    result["response"] = response
+            except Exception as e:
+                result["error"] = f"{type(e).__name__}: {e}"
+            result["seconds"] = time.perf_counter() - started
+            self._write(output, result)
+            results.append(result)
+            if "error" in result:
+                break
+        return results
+    
+    def run(self, sessions: Dict[str, List[str]], output_path: str) -> Dict[str, Any]:
+        """
+        Replay `sessions` (session_id -> turns), appending results to `output_path`.
+        
+        Returns:
+            Summary with sessions, turns completed in this run, turns
+            skipped from the checkpoint, failures, and turn latency p50/p95
+        """
+        done = load_checkpoint(output_path)
+        started = time.perf_counter()
+        with open(output_path, "a", encoding="utf-8") as output:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="batch-session") as pool:
+                futures = [
+                    pool.submit(self._run_session, session_id, turns, done, output)
+                    for session_id, turns in sessions.items()
+                ]
+                try:
+                    results = [result for future in futures for result in future.result()]
+                except KeyboardInterrupt:
+                    # Let the turns in flight finish (and be checkpointed), skip the rest
+                    self._stop.set()
+                    pool.shutdown(wait=True, cancel_futures=True)
+                    raise
+        
+        latencies = sorted(result["seconds"] for result in results if "error" not in result)
+        skipped = sum(1 for session_id, turn in done
+                      if session_id in sessions and turn < len(sessions[session_id]))
+        return {
+            "sessions": len(sessions),
+            "completed": len(latencies),
+            "skipped": skipped,
+            "failed": len(results) - len(latencies),
+            "remaining": sum(len(turns) for turns in sessions.values()) - len(latencies) - skipped,
+            "seconds": time.perf_counter() - started,
+            "p50": latencies[int(0.50 * (len(latencies) - 1))] if latencies else 0.0,
+            "p95": latencies[int(0.95 * (len(latencies) - 1))] if latencies else 0.0,
+        }
+
+def main(argv: Optional[List[str]] = None) -> int:
+    """`python -m backend.batch sessions.jsonl --output results.jsonl`"""
+    import argparse
+    from .chat_service import get_chat_service
+    
+    parser = argparse.ArgumentParser(description="Replay chat sessions from a JSONL file")
+    parser.add_argument("input", help="JSONL of {session_id, turns} or {session_id, message} lines")
+    parser.add_argument("--output", required=True, help="Results JSONL; also the checkpoint to resume from")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv('BATCH_CONCURRENCY', '4')),
+                        help="Sessions run in parallel (default BATCH_CONCURRENCY or 4)")
+    parser.add_argument("--no-cache", action="store_true", help="Bypass the LLM response cache")
+    parser.add_argument("--fresh", action="store_true", help="Clear each session's history before its first turn")
+    args = parser.parse_args(argv)
+    
+    sessions = load_sessions(args.input)
+    service = get_chat_service()
+    try:
+        runner = BatchRunner(service, args.concurrency, use_cache=not args.no_cache, fresh=args.fresh)
+        summary = runner.run(sessions, args.output)
+    except KeyboardInterrupt:
+        print(f"Interrupted; run again with --output {args.output} to resume")
+        return 130
+    finally:
+        service.close()
+    
+    print(f"{summary['sessions']} sessions: {summary['completed']} turns completed, "
+          f"{summary['skipped']} skipped (checkpoint), {summary['failed']} failed, "
+          f"{summary['remaining']} remaining in {summary['seconds']:.1f}s "
+          f"(p50 {summary['p50']:.2f}s, p95 {summary['p95']:.2f}s)")
+    return 1 if summary["failed"] else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
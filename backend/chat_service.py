@@ -1,67 +1,454 @@
-from typing import List, Tuple
+import os
+import time
+import threading
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
 from langchain_core.messages import HumanMessage, AIMessage
-from .database import DatabaseManager
-from .llm_handler import OllamaLLM
+from .context_builder import ContextBuilder, ContextWindow, with_token_count
+from .context_cache import ContextCache
+from .generation import Cancellation, FailedGeneration
+from .database import (ROLE_AI, ROLE_HUMAN, AsyncDatabaseManager, DatabaseManager, SearchHit, SessionInfo,
+                       StoredMessage)
+from .lifecycle import SessionLifecycle
+from .llm_handler import AsyncOllamaLLM, OllamaLLM
+from .memory import SemanticMemory, build_embedder
+from .metrics import PipelineMetrics
+from .summarizer import ConversationSummarizer
+from .write_buffer import MessageWriteBuffer
+
+def _keep_turn(parts: List[str]) -> bool:
+    """Whether to save a turn: only if reply text was generated and nothing failed"""
+    return any(parts) and not any(isinstance(part, FailedGeneration) for part in parts)
+
+def _pair_messages(messages: List[StoredMessage]) -> List[Tuple[str, str]]:
+    """Group a full history into (human_message, ai_response) tuples"""
+    chat_pairs = []
+    for i in range(0, len(messages) - 1, 2):
+        if (i + 1 < len(messages) and 
+            messages[i].role == ROLE_HUMAN and 
+            messages[i + 1].role == ROLE_AI):
+            chat_pairs.append((messages[i].content, messages[i + 1].content))
+
+    return chat_pairs
+
+def _pair_page(rows: List[StoredMessage], fetched: int) -> Tuple[List[Tuple[str, str]], Optional[int]]:
+    """Pair one page of stored rows and compute the next-page cursor"""
+    chat_pairs = []
+    first_id = None
+    for i in range(len(rows) - 1):
+        human, ai = rows[i], rows[i + 1]
+        if human.role == ROLE_HUMAN and ai.role == ROLE_AI:
+            if first_id is None:
+                first_id = human.id
+            chat_pairs.append((human.content, ai.content))
+
+    # A short page means the start of the session was reached
+    has_more = len(rows) == fetched and first_id is not None
+    return chat_pairs, first_id if has_more else None
 
 class ChatService:
     """
     Main orchestration service for chat functionality.
-    
+
     Responsibilities:
     - Coordinate between database and LLM
     - Manage conversation context and memory
-    - Handle session management
+    - Handle session management (per-owner session index)
     - Process chat messages end-to-end
+    - Keep a rolling summary of turns that fell out of the context window
+    - Recall relevant older messages through semantic memory
+    - Archive and expire idle sessions (SessionLifecycle, off by default);
+      an archived session is restored when it is read again
+    - Time every stage of a turn in PipelineMetrics (served at /metrics
+      on METRICS_PORT when set)
+
+    CHAT_WRITE_MODE selects durability: "sync" (default) commits each turn
+    before returning; "buffered" acknowledges turns immediately and writes
+    them in bulk through a MessageWriteBuffer, trading the last flush
+    interval of messages on a crash for far fewer commits.
     """
-    
+
     def __init__(self):
         self.db_manager = DatabaseManager()
-        self.llm = OllamaLLM()
-    
-    def get_conversation_context(self, session_id: str, max_messages: int = 10) -> str:
-        """Get recent conversation context"""
-        history = self.db_manager.get_chat_history(session_id)
-        messages = history.messages[-max_messages:] if len(history.messages) > max_messages else history.messages
-        
-        context = ""
-        for message in messages:
-            if isinstance(message, HumanMessage):
-                context += f"Human: {message.content}\n"
-            elif isinstance(message, AIMessage):
-                context += f"Assistant: {message.content}\n"
-        
-        return context
-    
-    def chat(self, message: str, session_id: str = "default") -> str:
-        """Process chat message and return response"""
-        # Get conversation context
-        context = self.get_conversation_context(session_id)
-        
-        # Generate response
-        response = self.llm.generate_response(message, context)
-        
-        # Save to database
+        self.metrics = PipelineMetrics()
+        self.llm = OllamaLLM(metrics=self.metrics)
+        self.context_cache = ContextCache()
+        self.context_builder = ContextBuilder()
+        self.summarizer = ConversationSummarizer(
+            self.db_manager,
+            self.llm,
+            keep_recent=self.context_cache.window,
+            on_summary=self.context_cache.set_summary,
+            context_builder=self.context_builder
+        )
+        self.memory = SemanticMemory(self.db_manager, build_embedder(self.llm))
+        self.write_buffer = (MessageWriteBuffer(self.db_manager)
+                             if os.getenv('CHAT_WRITE_MODE', 'sync') == 'buffered' else None)
+        self.llm.response_cache.attach_store(self.db_manager)
+        self.db_manager.start_listener(self._on_history_changed)
+        self.lifecycle = SessionLifecycle(self.db_manager, on_change=self._on_history_changed)
+        self.lifecycle.start()
+        if os.getenv('METRICS_PORT'):
+            self.metrics.serve(int(os.getenv('METRICS_PORT')))
+
+    def _on_history_changed(self, session_id: Optional[str]):
+        """Drop cached state for a session changed by another process"""
+        self.context_cache.invalidate(session_id)
+        self.memory.invalidate(session_id)
+
+    def _flush_pending(self, session_uuid: str):
+        """Make buffered messages of a session visible to database reads"""
+        if self.write_buffer is not None and self.write_buffer.has_pending(session_uuid):
+            self.write_buffer.flush()
+
+    def get_context_window(self, session_id: str, max_messages: Optional[int] = None,
+                           query: Optional[str] = None) -> ContextWindow:
+        """
+        Build the conversation context for a session under the token budget.
+
+        Args:
+            session_id: Conversation session
+            max_messages: Most recent messages to consider (default: cache window)
+            query: Current user message; enables recall of older relevant messages
+
+        Returns:
+            ContextWindow with the text, running summary and the
+            message/token counts included
+        """
+        limit = max_messages or self.context_cache.window
+        model = self.llm.model_name
+        with self.metrics.stage("history", model):
+            history = self.db_manager.get_chat_history(session_id)
+            messages = self.context_cache.get(history.session_id, limit)
+            if messages is None:
+                self._flush_pending(history.session_id)
+                window = max(limit, self.context_cache.window)
+                messages = history.get_recent_messages(window)
+                # Archived messages are older than any hot one, so only a
+                # short read can be missing them
+                if len(messages) < window and self.db_manager.restore_session(history.session_id):
+                    messages = history.get_recent_messages(window)
+                summary = history.get_summary()
+                self.context_cache.put(history.session_id, messages, summary)
+                messages = messages[-limit:]
+            else:
+                summary = self.context_cache.get_summary(history.session_id)
+
+        memories = []
+        if query:
+            with self.metrics.stage("memory", model):
+                recent = [str(message.content) for message in messages]
+                # Memories are optional context; a failing embedder must not fail the turn
+                try:
+                    memories = self.memory.search(history.session_id, query, exclude=recent)
+                except Exception as e:
+                    print(f"Warning: Memory recall failed - {e}")
+
+        with self.metrics.stage("context", model):
+            return self.context_builder.build(messages, summary, memories)
+
+    def get_conversation_context(self, session_id: str, max_messages: Optional[int] = None) -> str:
+        """Get recent conversation context (from the cache for hot sessions)"""
+        return self.get_context_window(session_id, max_messages).text
+
+    def _save_turn(self, session_id: str, message: str, response: str, owner: Optional[str] = None):
+        """Persist a turn with token counts, then append it to the context cache"""
+        turn = [with_token_count(HumanMessage(content=message)), with_token_count(AIMessage(content=response))]
         history = self.db_manager.get_chat_history(session_id)
-        history.add_user_message(message)
-        history.add_ai_message(response)
+        with self.metrics.stage("db_write", self.llm.model_name):
+            if owner is not None:
+                self.db_manager.claim_session(history.session_id, owner)
+            if self.write_buffer is not None:
+                self.write_buffer.add(history.session_id, turn)
+            else:
+                # Both messages in one INSERT and one commit
+                history.add_messages(turn)
+        self.context_cache.append(history.session_id, turn)
+        self.memory.index(history.session_id, turn)
+
+    def chat(self, message: str, session_id: str = "default", use_cache: bool = True,
+             options: Optional[Dict[str, Any]] = None, cancel: Optional[Cancellation] = None,
+             owner: Optional[str] = None) -> str:
+        """
+        Process chat message and return response (use_cache=False forces a fresh generation).
         
+        `options` are per-request generation options (see ollama_options);
+        `cancel` stops the generation early. A failed generation (returned
+        as FailedGeneration, e.g. the LLM was busy or cancelled before any
+        reply text) is not saved. With an `owner`, a session that has none
+        yet is listed under it once the turn is saved.
+        """
+        with self.metrics.turn(self.llm.model_name):
+            # Get conversation context
+            window = self.get_context_window(session_id, query=message)
+
+            # Generate response
+            response = self.llm.chat_response(message, window, use_cache=use_cache, session_id=session_id,
+                                              options=options, cancel=cancel)
+
+            # Save to database, then to the context cache
+            if _keep_turn([response]):
+                self._save_turn(session_id, message, response, owner)
+
+        # Compact older turns off the request path
+        self.summarizer.schedule(session_id)
+
         return response
-    
+
+    def chat_stream(self, message: str, session_id: str = "default", use_cache: bool = True,
+                    options: Optional[Dict[str, Any]] = None, cancel: Optional[Cancellation] = None,
+                    owner: Optional[str] = None) -> Iterator[str]:
+        """
+        Process chat message and yield response tokens as they arrive.
+
+        The turn is saved once the stream finishes, or with the partial
+        response if the consumer stops iterating early; not if the stream
+        yielded a FailedGeneration.
+        """
+        started = time.perf_counter()
+        window = self.get_context_window(session_id, query=message)
+
+        tokens = []
+        try:
+            for token in self.llm.stream_chat(message, window, use_cache=use_cache, session_id=session_id,
+                                              options=options, cancel=cancel):
+                tokens.append(token)
+                yield token
+        finally:
+            if _keep_turn(tokens):
+                self._save_turn(session_id, message, "".join(tokens), owner)
+                self.summarizer.schedule(session_id)
+            self.metrics.observe("turn", self.llm.model_name, time.perf_counter() - started)
+
     def get_chat_history(self, session_id: str = "default") -> List[Tuple[str, str]]:
         """Get chat history as list of (human_message, ai_response) tuples"""
         history = self.db_manager.get_chat_history(session_id)
+        self._flush_pending(history.session_id)
+        self.db_manager.restore_session(history.session_id)
+
+        return _pair_messages(history.get_stored_messages())
+
+    def get_chat_history_page(self, session_id: str = "default", limit: int = 20,
+                              before_id: Optional[int] = None) -> Tuple[List[Tuple[str, str]], Optional[int]]:
+        """
+        Get one page of chat history, newest page first.
+
+        Args:
+            session_id: Conversation session
+            limit: Maximum number of (human_message, ai_response) pairs
+            before_id: Cursor returned by the previous call (None for newest)
+
+        Returns:
+            Tuple of (pairs oldest first, cursor for the next older page or None)
+        """
+        history = self.db_manager.get_chat_history(session_id)
+        self._flush_pending(history.session_id)
+        rows = history.get_stored_page(limit * 2, before_id)
+        if len(rows) < limit * 2 and self.db_manager.restore_session(history.session_id):
+            rows = history.get_stored_page(limit * 2, before_id)
+
+        return _pair_page(rows, limit * 2)
+
+    def clear_history(self, session_id: str = "default"):
+        """Clear chat history for session"""
+        history = self.db_manager.get_chat_history(session_id)
+        # Buffered messages and queued memories must not land after the delete
+        self._flush_pending(history.session_id)
+        self.memory.discard(history.session_id)
+        self.db_manager.clear_history(session_id)
+        self._on_history_changed(history.session_id)
+
+    def create_session(self, owner: str, title: Optional[str] = None) -> str:
+        """Start a new session for `owner` and return its id"""
+        return self.db_manager.create_session(owner, title)
+    
+    def list_sessions(self, owner: str, limit: int = 20,
+                      cursor: Optional[str] = None) -> Tuple[List[SessionInfo], Optional[str]]:
+        """
+        Get one page of an owner's sessions, most recently active first.
         
-        chat_pairs = []
-        messages = history.messages
-        
-        for i in range(0, len(messages) - 1, 2):
-            if (i + 1 < len(messages) and 
-                isinstance(messages[i], HumanMessage) and 
-                isinstance(messages[i + 1], AIMessage)):
-                chat_pairs.append((messages[i].content, messages[i + 1].content))
+        Returns:
+            Tuple of (sessions, cursor for the next page or None)
+        """
+        return self.db_manager.list_sessions(owner, limit, cursor)
+    
+    def search_history(self, query: str, session_id: Optional[str] = None, owner: Optional[str] = None,
+                       limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[SearchHit], Optional[str]]:
+        """
+        Full-text search over one session and/or one owner's sessions.
         
-        return chat_pairs
+        Returns:
+            Tuple of (hits, best first, cursor for the next page or None)
+        """
+        if session_id is not None:
+            self._flush_pending(self.db_manager.get_chat_history(session_id).session_id)
+        elif self.write_buffer is not None:
+            self.write_buffer.flush()
+        return self.db_manager.search_messages(query, session_id, owner, limit, cursor)
     
-    def clear_history(self, session_id: str = "default"):
+    def close(self):
+        """Flush buffered messages, stop background workers and close connections"""
+        if self.write_buffer is not None:
+            self.write_buffer.close()
+        self.summarizer.stop()
+        self.lifecycle.stop()
+        self.memory.stop()
+        self.llm.close()
+        self.metrics.stop()
+        self.db_manager.close()
+
+class AsyncChatService:
+    """
+    Async orchestration service with the same semantics as ChatService.
+
+    Backed by AsyncDatabaseManager and AsyncOllamaLLM so that many concurrent
+    sessions can be served from a single event loop without a thread per
+    in-flight LLM call. Running summaries are read and included in prompts;
+    they are produced by the summarization worker of the sync ChatService.
+    Semantic memory recall is only available in the sync ChatService. Use as
+    an async context manager, or call `await open()` / `await close()`
+    explicitly.
+    """
+
+    def __init__(self):
+        self.db_manager = AsyncDatabaseManager()
+        self.metrics = PipelineMetrics()
+        self.llm = AsyncOllamaLLM(metrics=self.metrics)
+        self.context_cache = ContextCache()
+        self.context_builder = ContextBuilder()
+
+    async def open(self):
+        """Open database pool, start cache invalidation and verify Ollama"""
+        await self.db_manager.open()
+        self.db_manager.start_listener(self.context_cache.invalidate)
+        await self.llm._check_ollama_connection()
+
+    async def close(self):
+        """Release HTTP and database connections"""
+        await self.llm.aclose()
+        await self.db_manager.close()
+
+    async def __aenter__(self) -> "AsyncChatService":
+        await self.open()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def get_context_window(self, session_id: str, max_messages: Optional[int] = None) -> ContextWindow:
+        """Async version of ChatService.get_context_window"""
+        limit = max_messages or self.context_cache.window
+        with self.metrics.stage("history", self.llm.model_name):
+            history = self.db_manager.get_chat_history(session_id)
+            messages = self.context_cache.get(history.session_id, limit)
+            if messages is None:
+                window = max(limit, self.context_cache.window)
+                messages = await history.aget_recent_messages(window)
+                if len(messages) < window and await self.db_manager.restore_session(history.session_id):
+                    messages = await history.aget_recent_messages(window)
+                summary = await history.aget_summary()
+                self.context_cache.put(history.session_id, messages, summary)
+                messages = messages[-limit:]
+            else:
+                summary = self.context_cache.get_summary(history.session_id)
+
+        with self.metrics.stage("context", self.llm.model_name):
+            return self.context_builder.build(messages, summary)
+
+    async def get_conversation_context(self, session_id: str, max_messages: Optional[int] = None) -> str:
+        """Get recent conversation context"""
+        return (await self.get_context_window(session_id, max_messages)).text
+
+    async def _save_turn(self, session_id: str, message: str, response: str, owner: Optional[str] = None):
+        """Persist a turn with token counts, then append it to the context cache"""
+        turn = [with_token_count(HumanMessage(content=message)), with_token_count(AIMessage(content=response))]
+        history = self.db_manager.get_chat_history(session_id)
+        with self.metrics.stage("db_write", self.llm.model_name):
+            if owner is not None:
+                await self.db_manager.claim_session(history.session_id, owner)
+            await history.aadd_messages(turn)
+        self.context_cache.append(history.session_id, turn)
+
+    async def chat(self, message: str, session_id: str = "default", use_cache: bool = True,
+                   options: Optional[Dict[str, Any]] = None, cancel: Optional[Cancellation] = None,
+                   owner: Optional[str] = None) -> str:
+        """Process chat message and return response"""
+        with self.metrics.turn(self.llm.model_name):
+            window = await self.get_context_window(session_id)
+
+            response = await self.llm.chat_response(message, window, use_cache=use_cache, session_id=session_id,
+                                                    options=options, cancel=cancel)
+
+            if _keep_turn([response]):
+                await self._save_turn(session_id, message, response, owner)
+
+        return response
+
+    async def chat_stream(self, message: str, session_id: str = "default", use_cache: bool = True,
+                          options: Optional[Dict[str, Any]] = None,
+                          cancel: Optional[Cancellation] = None,
+                          owner: Optional[str] = None) -> AsyncIterator[str]:
+        """Async version of ChatService.chat_stream"""
+        window = await self.get_context_window(session_id)
+
+        tokens = []
+        try:
+            async for token in self.llm.stream_chat(message, window, use_cache=use_cache,
+                                                    session_id=session_id, options=options, cancel=cancel):
+                tokens.append(token)
+                yield token
+        finally:
+            if _keep_turn(tokens):
+                await self._save_turn(session_id, message, "".join(tokens), owner)
+
+    async def get_chat_history(self, session_id: str = "default") -> List[Tuple[str, str]]:
+        """Get chat history as list of (human_message, ai_response) tuples"""
+        history = self.db_manager.get_chat_history(session_id)
+        await self.db_manager.restore_session(history.session_id)
+
+        return _pair_messages(await history.aget_stored_messages())
+
+    async def get_chat_history_page(self, session_id: str = "default", limit: int = 20,
+                                    before_id: Optional[int] = None) -> Tuple[List[Tuple[str, str]], Optional[int]]:
+        """Async version of ChatService.get_chat_history_page"""
+        history = self.db_manager.get_chat_history(session_id)
+        rows = await history.aget_stored_page(limit * 2, before_id)
+        if len(rows) < limit * 2 and await self.db_manager.restore_session(history.session_id):
+            rows = await history.aget_stored_page(limit * 2, before_id)
+
+        return _pair_page(rows, limit * 2)
+
+    async def clear_history(self, session_id: str = "default"):
         """Clear chat history for session"""
-        self.db_manager.clear_history(session_id)
\ No newline at end of file
+        await self.db_manager.clear_history(session_id)
+        self.context_cache.invalidate(self.db_manager.get_chat_history(session_id).session_id)
+
+    async def create_session(self, owner: str, title: Optional[str] = None) -> str:
+        """Start a new session for `owner` and return its id"""
+        return await self.db_manager.create_session(owner, title)
+    
+    async def list_sessions(self, owner: str, limit: int = 20,
+                            cursor: Optional[str] = None) -> Tuple[List[SessionInfo], Optional[str]]:
+        """Async version of ChatService.list_sessions"""
+        return await self.db_manager.list_sessions(owner, limit, cursor)
+
+    async def search_history(self, query: str, session_id: Optional[str] = None, owner: Optional[str] = None,
+                             limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[SearchHit], Optional[str]]:
+        """Async version of ChatService.search_history"""
+        return await self.db_manager.search_messages(query, session_id, owner, limit, cursor)
+
+_shared_service: Optional[ChatService] = None
+_shared_service_lock = threading.Lock()
+
+def get_chat_service() -> ChatService:
+    """
+    Process-wide ChatService, created on first call.
+
+    Every caller in the process shares one connection pool, LLM session,
+    context cache and background workers instead of building its own.
+    """
+    global _shared_service
+    if _shared_service is None:
+        with _shared_service_lock:
+            if _shared_service is None:
+                _shared_service = ChatService()
+    return _shared_service
@@ -0,0 +1,125 @@
+import os
+import re
+import zlib
+from typing import List, NamedTuple, Optional, Sequence, Tuple
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+
+# Average characters per token for Llama-family tokenizers on English text
+CHARS_PER_TOKEN = 4
+
+_WORD_PATTERN = re.compile(r"\w+|[^\w\s]")
+
+class ContextWindow(NamedTuple):
+    """Assembled conversation context and what went into it"""
+    text: str
+    message_count: int
+    token_count: int
+    summary: str = ""
+    memory_count: int = 0
+    messages: Tuple[BaseMessage, ...] = ()
+    memory_text: str = ""
+
+def estimate_tokens(text: str) -> int:
+    """
+    Fast local token estimate without loading a tokenizer.
+    
+    Takes the larger of a characters-per-token estimate and the number of
+    words/punctuation marks, which keeps short, punctuation-heavy text from
+    being undercounted.
+    """
+    return max(len(text) // CHARS_PER_TOKEN, len(_WORD_PATTERN.findall(text)), 1)
+
+def message_tokens(message: BaseMessage) -> int:
+    """Token count of a message, cached in its additional_kwargs"""
+    count = message.additional_kwargs.get("token_count")
+    if count is None:
+        count = estimate_tokens(str(message.content))
+        message.additional_kwargs["token_count"] = count
+    return count
+
+def with_token_count(message: BaseMessage) -> BaseMessage:
+    """Attach the token count so it is stored alongside the message"""
+    message_tokens(message)
+    return message
+
+class ContextBuilder:
+    """
+    Packs recent messages into a prompt context under a token budget.
+    
+    Messages are taken newest-first until the next one would exceed the
+    budget (CONTEXT_TOKEN_BUDGET), then rendered oldest-first as
+    Human/Assistant lines with a single join. A running summary of older
+    turns is charged against the budget first. Recalled long-term memories
+    get their own share (CONTEXT_MEMORY_BUDGET, a fifth of the budget by
+    default) and are placed ahead of the recent turns. The share is set
+    aside whether or not anything is recalled, so which turns fit depends
+    only on the history and the summary, never on the query; the
+    summarizer relies on that to fold exactly the turns left out.
+    
+    Once older turns have to be dropped, the window starts at an "anchor"
+    turn: a human message whose content hash is divisible by
+    CONTEXT_PREFIX_STEP. Anchors don't change as the conversation grows, so
+    the window start (and the prompt prefix the LLM can reuse) only moves
+    every few turns instead of on every turn. Set CONTEXT_PREFIX_STEP=1 to
+    always keep as many turns as fit.
+    """
+    
+    def __init__(self, token_budget: Optional[int] = None, prefix_step: Optional[int] = None,
+                 memory_budget: Optional[int] = None):
+        self.token_budget = token_budget or int(os.getenv('CONTEXT_TOKEN_BUDGET', '1500'))
+        self.prefix_step = prefix_step or int(os.getenv('CONTEXT_PREFIX_STEP', '4'))
+        if memory_budget is None:
+            memory_budget = int(os.getenv('CONTEXT_MEMORY_BUDGET', str(self.token_budget // 5)))
+        self.memory_budget = memory_budget
+    
+    def _is_anchor(self, message: BaseMessage) -> bool:
+        return (isinstance(message, HumanMessage) and
+                zlib.crc32(str(message.content).encode()) % self.prefix_step == 0)
+    
+    def build(self, messages: List[BaseMessage], summary: str = "",
+              memories: Sequence = ()) -> ContextWindow:
+        """
+        Assemble the context for the given messages (oldest first).
+        
+        Args:
+            messages: Recent messages, oldest first
+            summary: Running summary of older turns
+            memories: Recalled items with `role` and `content`, best first
+        """
+        used = estimate_tokens(summary) if summary else 0
+        
+        memory_lines = []
+        memory_used = 0
+        for memory in memories:
+            line = f"- {memory.role}: {memory.content}\n"
+            cost = estimate_tokens(line)
+            if memory_used + cost > self.memory_budget:
+                break
+            memory_lines.append(line)
+            memory_used += cost
+        
+        turns = [message for message in messages if isinstance(message, (HumanMessage, AIMessage))]
+        # +2 covers the role prefix and line break
+        costs = [message_tokens(message) + 2 for message in turns]
+        turn_budget = self.token_budget - self.memory_budget
+        start = len(turns)
+        while start > 0 and used + costs[start - 1] <= turn_budget:
+            start -= 1
+            used += costs[start]
+        
+        if 0 < start < len(turns) and self.prefix_step > 1:
+            anchor = next((i for i in range(start, len(turns)) if self._is_anchor(turns[i])), None)
+            if anchor is not None:
+                used -= sum(costs[start:anchor])
+                start = anchor
+        
+        included = turns[start:]
+        lines = [
+            f"{'Human' if isinstance(message, HumanMessage) else 'Assistant'}: {message.content}\n"
+            for message in included
+        ]
+        memory_text = "".join(memory_lines)
+        if memory_lines:
+            lines[:0] = ["Relevant earlier messages:\n", *memory_lines, "\n"]
+        return ContextWindow("".join(lines), len(included), used + memory_used, summary, len(memory_lines),
+                             tuple(included), memory_text)
\ No newline at end of file
@@ -0,0 +1,138 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional
+from langchain_core.messages import BaseMessage
+
+# Rough per-message bookkeeping cost on top of the content itself
+MESSAGE_OVERHEAD_BYTES = 200
+
+class _CacheEntry:
+    __slots__ = ("messages", "summary", "size", "expires_at")
+    
+    def __init__(self, messages: List[BaseMessage], summary: str, size: int, expires_at: float):
+        self.messages = messages
+        self.summary = summary
+        self.size = size
+        self.expires_at = expires_at
+
+class ContextCache:
+    """
+    In-process LRU/TTL cache of the most recent messages per session.
+    
+    Key responsibilities:
+    - Serve conversation context for hot sessions without a DB round-trip
+    - Append new turns in place (write-through; the caller persists first)
+    - Hold the session's running summary of older turns
+    - Bound memory by total message bytes, evicting least recently used
+    - Drop sessions on clear_history or cross-process change notifications
+    
+    Configured through CONTEXT_CACHE_WINDOW (messages kept per session),
+    CONTEXT_CACHE_TTL (seconds) and CONTEXT_CACHE_MAX_BYTES.
+    """
+    
+    def __init__(self, window: Optional[int] = None, ttl: Optional[float] = None,
+                 max_bytes: Optional[int] = None):
+        self.window = window or int(os.getenv('CONTEXT_CACHE_WINDOW', '50'))
+        self.ttl = ttl or float(os.getenv('CONTEXT_CACHE_TTL', '300'))
+        self.max_bytes = max_bytes or int(os.getenv('CONTEXT_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+        self._entries: "OrderedDict[Any, _CacheEntry]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def _message_size(self, message: BaseMessage) -> int:
+        return len(str(message.content)) + MESSAGE_OVERHEAD_BYTES
+    
+    def _remove(self, key: Any):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self.total_bytes -= entry.size
+    
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._remove(key)
+            self.evictions += 1
+    
+    def get(self, key: Any, max_messages: int) -> Optional[List[BaseMessage]]:
+        """Return the last `max_messages` cached messages, or None on a miss"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or max_messages > self.window:
+                self.misses += 1
+                return None
+            if entry.expires_at < time.monotonic():
+                self._remove(key)
+                self.misses += 1
+                return None
+            
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry.messages[-max_messages:]
+    
+    def get_summary(self, key: Any) -> str:
+        """Return the cached running summary ("" if none or not cached)"""
+        with self._lock:
+            entry = self._entries.get(key)
+            return entry.summary if entry is not None else ""
+    
+    def put(self, key: Any, messages: List[BaseMessage], summary: str = ""):
+        """Cache the most recent messages of a session loaded from the database"""
+        messages = list(messages[-self.window:])
+        with self._lock:
+            self._remove(key)
+            size = sum(self._message_size(message) for message in messages) + len(summary)
+            self._entries[key] = _CacheEntry(messages, summary, size, time.monotonic() + self.ttl)
+            self.total_bytes += size
+            self._evict()
+    
+    def append(self, key: Any, messages: List[BaseMessage]):
+        """Append persisted messages to a cached session, if it is cached"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            
+            old_size = entry.size
+            entry.messages.extend(messages)
+            entry.size += sum(self._message_size(message) for message in messages)
+            while len(entry.messages) > self.window:
+                entry.size -= self._message_size(entry.messages.pop(0))
+            self.total_bytes += entry.size - old_size
+            entry.expires_at = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            self._evict()
+    
+    def set_summary(self, key: Any, summary: str):
+        """Replace the running summary of a cached session"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return
+            self.total_bytes += len(summary) - len(entry.summary)
+            entry.size += len(summary) - len(entry.summary)
+            entry.summary = summary
+    
+    def invalidate(self, key: Any = None):
+        """Drop one session, or every session when key is None"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+                self.total_bytes = 0
+            else:
+                self._remove(key)
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get hit/miss/eviction counters and current memory use"""
+        with self._lock:
+            return {
+                "sessions": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
\ No newline at end of file
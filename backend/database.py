@@ -1,30 +1,492 @@
 import os
+import json
 import uuid
-from typing import Optional
-from langchain_postgres import PostgresChatMessageHistory
-from langchain_core.messages import BaseMessage
-from sqlalchemy import create_engine, text
+import asyncio
+import zlib
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, NamedTuple, Optional, Sequence, Tuple
 import psycopg
+from langchain_core.chat_history import BaseChatMessageHistory
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage
+from psycopg import sql
+from psycopg_pool import AsyncConnectionPool, ConnectionPool
 from dotenv import load_dotenv
+from .migrations import SEARCH_CONFIG, amigrate, migrate
 
 load_dotenv()
 
-class DatabaseManager:
+CHANGE_CHANNEL = "chat_history_changed"
+
+# chat_history.role values (see migration 2)
+ROLE_HUMAN = 0
+ROLE_AI = 1
+ROLE_SYSTEM = 2
+
+_ROLES = {"human": ROLE_HUMAN, "ai": ROLE_AI, "system": ROLE_SYSTEM}
+_MESSAGE_CLASSES = {ROLE_HUMAN: HumanMessage, ROLE_AI: AIMessage, ROLE_SYSTEM: SystemMessage}
+
+class StoredMessage(NamedTuple):
+    """A chat_history row as stored: read without building LangChain objects"""
+    id: int
+    role: int
+    content: str
+    token_count: Optional[int]
+
+    def to_message(self) -> BaseMessage:
+        """Build the LangChain message, carrying the stored token count"""
+        additional_kwargs = {"token_count": self.token_count} if self.token_count is not None else {}
+        return _MESSAGE_CLASSES[self.role](content=self.content, additional_kwargs=additional_kwargs)
+
+class SessionInfo(NamedTuple):
+    """A row of the per-owner session index"""
+    session_id: str
+    title: Optional[str]
+    last_active_at: datetime
+    message_count: int
+
+class SearchHit(NamedTuple):
+    """A message matching a full-text search, with a highlighted snippet"""
+    session_id: str
+    message_id: int
+    role: int
+    created_at: datetime
+    rank: float
+    snippet: str
+
+@lru_cache(maxsize=65536)
+def resolve_session_id(session_id: str) -> str:
+    """Session UUID for a session id: UUIDs as-is (normalized), other strings via uuid5"""
+    try:
+        # Try to parse as UUID (normalized to match Postgres' text form)
+        return str(uuid.UUID(session_id))
+    except ValueError:
+        # Create a deterministic UUID from the string
+        return str(uuid.uuid5(uuid.NAMESPACE_DNS, session_id))
+
+def _message_columns(message: BaseMessage) -> Tuple[int, str, Optional[int]]:
+    """(role, content, token_count) of a message to store"""
+    role = _ROLES.get(message.type)
+    if role is None:
+        raise ValueError(f"Cannot store {message.type!r} messages in chat_history")
+    return role, str(message.content), message.additional_kwargs.get("token_count")
+
+def _messages_query(table_name: str) -> sql.Composed:
+    """Every message of a session, oldest first"""
+    return sql.SQL(
+        "SELECT id, role, content, token_count FROM {table} "
+        "WHERE session_id = %(session_id)s ORDER BY id"
+    ).format(table=sql.Identifier(table_name))
+
+def _messages_page_query(table_name: str) -> sql.Composed:
+    """Newest-first window of a session's messages older than a cursor"""
+    return sql.SQL(
+        "SELECT id, role, content, token_count FROM {table} "
+        "WHERE session_id = %(session_id)s "
+        "AND (%(before_id)s::int IS NULL OR id < %(before_id)s::int) "
+        "ORDER BY id DESC LIMIT %(limit)s"
+    ).format(table=sql.Identifier(table_name))
+
+def _messages_range_query(table_name: str) -> sql.Composed:
+    """Oldest-first messages of a session strictly between two ids"""
+    return sql.SQL(
+        "SELECT id, role, content, token_count FROM {table} "
+        "WHERE session_id = %(session_id)s "
+        "AND id > %(after_id)s AND id < %(before_id)s "
+        "ORDER BY id LIMIT %(limit)s"
+    ).format(table=sql.Identifier(table_name))
+
+def _delete_messages_query(table_name: str) -> sql.Composed:
+    return sql.SQL("DELETE FROM {table} WHERE session_id = %(session_id)s").format(
+        table=sql.Identifier(table_name)
+    )
+
+def _insert_messages_query(table_name: str, count: int) -> sql.Composed:
+    """Single multi-row INSERT of `count` (session_id, role, content, token_count) rows"""
+    return sql.SQL("INSERT INTO {table} (session_id, role, content, token_count) VALUES {values}").format(
+        table=sql.Identifier(table_name),
+        values=sql.SQL(", ").join([sql.SQL("(%s, %s, %s, %s)")] * count)
+    )
+
+def _insert_messages_params(session_id: str, messages: Sequence[BaseMessage]) -> List[Any]:
+    params: List[Any] = []
+    for message in messages:
+        params.append(session_id)
+        params.extend(_message_columns(message))
+    return params
+
+SUMMARY_QUERY = (
+    "SELECT summary, summarized_through_id FROM chat_summaries "
+    "WHERE session_id = %(session_id)s"
+)
+
+# Never move a summary backwards if two workers race on the same session
+SAVE_SUMMARY_QUERY = (
+    "INSERT INTO chat_summaries (session_id, summary, summarized_through_id) "
+    "VALUES (%(session_id)s, %(summary)s, %(through_id)s) "
+    "ON CONFLICT (session_id) DO UPDATE SET "
+    "summary = EXCLUDED.summary, "
+    "summarized_through_id = EXCLUDED.summarized_through_id, "
+    "updated_at = NOW() "
+    "WHERE chat_summaries.summarized_through_id < EXCLUDED.summarized_through_id"
+)
+
+DELETE_SUMMARY_QUERY = "DELETE FROM chat_summaries WHERE session_id = %(session_id)s"
+
+DELETE_MEMORIES_QUERY = "DELETE FROM chat_memories WHERE session_id = %(session_id)s"
+
+DELETE_ARCHIVE_QUERY = "DELETE FROM chat_archive WHERE session_id = %(session_id)s"
+
+# Lifecycle jobs claim sessions with SKIP LOCKED so concurrent runs split the work
+IDLE_SESSIONS_QUERY = (
+    "SELECT session_id FROM chat_sessions "
+    "WHERE message_count > 0 AND last_active_at < NOW() - make_interval(secs => %(idle)s) "
+    "ORDER BY last_active_at LIMIT %(limit)s FOR UPDATE SKIP LOCKED"
+)
+
+EXPIRED_SESSIONS_QUERY = (
+    "SELECT session_id FROM chat_sessions "
+    "WHERE last_active_at < NOW() - make_interval(secs => %(ttl)s) "
+    "ORDER BY last_active_at LIMIT %(limit)s FOR UPDATE SKIP LOCKED"
+)
+
+ARCHIVE_ROWS_QUERY = (
+    "SELECT id, role, content, token_count, created_at FROM chat_history "
+    "WHERE session_id = %(session_id)s ORDER BY id"
+)
+
+SAVE_ARCHIVE_QUERY = (
+    "INSERT INTO chat_archive (session_id, first_id, last_id, message_count, data) "
+    "VALUES (%(session_id)s, %(first_id)s, %(last_id)s, %(count)s, %(data)s)"
+)
+
+TAKE_ARCHIVE_QUERY = "DELETE FROM chat_archive WHERE session_id = %(session_id)s RETURNING first_id, data"
+
+RESTORE_ROWS_COPY = "COPY chat_history (id, session_id, role, content, token_count, created_at) FROM STDIN"
+
+EXPIRE_QUERIES = [
+    f"DELETE FROM {table} WHERE session_id = ANY(%(session_ids)s)"
+    for table in ("chat_history", "chat_summaries", "chat_memories", "chat_archive", "chat_sessions")
+]
+
+CREATE_SESSION_QUERY = (
+    "INSERT INTO chat_sessions (session_id, owner, title) "
+    "VALUES (%(session_id)s, %(owner)s, %(title)s)"
+)
+
+# Sessions written to before they had an owner go to the first owner that
+# writes to them; owned sessions never change hands
+CLAIM_SESSION_QUERY = (
+    "INSERT INTO chat_sessions (session_id, owner) VALUES (%(session_id)s, %(owner)s) "
+    "ON CONFLICT (session_id) DO UPDATE SET owner = EXCLUDED.owner WHERE chat_sessions.owner IS NULL"
+)
+
+# (session, owner) claims each manager remembers, so a session is claimed
+# once per process rather than on every turn
+CLAIM_MEMO_SIZE = 65536
+
+# Sessions each manager knows to have nothing in chat_archive, so short reads
+# of new sessions don't look for an archive every time
+ARCHIVE_MEMO_SIZE = 65536
+
+# Newest first, keyset-paginated on (last_active_at, session_id) through
+# idx_chat_sessions_owner_recent; fetches one extra row to detect more pages
+# message_count includes archived messages, which come back on the next read
+LIST_SESSIONS_QUERY = (
+    "SELECT session_id, title, last_active_at, message_count + COALESCE(("
+    "SELECT SUM(message_count) FROM chat_archive WHERE chat_archive.session_id = chat_sessions.session_id"
+    "), 0) FROM chat_sessions "
+    "WHERE owner = %(owner)s AND (%(before_at)s::timestamptz IS NULL "
+    "OR (last_active_at, session_id) < (%(before_at)s::timestamptz, %(before_id)s::uuid)) "
+    "ORDER BY last_active_at DESC, session_id DESC LIMIT %(limit)s"
+)
+
+def _list_sessions_params(owner: str, limit: int, cursor: Optional[str]) -> Dict[str, Any]:
+    """Query parameters for a page after `cursor` ("<last active ISO time>|<session UUID>")"""
+    before_at = before_id = None
+    if cursor:
+        before_at, separator, before_id = cursor.partition("|")
+        if not separator:
+            raise ValueError(f"Invalid session cursor: {cursor!r}")
+        before_at, before_id = datetime.fromisoformat(before_at), str(uuid.UUID(before_id))
+    return {"owner": owner, "before_at": before_at, "before_id": before_id, "limit": limit + 1}
+
+def _sessions_page(rows: List[Tuple[Any, ...]], limit: int) -> Tuple[List[SessionInfo], Optional[str]]:
+    sessions = [SessionInfo(str(row[0]), row[1], row[2], row[3]) for row in rows[:limit]]
+    if len(rows) <= limit:
+        return sessions, None
+    last = sessions[-1]
+    return sessions, f"{last.last_active_at.isoformat()}|{last.session_id}"
+
+# Matched words are wrapped in ** (Markdown bold) in snippets
+SEARCH_HEADLINE_OPTIONS = 'StartSel=**, StopSel=**, MinWords=10, MaxWords=30, MaxFragments=2, FragmentDelimiter=" … "'
+
+def _search_query(by_session: bool, by_owner: bool) -> sql.Composed:
     """
-    Manages PostgreSQL database connections and chat history operations.
+    Best-ranked matches after a (rank, id) cursor.
     
-    Key responsibilities:
-    - Establish database connections
-    - Handle chat history storage/retrieval
-    - Manage session IDs (convert to UUID format)
-    - Initialize database schema
+    A session's matches come from its one partition, through the GIN index
+    or the primary key, whichever the planner finds cheaper. An owner's
+    sessions are read one by one through the primary key (LATERAL) and
+    filtered, so the cost follows the owner's history rather than how
+    common the words are overall. Only the page's rows get a ts_headline
+    snippet.
+    
+    Run it unprepared: the best plan depends on how common the words are,
+    which a generic (prepared) plan cannot see.
+    """
+    if by_owner:
+        owned = "owned.owner = %(owner)s" + (" AND owned.session_id = %(session_id)s" if by_session else "")
+        # OFFSET 0 keeps the planner from flattening the LATERAL into a join
+        # over every partition's matches, or pushing the match into it
+        source = (
+            "chat_sessions AS owned, LATERAL ("
+            "SELECT session_id, id, role, created_at, content, search_vector FROM chat_history "
+            "WHERE session_id = owned.session_id OFFSET 0"
+            f") AS history WHERE {owned} AND "
+        )
+    else:
+        source = "chat_history AS history WHERE history.session_id = %(session_id)s AND "
+    matches = (
+        "SELECT history.session_id, history.id, history.role, history.created_at, history.content, "
+        "ts_rank(history.search_vector, websearch_to_tsquery({config}, %(query)s)) AS rank "
+        "FROM " + source + "history.search_vector @@ websearch_to_tsquery({config}, %(query)s)"
+    )
+    return sql.SQL(
+        "SELECT session_id, id, role, created_at, rank, "
+        "ts_headline({config}, content, websearch_to_tsquery({config}, %(query)s), %(headline)s) "
+        "FROM ("
+        "SELECT * FROM (" + matches + ") AS matches "
+        "WHERE %(before_rank)s::real IS NULL OR (rank, id) < (%(before_rank)s::real, %(before_id)s::int) "
+        "ORDER BY rank DESC, id DESC LIMIT %(limit)s"
+        ") AS page ORDER BY rank DESC, id DESC"
+    ).format(config=sql.SQL("{}::regconfig").format(sql.Literal(SEARCH_CONFIG)))
+
+def _search_params(query: str, session_uuid: Optional[str], owner: Optional[str], limit: int,
+                   cursor: Optional[str]) -> Dict[str, Any]:
+    """Query parameters for a page after `cursor` ("<rank>|<message id>")"""
+    if session_uuid is None and owner is None:
+        raise ValueError("Search needs a session_id or an owner")
+    before_rank = before_id = None
+    if cursor:
+        before_rank, separator, before_id = cursor.partition("|")
+        if not separator:
+            raise ValueError(f"Invalid search cursor: {cursor!r}")
+        before_rank, before_id = float(before_rank), int(before_id)
+    return {"query": query, "session_id": session_uuid, "owner": owner, "headline": SEARCH_HEADLINE_OPTIONS,
+            "before_rank": before_rank, "before_id": before_id, "limit": limit + 1}
+
+def _search_page(rows: List[Tuple[Any, ...]], limit: int) -> Tuple[List[SearchHit], Optional[str]]:
+    hits = [SearchHit(str(row[0]), *row[1:]) for row in rows[:limit]]
+    if len(rows) <= limit:
+        return hits, None
+    # repr round-trips the float4 rank exactly through ::real
+    return hits, f"{hits[-1].rank!r}|{hits[-1].message_id}"
+
+def _pack_archive(rows: List[Tuple[Any, ...]]) -> bytes:
+    """Compress (id, role, content, token_count, created_at) rows for chat_archive"""
+    return zlib.compress(json.dumps(
+        [[id_, role, content, token_count, created_at.isoformat()]
+         for id_, role, content, token_count, created_at in rows]
+    ).encode())
+
+def _unpack_archive(data: bytes) -> List[List[Any]]:
+    return json.loads(zlib.decompress(data))
+
+def _archived_rows(session_uuid: str, batches: List[Tuple[int, bytes]]) -> Iterator[Tuple[Any, ...]]:
+    """chat_history rows of a session's archive batches, oldest first"""
+    for _, data in sorted(batches):
+        for id_, role, content, token_count, created_at in _unpack_archive(data):
+            yield (id_, session_uuid, role, content, token_count, created_at)
+
+def _stored(rows: List[Tuple[Any, ...]]) -> List[StoredMessage]:
+    return [StoredMessage._make(row) for row in rows]
+
+def _with_ids(rows: List[StoredMessage]) -> List[Tuple[int, BaseMessage]]:
+    return [(row.id, row.to_message()) for row in rows]
+
+class PooledChatMessageHistory(BaseChatMessageHistory):
+    """
+    Chat history for one session backed by a shared connection pool.
+
+    Each operation borrows a connection from the pool for the duration of
+    the query and returns it afterwards, so history objects can be created
+    freely without holding (or leaking) a database connection.
+    """
+
+    def __init__(self, table_name: str, session_id: str, pool: ConnectionPool):
+        self.table_name = table_name
+        self.session_id = session_id
+        self.pool = pool
+
+    @property
+    def messages(self) -> List[BaseMessage]:
+        return [row.to_message() for row in self.get_stored_messages()]
+
+    def get_stored_messages(self) -> List[StoredMessage]:
+        """Every message of the session, oldest first, as plain StoredMessage rows"""
+        with self.pool.connection() as conn:
+            rows = conn.execute(_messages_query(self.table_name), {"session_id": self.session_id}).fetchall()
+        return _stored(rows)
+
+    def add_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Insert messages with one multi-row INSERT in a single transaction"""
+        if not messages:
+            return
+        with self.pool.connection() as conn:
+            conn.execute(
+                _insert_messages_query(self.table_name, len(messages)),
+                _insert_messages_params(self.session_id, messages)
+            )
+
+    def clear(self) -> None:
+        with self.pool.connection() as conn:
+            conn.execute(_delete_messages_query(self.table_name), {"session_id": self.session_id})
+            conn.execute(DELETE_SUMMARY_QUERY, {"session_id": self.session_id})
+            conn.execute(DELETE_MEMORIES_QUERY, {"session_id": self.session_id})
+            conn.execute(DELETE_ARCHIVE_QUERY, {"session_id": self.session_id})
+
+    def get_stored_page(self, limit: int, before_id: Optional[int] = None) -> List[StoredMessage]:
+        """
+        Fetch up to `limit` messages older than `before_id` (keyset pagination).
+
+        Only the requested window is read, newest first via the
+        (session_id, id) index, and returned in chronological order as
+        StoredMessage rows (no LangChain objects are built).
+
+        Args:
+            limit: Maximum number of messages to return
+            before_id: Return only rows with id < before_id (None for newest)
+
+        Returns:
+            List of StoredMessage rows, oldest first
+        """
+        query = _messages_page_query(self.table_name)
+        params = {"session_id": self.session_id, "before_id": before_id, "limit": limit}
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        return _stored(rows[::-1])
+
+    def get_messages_page(self, limit: int, before_id: Optional[int] = None) -> List[Tuple[int, BaseMessage]]:
+        """Same window as get_stored_page, as (row id, message) tuples"""
+        return _with_ids(self.get_stored_page(limit, before_id))
+
+    def get_recent_messages(self, limit: int) -> List[BaseMessage]:
+        """Get the last `limit` messages without loading the whole session"""
+        return [message for _, message in self.get_messages_page(limit)]
+
+    def get_messages_range(self, after_id: int, before_id: int, limit: int) -> List[Tuple[int, BaseMessage]]:
+        """Get up to `limit` messages with after_id < id < before_id, oldest first"""
+        query = _messages_range_query(self.table_name)
+        params = {"session_id": self.session_id, "after_id": after_id, "before_id": before_id, "limit": limit}
+
+        with self.pool.connection() as conn:
+            rows = conn.execute(query, params).fetchall()
+
+        return _with_ids(_stored(rows))
+
+    def get_summary_state(self) -> Tuple[str, int]:
+        """Get (running summary, id of the last summarized message); ("", 0) if none"""
+        with self.pool.connection() as conn:
+            row = conn.execute(SUMMARY_QUERY, {"session_id": self.session_id}).fetchone()
+        return (row[0], row[1]) if row else ("", 0)
+
+    def get_summary(self) -> str:
+        """Get the running summary of older messages ("" if none yet)"""
+        return self.get_summary_state()[0]
+
+    def save_summary(self, summary: str, through_id: int):
+        """Store the running summary covering messages up to `through_id`"""
+        params = {"session_id": self.session_id, "summary": summary, "through_id": through_id}
+        with self.pool.connection() as conn:
+            conn.execute(SAVE_SUMMARY_QUERY, params)
+
+class AsyncPooledChatMessageHistory:
+    """
+    Async counterpart of PooledChatMessageHistory backed by an async pool.
+
+    Offers the async methods only (aget_messages, aadd_messages, aclear and
+    the windowed readers): a sync call could not use an async pool.
+    """
+
+    def __init__(self, table_name: str, session_id: str, pool: AsyncConnectionPool):
+        self.table_name = table_name
+        self.session_id = session_id
+        self.pool = pool
+
+    async def aget_messages(self) -> List[BaseMessage]:
+        return [row.to_message() for row in await self.aget_stored_messages()]
+
+    async def aget_stored_messages(self) -> List[StoredMessage]:
+        """Async version of PooledChatMessageHistory.get_stored_messages"""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(_messages_query(self.table_name), {"session_id": self.session_id})
+            rows = await cursor.fetchall()
+        return _stored(rows)
+
+    async def aadd_messages(self, messages: Sequence[BaseMessage]) -> None:
+        """Insert messages with one multi-row INSERT in a single transaction"""
+        if not messages:
+            return
+        async with self.pool.connection() as conn:
+            await conn.execute(
+                _insert_messages_query(self.table_name, len(messages)),
+                _insert_messages_params(self.session_id, messages)
+            )
+
+    async def aclear(self) -> None:
+        async with self.pool.connection() as conn:
+            await conn.execute(_delete_messages_query(self.table_name), {"session_id": self.session_id})
+            await conn.execute(DELETE_SUMMARY_QUERY, {"session_id": self.session_id})
+            await conn.execute(DELETE_MEMORIES_QUERY, {"session_id": self.session_id})
+            await conn.execute(DELETE_ARCHIVE_QUERY, {"session_id": self.session_id})
+
+    async def aget_stored_page(self, limit: int, before_id: Optional[int] = None) -> List[StoredMessage]:
+        """Async version of PooledChatMessageHistory.get_stored_page"""
+        query = _messages_page_query(self.table_name)
+        params = {"session_id": self.session_id, "before_id": before_id, "limit": limit}
+
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(query, params)
+            rows = await cursor.fetchall()
+
+        return _stored(rows[::-1])
+
+    async def aget_messages_page(self, limit: int, before_id: Optional[int] = None) -> List[Tuple[int, BaseMessage]]:
+        """Async version of PooledChatMessageHistory.get_messages_page"""
+        return _with_ids(await self.aget_stored_page(limit, before_id))
+
+    async def aget_recent_messages(self, limit: int) -> List[BaseMessage]:
+        """Get the last `limit` messages without loading the whole session"""
+        return [message for _, message in await self.aget_messages_page(limit)]
+
+    async def aget_summary(self) -> str:
+        """Get the running summary of older messages ("" if none yet)"""
+        async with self.pool.connection() as conn:
+            cursor = await conn.execute(SUMMARY_QUERY, {"session_id": self.session_id})
+            row = await cursor.fetchone()
+        return row[0] if row else ""
+
+class _ManagerBase:
+    """
+    Configuration, session ids and the change listener shared by
+    DatabaseManager and AsyncDatabaseManager; each subclass owns its pool.
     """
     
     def __init__(self):
         self.db_url = self._build_db_url()
-        self.engine = create_engine(self.db_url)
-        self._initialize_database()
-        self._create_chat_history_table()
+        self.origin = uuid.uuid4().hex
+        self._listener_thread: Optional[threading.Thread] = None
+        self._listener_stop = threading.Event()
+        self._claims: "OrderedDict[Tuple[str, str], None]" = OrderedDict()
+        self._claims_lock = threading.Lock()
+        # session -> True when known to have no archive, False while a lookup runs
+        self._unarchived: "OrderedDict[str, bool]" = OrderedDict()
+        self._unarchived_lock = threading.Lock()
     
     def _build_db_url(self) -> str:
         user = os.getenv('POSTGRES_USER', 'chatbot_user')
@@ -35,66 +497,524 @@ class DatabaseManager:
         
         return f"postgresql://{user}:{password}@{host}:{port}/{db}"
     
-    def _initialize_database(self):
-        """Initialize database tables if they don't exist"""
-        with self.engine.connect() as conn:
-            conn.execute(text("""
-                CREATE TABLE IF NOT EXISTS chat_history (
-                    id SERIAL PRIMARY KEY,
-                    session_id UUID NOT NULL,
-                    message JSONB NOT NULL,
-                    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
-                );
-            """))
-            conn.commit()
-    
-    def _create_chat_history_table(self):
-        """Create the chat_history table if it doesn't exist"""
-        try:
-            # Create a temporary PostgresChatMessageHistory to initialize the table
-            temp_connection = psycopg.connect(self.db_url)
-            temp_uuid = str(uuid.uuid4())
-            
-            # Creates the table automatically
-            temp_history = PostgresChatMessageHistory(
-                "chat_history",
-                temp_uuid,
-                sync_connection=temp_connection
-            )
-            
-            # Close the temporary connection
-            temp_connection.close()
-            print("Chat history table initialized")
-            
-        except Exception as e:
-            print(f"Error creating chat history table: {e}")
+    def _claimed(self, session_uuid: str, owner: str) -> bool:
+        """Whether this process already claimed the session for `owner`"""
+        with self._claims_lock:
+            if (session_uuid, owner) not in self._claims:
+                return False
+            self._claims.move_to_end((session_uuid, owner))
+            return True
+    
+    def _remember_claim(self, session_uuid: str, owner: str):
+        with self._claims_lock:
+            self._claims[(session_uuid, owner)] = None
+            if len(self._claims) > CLAIM_MEMO_SIZE:
+                self._claims.popitem(last=False)
+    
+    def _known_unarchived(self, session_uuid: str) -> bool:
+        """
+        Whether the session is known to have no archive.
+        
+        Only trusted while the change listener runs, since it forgets
+        sessions archived by other processes; otherwise always False.
+        """
+        with self._unarchived_lock:
+            if self._listener_thread is None:
+                return False
+            if self._unarchived.get(session_uuid):
+                self._unarchived.move_to_end(session_uuid)
+                return True
+            self._unarchived[session_uuid] = False
+            if len(self._unarchived) > ARCHIVE_MEMO_SIZE:
+                self._unarchived.popitem(last=False)
+            return False
+    
+    def _remember_unarchived(self, session_uuid: str):
+        """Record a lookup that found no archive, unless the session changed meanwhile"""
+        with self._unarchived_lock:
+            if session_uuid in self._unarchived:
+                self._unarchived[session_uuid] = True
+    
+    def _forget_unarchived(self, session_uuid: Optional[str]):
+        """Forget one session (it may have been archived), or all when None"""
+        with self._unarchived_lock:
+            if session_uuid is None:
+                self._unarchived.clear()
+            else:
+                self._unarchived.pop(session_uuid, None)
+    
+    def _pool_settings(self) -> Dict[str, Any]:
+        """Pool sizing from environment configuration"""
+        return {
+            "min_size": int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+            "max_size": int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+            "timeout": float(os.getenv('DB_POOL_TIMEOUT', '30')),
+            "max_idle": float(os.getenv('DB_POOL_MAX_IDLE', '600')),
+            "max_lifetime": float(os.getenv('DB_POOL_MAX_LIFETIME', '3600')),
+            "kwargs": {"options": f"-c chatbot.origin={self.origin}"},
+        }
     
     def _ensure_valid_uuid(self, session_id: str) -> str:
-        """Convert session_id to valid UUID format"""
-        try:
-            # Try to parse as UUID
-            uuid.UUID(session_id)
-            return session_id
-        except ValueError:
-            # Create a deterministic UUID from the string
-            namespace = uuid.NAMESPACE_DNS
-            return str(uuid.uuid5(namespace, session_id))
-    
-    def get_chat_history(self, session_id: str) -> PostgresChatMessageHistory:
+        """Convert session_id to valid UUID format (memoized)"""
+        return resolve_session_id(session_id)
+    
+    def start_listener(self, callback: Callable[[Optional[str]], None]):
+        """
+        Deliver chat_history changes made by other processes to `callback`.
+        
+        Runs a daemon thread holding one dedicated LISTEN connection (outside
+        the pool). `callback` receives the changed session UUID, or None after
+        a reconnect, when any session may have changed unnoticed.
+        """
+        if self._listener_thread is not None:
+            return
+        self._listener_thread = threading.Thread(
+            target=self._listen,
+            args=(callback,),
+            name="chat-history-listener",
+            daemon=True
+        )
+        self._listener_thread.start()
+    
+    def _listen(self, callback: Callable[[Optional[str]], None]):
+        reconnecting = False
+        while not self._listener_stop.is_set():
+            try:
+                with psycopg.connect(self.db_url, autocommit=True) as conn:
+                    conn.execute(f"LISTEN {CHANGE_CHANNEL}")
+                    if reconnecting:
+                        self._forget_unarchived(None)
+                        callback(None)
+                    while not self._listener_stop.is_set():
+                        for notify in conn.notifies(timeout=1.0):
+                            session_id, _, origin = notify.payload.partition(" ")
+                            if origin != self.origin:
+                                self._forget_unarchived(session_id)
+                                callback(session_id)
+            except Exception as e:
+                print(f"Warning: chat history listener disconnected: {e}")
+                reconnecting = True
+                self._listener_stop.wait(5)
+    
+    def _stop_listener(self):
+        self._listener_stop.set()
+        if self._listener_thread is not None:
+            # Returns within the listener's 1s poll
+            self._listener_thread.join()
+
+class DatabaseManager(_ManagerBase):
+    """
+    Manages PostgreSQL database connections and chat history operations.
+
+    Key responsibilities:
+    - Own a bounded connection pool shared by history objects
+    - Handle chat history storage/retrieval
+    - Manage session IDs (convert to UUID format) and list each owner's
+      sessions by recency
+    - Full-text search over stored messages
+    - Apply versioned schema migrations (checked once per process)
+
+    Pool sizing is configured through environment variables:
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT (seconds to wait for
+    a free connection), DB_POOL_MAX_IDLE and DB_POOL_MAX_LIFETIME (seconds
+    before idle/old connections are closed and replaced).
+
+    Writes to chat_history raise a Postgres notification; `start_listener`
+    delivers the ones made by other processes to a callback so in-process
+    caches stay coherent.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pool = self._build_pool()
+        migrate(self.pool, self.db_url)
+
+    def _build_pool(self) -> ConnectionPool:
+        """Create the connection pool from environment configuration"""
+        return ConnectionPool(self.db_url, **self._pool_settings(), name="chatbot", open=True)
+
+    def get_chat_history(self, session_id: str) -> PooledChatMessageHistory:
         """Get chat history for a specific session"""
         # Convert to valid UUID
         valid_session_id = self._ensure_valid_uuid(session_id)
-        
-        # Create psycopg connection
-        connection = psycopg.connect(self.db_url)
-        
-        return PostgresChatMessageHistory(
-            "chat_history",  # table_name as first positional argument
-            valid_session_id,      # session_id as UUID
-            sync_connection=connection
+
+        return PooledChatMessageHistory(
+            "chat_history",
+            valid_session_id,
+            self.pool
         )
-    
+
     def clear_history(self, session_id: str):
         """Clear chat history for a specific session"""
         history = self.get_chat_history(session_id)
-        history.clear()
\ No newline at end of file
+        history.clear()
+
+    def create_session(self, owner: str, title: Optional[str] = None) -> str:
+        """
+        Start a new session owned by `owner`.
+
+        Args:
+            owner: User the session is listed under
+            title: Display title (None: the start of the first human message)
+
+        Returns:
+            The new session's UUID
+        """
+        session_id = str(uuid.uuid4())
+        with self.pool.connection() as conn:
+            conn.execute(CREATE_SESSION_QUERY, {"session_id": session_id, "owner": owner, "title": title})
+        return session_id
+    
+    def claim_session(self, session_id: str, owner: str):
+        """
+        List a session under `owner` unless it already has an owner.
+        
+        Lets clients start a conversation under any new session id (no
+        create_session round trip): the session is claimed when its first
+        turn is saved. Sessions written to before they had an owner, such
+        as "default", are claimed the same way. Each (session, owner) is
+        sent to the database once per process.
+        """
+        session_uuid = self._ensure_valid_uuid(session_id)
+        if self._claimed(session_uuid, owner):
+            return
+        with self.pool.connection() as conn:
+            conn.execute(CLAIM_SESSION_QUERY, {"session_id": session_uuid, "owner": owner})
+        self._remember_claim(session_uuid, owner)
+
+    def list_sessions(self, owner: str, limit: int = 20,
+                      cursor: Optional[str] = None) -> Tuple[List[SessionInfo], Optional[str]]:
+        """
+        Get one page of an owner's sessions, most recently active first.
+
+        Reads only the page from the (owner, last_active_at, session_id)
+        index, however many sessions and messages exist.
+
+        Args:
+            owner: User whose sessions to list
+            limit: Maximum number of sessions
+            cursor: Cursor returned by the previous call (None for the first page)
+
+        Returns:
+            Tuple of (sessions, cursor for the next page or None)
+        """
+        with self.pool.connection() as conn:
+            rows = conn.execute(LIST_SESSIONS_QUERY, _list_sessions_params(owner, limit, cursor)).fetchall()
+        return _sessions_page(rows, limit)
+
+    def add_messages_bulk(self, rows: List[Tuple[str, BaseMessage]]):
+        """
+        Store messages of many sessions in one transaction using COPY.
+
+        Rows are written in order, so each session's messages keep their
+        relative order (ids are assigned as rows arrive).
+
+        Args:
+            rows: (session UUID, message) tuples
+        """
+        if not rows:
+            return
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                with cursor.copy("COPY chat_history (session_id, role, content, token_count) FROM STDIN") as copy:
+                    for session_id, message in rows:
+                        copy.write_row((session_id, *_message_columns(message)))
+    
+    def search_messages(self, query: str, session_id: Optional[str] = None, owner: Optional[str] = None,
+                        limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[SearchHit], Optional[str]]:
+        """
+        Full-text search over messages of one session and/or one owner's sessions.
+        
+        Args:
+            query: Web-search style text ("quoted phrases", or, -excluded)
+            session_id: Search only this session
+            owner: Search only sessions of this owner
+            limit: Maximum number of hits
+            cursor: Cursor returned by the previous call (None for the best hits)
+        
+        Returns:
+            Tuple of (hits, best first, cursor for the next page or None)
+        
+        Raises:
+            ValueError: Neither scope given, or an invalid cursor
+        """
+        session_uuid = self._ensure_valid_uuid(session_id) if session_id is not None else None
+        params = _search_params(query, session_uuid, owner, limit, cursor)
+        with self.pool.connection() as conn:
+            rows = conn.execute(_search_query(session_uuid is not None, owner is not None), params,
+                                prepare=False).fetchall()
+        return _search_page(rows, limit)
+
+    def archive_idle_sessions(self, idle_seconds: float, limit: int) -> List[str]:
+        """
+        Move messages of sessions idle for `idle_seconds` to chat_archive.
+
+        Each session's messages become one compressed chat_archive batch and
+        are deleted from chat_history in the same transaction. Summaries and
+        semantic memories stay, so a returning session keeps its context.
+
+        Args:
+            idle_seconds: Archive sessions without writes for this long
+            limit: Maximum number of sessions to archive in this call
+
+        Returns:
+            UUIDs of the archived sessions
+        """
+        archived = []
+        with self.pool.connection() as conn:
+            with conn.transaction():
+                sessions = conn.execute(IDLE_SESSIONS_QUERY, {"idle": idle_seconds, "limit": limit}).fetchall()
+                for (session_id,) in sessions:
+                    rows = conn.execute(ARCHIVE_ROWS_QUERY, {"session_id": session_id}).fetchall()
+                    if not rows:
+                        continue
+                    conn.execute(SAVE_ARCHIVE_QUERY, {
+                        "session_id": session_id, "first_id": rows[0][0], "last_id": rows[-1][0],
+                        "count": len(rows), "data": _pack_archive(rows)
+                    })
+                    conn.execute(
+                        "DELETE FROM chat_history WHERE session_id = %(session_id)s AND id <= %(last_id)s",
+                        {"session_id": session_id, "last_id": rows[-1][0]}
+                    )
+                    archived.append(str(session_id))
+        for session_id in archived:
+            self._forget_unarchived(session_id)
+        return archived
+
+    def restore_session(self, session_id: str) -> int:
+        """
+        Move a session's archived messages back into chat_history.
+
+        Messages keep their original ids, so ordering and the summary
+        cursor stay valid. A session without an archive costs one index
+        lookup the first time, then nothing while the change listener runs.
+        ChatService calls this when a read of a session comes back short;
+        `python -m backend.lifecycle restore` calls it directly.
+
+        Returns:
+            Number of messages restored
+        """
+        session_uuid = self._ensure_valid_uuid(session_id)
+        if self._known_unarchived(session_uuid):
+            return 0
+        restored = 0
+        with self.pool.connection() as conn:
+            with conn.transaction():
+                batches = conn.execute(TAKE_ARCHIVE_QUERY, {"session_id": session_uuid}).fetchall()
+                if batches:
+                    with conn.cursor() as cursor:
+                        with cursor.copy(RESTORE_ROWS_COPY) as copy:
+                            for row in _archived_rows(session_uuid, batches):
+                                copy.write_row(row)
+                                restored += 1
+        self._remember_unarchived(session_uuid)
+        return restored
+
+    def expire_sessions(self, ttl_seconds: float, limit: int) -> List[str]:
+        """
+        Delete sessions idle for `ttl_seconds`: messages, archive, summary and memories.
+
+        Args:
+            ttl_seconds: Expire sessions without writes for this long
+            limit: Maximum number of sessions to expire in this call
+
+        Returns:
+            UUIDs of the expired sessions
+        """
+        with self.pool.connection() as conn:
+            with conn.transaction():
+                session_ids = [row[0] for row in conn.execute(
+                    EXPIRED_SESSIONS_QUERY, {"ttl": ttl_seconds, "limit": limit}
+                ).fetchall()]
+                if session_ids:
+                    for query in EXPIRE_QUERIES:
+                        conn.execute(query, {"session_ids": session_ids})
+        return [str(session_id) for session_id in session_ids]
+
+    def add_memories(self, rows: List[Tuple[str, str, str, bytes]]):
+        """
+        Store embedded messages for semantic recall in one batch.
+
+        Args:
+            rows: (session UUID, role, content, float32 embedding bytes) tuples
+        """
+        with self.pool.connection() as conn:
+            with conn.cursor() as cursor:
+                cursor.executemany(
+                    "INSERT INTO chat_memories (session_id, role, content, embedding) "
+                    "VALUES (%s, %s, %s, %s)",
+                    rows
+                )
+
+    def get_memories(self, session_id: str) -> List[Tuple[str, str, bytes]]:
+        """Get (role, content, embedding bytes) for every memory of a session UUID"""
+        with self.pool.connection() as conn:
+            return conn.execute(
+                "SELECT role, content, embedding FROM chat_memories "
+                "WHERE session_id = %(session_id)s ORDER BY id",
+                {"session_id": session_id}
+            ).fetchall()
+
+    def get_cached_response(self, cache_key: str, max_age: float) -> Optional[str]:
+        """Get a cached LLM response stored less than `max_age` seconds ago"""
+        with self.pool.connection() as conn:
+            row = conn.execute(
+                "SELECT response FROM llm_response_cache WHERE cache_key = %(key)s "
+                "AND created_at > NOW() - make_interval(secs => %(max_age)s)",
+                {"key": cache_key, "max_age": max_age}
+            ).fetchone()
+        return row[0] if row else None
+
+    def save_cached_response(self, cache_key: str, response: str):
+        """Store (or refresh) a cached LLM response"""
+        with self.pool.connection() as conn:
+            conn.execute(
+                "INSERT INTO llm_response_cache (cache_key, response) VALUES (%(key)s, %(response)s) "
+                "ON CONFLICT (cache_key) DO UPDATE SET response = EXCLUDED.response, created_at = NOW()",
+                {"key": cache_key, "response": response}
+            )
+
+    def check_connection(self) -> bool:
+        """Return True if a pooled connection can run a trivial query"""
+        try:
+            with self.pool.connection() as conn:
+                conn.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    def get_pool_stats(self) -> Dict[str, Any]:
+        """
+        Get connection pool statistics for sizing.
+
+        Returns:
+            Dict with in_use, available, waiting, created and recycled counts
+            plus the configured min/max size. "recycled" counts connections
+            that were opened and later retired (idle, lifetime or broken).
+        """
+        stats = self.pool.get_stats()
+        size = stats.get('pool_size', 0)
+        available = stats.get('pool_available', 0)
+        created = stats.get('connections_num', 0)
+        return {
+            "min_size": stats.get('pool_min', self.pool.min_size),
+            "max_size": stats.get('pool_max', self.pool.max_size),
+            "size": size,
+            "in_use": size - available,
+            "available": available,
+            "waiting": stats.get('requests_waiting', 0),
+            "created": created,
+            "recycled": max(created - size, 0),
+            "wait_ms": stats.get('requests_wait_ms', 0),
+            "timeouts": stats.get('requests_errors', 0),
+        }
+
+    def close(self):
+        """Close the listener and all pooled connections"""
+        self._stop_listener()
+        self.pool.close()
+
+class AsyncDatabaseManager(_ManagerBase):
+    """
+    Async variant of DatabaseManager built on psycopg's AsyncConnectionPool.
+
+    Uses the same configuration and schema as the sync manager. The pool is
+    opened and the schema initialized by `await open()`, so construction
+    itself does no I/O and can happen outside an event loop. Covers what a
+    chat turn needs (history, restoring archived sessions, sessions,
+    search); bulk writes, memories, the response cache and lifecycle jobs
+    run on the sync manager.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.pool = self._build_pool()
+
+    def _build_pool(self) -> AsyncConnectionPool:
+        """Create the async connection pool from environment configuration"""
+        return AsyncConnectionPool(self.db_url, **self._pool_settings(), name="chatbot-async", open=False)
+
+    async def open(self):
+        """Open the pool and apply pending schema migrations"""
+        await self.pool.open()
+        await amigrate(self.pool, self.db_url)
+
+    def get_chat_history(self, session_id: str) -> AsyncPooledChatMessageHistory:
+        """Get async chat history for a specific session"""
+        return AsyncPooledChatMessageHistory(
+            "chat_history",
+            self._ensure_valid_uuid(session_id),
+            self.pool
+        )
+
+    async def clear_history(self, session_id: str):
+        """Clear chat history for a specific session"""
+        await self.get_chat_history(session_id).aclear()
+    
+    async def restore_session(self, session_id: str) -> int:
+        """Async version of DatabaseManager.restore_session"""
+        session_uuid = self._ensure_valid_uuid(session_id)
+        if self._known_unarchived(session_uuid):
+            return 0
+        restored = 0
+        async with self.pool.connection() as conn:
+            async with conn.transaction():
+                result = await conn.execute(TAKE_ARCHIVE_QUERY, {"session_id": session_uuid})
+                batches = await result.fetchall()
+                if batches:
+                    async with conn.cursor() as cursor:
+                        async with cursor.copy(RESTORE_ROWS_COPY) as copy:
+                            for row in _archived_rows(session_uuid, batches):
+                                await copy.write_row(row)
+                                restored += 1
+        self._remember_unarchived(session_uuid)
+        return restored
+
+    async def create_session(self, owner: str, title: Optional[str] = None) -> str:
+        """Async version of DatabaseManager.create_session"""
+        session_id = str(uuid.uuid4())
+        async with self.pool.connection() as conn:
+            await conn.execute(CREATE_SESSION_QUERY, {"session_id": session_id, "owner": owner, "title": title})
+        return session_id
+
+    async def claim_session(self, session_id: str, owner: str):
+        """Async version of DatabaseManager.claim_session"""
+        session_uuid = self._ensure_valid_uuid(session_id)
+        if self._claimed(session_uuid, owner):
+            return
+        async with self.pool.connection() as conn:
+            await conn.execute(CLAIM_SESSION_QUERY, {"session_id": session_uuid, "owner": owner})
+        self._remember_claim(session_uuid, owner)
+    
+    async def list_sessions(self, owner: str, limit: int = 20,
+                            cursor: Optional[str] = None) -> Tuple[List[SessionInfo], Optional[str]]:
+        """Async version of DatabaseManager.list_sessions"""
+        async with self.pool.connection() as conn:
+            result = await conn.execute(LIST_SESSIONS_QUERY, _list_sessions_params(owner, limit, cursor))
+            rows = await result.fetchall()
+        return _sessions_page(rows, limit)
+
+    async def search_messages(self, query: str, session_id: Optional[str] = None, owner: Optional[str] = None,
+                              limit: int = 20, cursor: Optional[str] = None) -> Tuple[List[SearchHit], Optional[str]]:
+        """Async version of DatabaseManager.search_messages"""
+        session_uuid = self._ensure_valid_uuid(session_id) if session_id is not None else None
+        params = _search_params(query, session_uuid, owner, limit, cursor)
+        async with self.pool.connection() as conn:
+            result = await conn.execute(_search_query(session_uuid is not None, owner is not None), params,
+                                        prepare=False)
+            rows = await result.fetchall()
+        return _search_page(rows, limit)
+    
+    async def check_connection(self) -> bool:
+        """Return True if a pooled connection can run a trivial query"""
+        try:
+            async with self.pool.connection() as conn:
+                await conn.execute("SELECT 1")
+            return True
+        except Exception:
+            return False
+
+    async def close(self):
+        """Close the listener and all pooled connections"""
+        await asyncio.to_thread(self._stop_listener)
+        await self.pool.close()
\ No newline at end of file
@@ -0,0 +1,227 @@
+import os
+import time
+import threading
+from typing import Any, Callable, Dict, List, NamedTuple, Optional
+
+# Per-request option names and the Ollama option each maps to; Ollama's own
+# names are accepted as well
+OLLAMA_OPTIONS = {
+    "max_tokens": "num_predict",
+    "context_tokens": "num_ctx",
+    "temperature": "temperature",
+    "top_p": "top_p",
+    "top_k": "top_k",
+    "repeat_penalty": "repeat_penalty",
+    "seed": "seed",
+    "stop": "stop",
+}
+
+_OPTION_TYPES = {
+    "num_predict": int,
+    "num_ctx": int,
+    "temperature": float,
+    "top_p": float,
+    "top_k": int,
+    "repeat_penalty": float,
+    "seed": int,
+    "stop": list,
+}
+
+def ollama_options(options: Dict[str, Any]) -> Dict[str, Any]:
+    """
+    Translate generation options into Ollama's `options` object.
+    
+    Raises:
+        ValueError: Unknown option, or a value of the wrong type
+    """
+    translated = {}
+    for name, value in options.items():
+        ollama_name = OLLAMA_OPTIONS.get(name, name)
+        expected = _OPTION_TYPES.get(ollama_name)
+        if expected is None:
+            raise ValueError(f"Unknown generation option: {name!r}")
+        if expected is list:
+            value = [value] if isinstance(value, str) else value
+            if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+                raise ValueError(f"Option {name!r} must be a string or a list of strings")
+        elif isinstance(value, bool) or not isinstance(value, (int, float)) or (expected is int and value != int(value)):
+            raise ValueError(f"Option {name!r} must be a number" if expected is float else
+                             f"Option {name!r} must be an integer")
+        else:
+            value = expected(value)
+        translated[ollama_name] = value
+    return translated
+
+class LatencyProfile(NamedTuple):
+    """Per-deployment latency target and the generation caps that serve it"""
+    name: str
+    target_seconds: float
+    max_predict: int
+    max_ctx: int
+
+LATENCY_PROFILES = {
+    "realtime": LatencyProfile("realtime", 3.0, 128, 2048),
+    "interactive": LatencyProfile("interactive", 10.0, 512, 4096),
+    "batch": LatencyProfile("batch", 60.0, 2048, 8192),
+}
+
+# Reply length floor, however slow generation gets
+MIN_PREDICT = 32
+
+class AdaptiveLimits:
+    """
+    Caps num_predict and num_ctx so a generation fits a latency profile.
+    
+    Key responsibilities:
+    - Fix num_ctx at the profile's size (Ollama reloads the model whenever
+      num_ctx changes, so it is never adapted per request)
+    - Track prefill seconds and decode tokens/sec (moving averages of what
+      Ollama reports) and cap num_predict at the tokens that still fit in
+      the target after prefill
+    - Round the cap down to a power of two, so it (and the response cache
+      key it is part of) only changes when speed changes materially
+    
+    Configured with LLM_LATENCY_PROFILE (realtime, interactive or batch;
+    unset means no caps) and LLM_LATENCY_TARGET to override its target
+    seconds. Requests may still ask for less than the caps.
+    """
+    
+    def __init__(self, profile: Optional[LatencyProfile] = None, smoothing: float = 0.2):
+        self.profile = profile
+        self.smoothing = smoothing
+        self.prefill_seconds: Optional[float] = None
+        self.decode_rate: Optional[float] = None
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def from_env(cls) -> "AdaptiveLimits":
+        name = os.getenv('LLM_LATENCY_PROFILE')
+        if not name:
+            return cls()
+        if name not in LATENCY_PROFILES:
+            print(f"Warning: Unknown LLM_LATENCY_PROFILE {name!r}, expected one of {sorted(LATENCY_PROFILES)}")
+            return cls()
+        profile = LATENCY_PROFILES[name]
+        if os.getenv('LLM_LATENCY_TARGET'):
+            profile = profile._replace(target_seconds=float(os.getenv('LLM_LATENCY_TARGET')))
+        return cls(profile)
+    
+    def _average(self, current: Optional[float], value: float) -> float:
+        return value if current is None else current + self.smoothing * (value - current)
+    
+    def observe(self, result: Dict[str, Any]):
+        """Update the speed estimates from a final Ollama response (durations in ns)"""
+        if self.profile is None:
+            return
+        with self._lock:
+            if result.get('prompt_eval_duration') is not None:
+                prefill = (result['prompt_eval_duration'] + result.get('load_duration', 0)) / 1e9
+                self.prefill_seconds = self._average(self.prefill_seconds, prefill)
+            if result.get('eval_count') and result.get('eval_duration'):
+                rate = result['eval_count'] / (result['eval_duration'] / 1e9)
+                self.decode_rate = self._average(self.decode_rate, rate)
+    
+    def predict_cap(self) -> Optional[int]:
+        """Largest num_predict expected to finish within the target (None without a profile)"""
+        if self.profile is None:
+            return None
+        with self._lock:
+            prefill, rate = self.prefill_seconds, self.decode_rate
+        if rate is None:
+            return self.profile.max_predict
+        fits = int((self.profile.target_seconds - (prefill or 0.0)) * rate)
+        tokens = max(MIN_PREDICT, min(self.profile.max_predict, fits))
+        return 1 << (tokens.bit_length() - 1)
+    
+    def apply(self, options: Dict[str, Any]) -> Dict[str, Any]:
+        """Options with num_predict and num_ctx capped for the profile"""
+        if self.profile is None:
+            return options
+        capped = dict(options)
+        cap = self.predict_cap()
+        requested = capped.get("num_predict")
+        if requested is None or requested < 0 or requested > cap:
+            capped["num_predict"] = cap
+        capped["num_ctx"] = min(capped.get("num_ctx", self.profile.max_ctx), self.profile.max_ctx)
+        return capped
+    
+    def get_stats(self) -> Dict[str, Any]:
+        """Get the profile, current speed estimates and the num_predict cap they give"""
+        if self.profile is None:
+            return {}
+        with self._lock:
+            stats = {"prefill_seconds": self.prefill_seconds, "decode_rate": self.decode_rate}
+        return {"profile": self.profile.name, "target_seconds": self.profile.target_seconds,
+                "num_predict": self.predict_cap(), "num_ctx": self.profile.max_ctx, **stats}
+
+class FailedGeneration(str):
+    """
+    Error message OllamaLLM returns (or yields) in place of generated text.
+    
+    Still a str, so it can be shown as the reply, but typed so callers can
+    tell a failed or shed generation from an answer (e.g. to not save it).
+    """
+    
+    __slots__ = ()
+
+class Cancellation:
+    """
+    Cooperative cancellation of one generation, from any thread.
+    
+    Key responsibilities:
+    - Cancel on request (e.g. the client went away) or once an optional
+      deadline passes
+    - Run callbacks registered by the request in flight on cancel(), so a
+      stream blocked on a read is aborted at once
+    - Report the time left, to bound queue waits and read timeouts
+    """
+    
+    def __init__(self, timeout: Optional[float] = None):
+        self.deadline = time.monotonic() + timeout if timeout is not None else None
+        self.reason: Optional[str] = None
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+    
+    @property
+    def cancelled(self) -> bool:
+        if self.reason is None and self.deadline is not None and time.monotonic() >= self.deadline:
+            self.reason = "deadline exceeded"
+        return self.reason is not None
+    
+    def remaining(self) -> Optional[float]:
+        """Seconds until the deadline (None without one, 0 once passed)"""
+        if self.deadline is None:
+            return None
+        return max(0.0, self.deadline - time.monotonic())
+    
+    def cancel(self, reason: str = "cancelled"):
+        """Cancel and run the registered callbacks (only the first call has an effect)"""
+        with self._lock:
+            if self.reason is not None:
+                return
+            self.reason = reason
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"Warning: Cancellation callback failed: {e}")
+    
+    def on_cancel(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Run `callback` on cancel() (at once if already cancelled).
+        
+        Returns:
+            Function that unregisters the callback
+        """
+        with self._lock:
+            if self.reason is None:
+                self._callbacks.append(callback)
+                return lambda: self._unregister(callback)
+        callback()
+        return lambda: None
+    
+    def _unregister(self, callback: Callable[[], None]):
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
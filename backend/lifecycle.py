@@ -0,0 +1,119 @@
+import os
+import sys
+import threading
+from typing import Callable, Dict, List, Optional
+
+DAY_SECONDS = 86400.0
+
+def _days(name: str) -> Optional[float]:
+    value = os.getenv(name)
+    return float(value) * DAY_SECONDS if value else None
+
+class SessionLifecycle:
+    """
+    Background archival and expiry of idle chat sessions.
+    
+    Key responsibilities:
+    - Move messages of sessions idle for CHAT_ARCHIVE_AFTER_DAYS into
+      compressed cold storage (chat_archive), out of the hot partitions
+    - Delete sessions idle for CHAT_SESSION_TTL_DAYS entirely
+    - Work in batches of CHAT_LIFECYCLE_BATCH sessions, one transaction
+      each, every CHAT_LIFECYCLE_INTERVAL seconds
+    
+    Archived sessions are restored by ChatService when they are read
+    again. Both jobs are off unless their variable is set. Several processes may
+    run them at once: sessions are claimed with SKIP LOCKED. `db_manager`
+    must provide archive_idle_sessions() and expire_sessions(); `on_change`
+    receives each session UUID that was archived or expired.
+    """
+    
+    def __init__(self, db_manager, on_change: Optional[Callable[[str], None]] = None):
+        self.db_manager = db_manager
+        self.on_change = on_change
+        self.archive_after = _days('CHAT_ARCHIVE_AFTER_DAYS')
+        self.ttl = _days('CHAT_SESSION_TTL_DAYS')
+        self.batch_size = int(os.getenv('CHAT_LIFECYCLE_BATCH', '100'))
+        self.interval = float(os.getenv('CHAT_LIFECYCLE_INTERVAL', '3600'))
+        self._stop = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+    
+    @property
+    def enabled(self) -> bool:
+        return self.archive_after is not None or self.ttl is not None
+    
+    def _drain(self, job: Callable[[float, int], List[str]], age: float) -> int:
+        """Run a job batch after batch until a short batch (or stop)"""
+        total = 0
+        while not self._stop.is_set():
+            session_ids = job(age, self.batch_size)
+            total += len(session_ids)
+            if self.on_change is not None:
+                for session_id in session_ids:
+                    self.on_change(session_id)
+            if len(session_ids) < self.batch_size:
+                break
+        return total
+    
+    def run_once(self) -> Dict[str, int]:
+        """
+        Expire, then archive, every eligible session.
+        
+        Returns:
+            Dict with the number of sessions "expired" and "archived"
+        """
+        counts = {"expired": 0, "archived": 0}
+        if self.ttl is not None:
+            counts["expired"] = self._drain(self.db_manager.expire_sessions, self.ttl)
+        if self.archive_after is not None:
+            counts["archived"] = self._drain(self.db_manager.archive_idle_sessions, self.archive_after)
+        return counts
+    
+    def start(self):
+        """Run the jobs every CHAT_LIFECYCLE_INTERVAL seconds in a daemon thread (if enabled)"""
+        if self._worker is not None or not self.enabled:
+            return
+        self._worker = threading.Thread(target=self._run, name="session-lifecycle", daemon=True)
+        self._worker.start()
+    
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            try:
+                self.run_once()
+            except Exception as e:
+                print(f"Warning: Session lifecycle run failed: {e}")
+    
+    def stop(self):
+        """Stop the worker after its current batch and wait for it"""
+        self._stop.set()
+        if self._worker is not None and self._worker is not threading.current_thread():
+            self._worker.join()
+
+def main(argv=None):
+    """`python -m backend.lifecycle run` or `python -m backend.lifecycle restore <session_id>`"""
+    import argparse
+    from .database import DatabaseManager
+    
+    parser = argparse.ArgumentParser(description="Archive, expire or restore chat sessions")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("run", help="Run archival and expiry once with the CHAT_* settings")
+    restore = commands.add_parser("restore", help="Move a session's archived messages back")
+    restore.add_argument("session_id")
+    args = parser.parse_args(argv)
+    
+    db_manager = DatabaseManager()
+    try:
+        if args.command == "restore":
+            print(f"Restored {db_manager.restore_session(args.session_id)} messages")
+            return 0
+        lifecycle = SessionLifecycle(db_manager)
+        if not lifecycle.enabled:
+            print("Nothing to do: set CHAT_ARCHIVE_AFTER_DAYS and/or CHAT_SESSION_TTL_DAYS")
+            return 1
+        counts = lifecycle.run_once()
+        print(f"Expired {counts['expired']} sessions, archived {counts['archived']} sessions")
+        return 0
+    finally:
+        db_manager.close()
+
+if __name__ == "__main__":
+    sys.exit(main())
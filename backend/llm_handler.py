@@ -1,11 +1,249 @@
 import os
+import json
+import time
+import socket
+import threading
+import httpx
 import requests
-from typing import Dict, Any
+from collections import defaultdict, deque
+from typing import Dict, Any, AsyncIterator, Deque, Iterator, List, Optional
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
+from langchain_core.messages import HumanMessage
+from .context_builder import ContextWindow, estimate_tokens
+from .generation import AdaptiveLimits, Cancellation, FailedGeneration, ollama_options
+from .load_balancer import BackendPool, OllamaBackend
+from .metrics import PipelineMetrics
+from .response_cache import ResponseCache, ResponseKey
+from .scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, LLMBusyError, LLMScheduler
 
 load_dotenv()
 
-class OllamaLLM:
+SYSTEM_PROMPT = (
+   "You are a helpful AI assistant. "
+   "Use information from our previous conversation when relevant."
+)
+
+def _response_text(result: Dict[str, Any]) -> str:
+   """Generated text of an /api/generate or /api/chat response or stream chunk"""
+   return result.get('response') or result.get('message', {}).get('content', '')
+
+def _abort(response: requests.Response):
+   """Shut a streaming response's socket down so a read blocked in another thread returns at once"""
+   sock = getattr(getattr(response.raw, 'connection', None), 'sock', None)
+   if sock is not None:
+       try:
+           sock.shutdown(socket.SHUT_RDWR)
+       except OSError:
+           pass
+
+def _cancelled(cancel: Cancellation) -> FailedGeneration:
+   return FailedGeneration(f"Error: LLM request {cancel.reason}")
+
+class _OllamaBase:
+   """
+   Configuration, prompt layout, request payloads and usage accounting
+   shared by OllamaLLM and AsyncOllamaLLM; each subclass owns its transport.
+   """
+
+   def __init__(self, metrics: Optional[PipelineMetrics], default_max_connections: int):
+       self.backends = BackendPool.from_env()
+       self.base_url = self.backends.backends[0].url
+       self.model_name = os.getenv('MODEL_NAME', 'llama2:7b-chat')
+       self.metrics = metrics or PipelineMetrics()
+       self._load_http_config(default_max_connections)
+       self._load_generation_config()
+       self.response_cache = ResponseCache()
+
+   def _load_http_config(self, default_max_connections: int):
+       """Read connection pool, timeout, retry and model keep-alive settings"""
+       self.max_connections = int(os.getenv('OLLAMA_MAX_CONNECTIONS', str(default_max_connections)))
+       self.connect_timeout = float(os.getenv('OLLAMA_CONNECT_TIMEOUT', '5'))
+       self.read_timeout = float(os.getenv('OLLAMA_READ_TIMEOUT', '30'))
+       self.max_retries = int(os.getenv('OLLAMA_MAX_RETRIES', '2'))
+       self.backoff_factor = float(os.getenv('OLLAMA_BACKOFF_FACTOR', '0.5'))
+       self.latencies: Dict[str, Deque[float]] = defaultdict(lambda: deque(maxlen=1000))
+       # How long Ollama keeps the model (and its prompt cache) loaded after a request
+       self.keep_alive = os.getenv('OLLAMA_KEEP_ALIVE', '30m')
+       self.prefill: Dict[str, float] = dict.fromkeys(
+           ("requests", "prompt_tokens", "evaluated_tokens", "eval_seconds", "reused_tokens", "saved_seconds"), 0
+       )
+       self._prefill_lock = threading.Lock()
+   
+   def _load_generation_config(self):
+       """Read default generation options and the latency profile"""
+       defaults = {
+           "temperature": float(os.getenv('LLM_TEMPERATURE', '0.7')),
+           "max_tokens": int(os.getenv('LLM_MAX_TOKENS', '500')),
+       }
+       if os.getenv('LLM_CONTEXT_TOKENS'):
+           defaults["context_tokens"] = int(os.getenv('LLM_CONTEXT_TOKENS'))
+       self.default_options = ollama_options(defaults)
+       self.limits = AdaptiveLimits.from_env()
+
+   @property
+   def timeout(self):
+       """(connect, read) timeout tuple for requests"""
+       return (self.connect_timeout, self.read_timeout)
+   
+   def _request_timeout(self, cancel: Optional[Cancellation]):
+       """(connect, read) timeouts, shortened to a cancellation's deadline"""
+       remaining = cancel.remaining() if cancel is not None else None
+       if remaining is None:
+           return self.timeout
+       # Zero is not a valid timeout; callers check `cancelled` first
+       remaining = max(remaining, 0.001)
+       return (min(self.connect_timeout, remaining), min(self.read_timeout, remaining))
+
+   def _record_latency(self, endpoint: str, started: float):
+       self.latencies[endpoint].append(time.perf_counter() - started)
+
+   def get_latency_stats(self) -> Dict[str, Dict[str, float]]:
+       """
+       Get latency statistics for recent requests per endpoint.
+
+       Returns:
+           Dict mapping endpoint to count, avg, p50, p95 and max in seconds
+       """
+       stats = {}
+       for endpoint, samples in self.latencies.items():
+           ordered = sorted(samples)
+           if not ordered:
+               continue
+           stats[endpoint] = {
+               "count": len(ordered),
+               "avg": sum(ordered) / len(ordered),
+               "p50": ordered[int(0.50 * (len(ordered) - 1))],
+               "p95": ordered[int(0.95 * (len(ordered) - 1))],
+               "max": ordered[-1],
+           }
+       return stats
+
+   def _format_prompt(self, prompt: str, context: str, summary: str = "") -> str:
+       """
+       Format a /api/generate prompt with conversation context and running summary.
+       
+       The layout is append-only (system text, summary, earlier turns, then
+       the new message), so consecutive turns of a conversation share a prefix.
+       """
+       parts = [SYSTEM_PROMPT, "\n\n"]
+       if summary:
+           # Older turns are only available in summarized form; put them first
+           parts.append(f"Summary of our earlier conversation: {summary}\n\n")
+       if context and len(context.strip()) > 0:
+           parts.append(context)
+       parts.append(f"Human: {prompt}\nAssistant:")
+       return "".join(parts)
+
+   def _options(self, requested: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+       """
+       Ollama options of a request: the defaults, overridden by `requested`
+       (see ollama_options), then capped by the latency profile.
+       """
+       options = dict(self.default_options)
+       if requested:
+           options.update(ollama_options(requested))
+       return self.limits.apply(options)
+
+   def _build_payload(self, prompt: str, context: str, stream: bool, summary: str = "",
+                      options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+       """Build the /api/generate request body"""
+       return {
+           "model": self.model_name,
+           "prompt": self._format_prompt(prompt, context, summary),
+           "stream": stream,
+           "keep_alive": self.keep_alive,
+           "options": self._options(options),
+       }
+   
+   def _build_chat_messages(self, prompt: str, window: ContextWindow) -> List[Dict[str, str]]:
+       """
+       Lay out a turn for /api/chat with a byte-stable prefix.
+       
+       The system message (carrying the running summary) and earlier turns
+       render identically from one turn to the next, so Ollama can reuse their
+       KV cache; per-turn material (recalled memories) rides on the new user
+       message at the end.
+       """
+       system = SYSTEM_PROMPT
+       if window.summary:
+           system += f"\n\nSummary of our earlier conversation: {window.summary}"
+       messages = [{"role": "system", "content": system}]
+       for message in window.messages:
+           role = "user" if isinstance(message, HumanMessage) else "assistant"
+           messages.append({"role": role, "content": str(message.content)})
+       
+       content = prompt
+       if window.memory_text:
+           content = f"Relevant earlier messages:\n{window.memory_text}\n{prompt}"
+       messages.append({"role": "user", "content": content})
+       return messages
+   
+   def _build_chat_payload(self, prompt: str, window: ContextWindow, stream: bool,
+                           options: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+       """Build the /api/chat request body"""
+       return {
+           "model": self.model_name,
+           "messages": self._build_chat_messages(prompt, window),
+           "stream": stream,
+           "keep_alive": self.keep_alive,
+           "options": self._options(options),
+       }
+
+   def _cache_key(self, prompt: str, context: str, summary: str, payload: Dict[str, Any]) -> ResponseKey:
+       """Response cache key: model, normalized prompt, context and options"""
+       return self.response_cache.make_key(
+           payload["model"], prompt, f"{summary}\x00{context}", payload["options"]
+       )
+   
+   def _record_prefill(self, payload: Dict[str, Any], result: Dict[str, Any]):
+       """
+       Account prefill work from a final response's prompt_eval_* fields.
+       
+       Ollama only counts prompt tokens it had to evaluate, so the gap to the
+       estimated prompt size is the prefix served from its KV cache. Time
+       saved is that gap at the request's own per-token prefill rate.
+       """
+       evaluated = result.get('prompt_eval_count')
+       if evaluated is None:
+           return
+       seconds = result.get('prompt_eval_duration', 0) / 1e9
+       if "messages" in payload:
+           # +4 covers the chat template's role markers
+           prompt_tokens = sum(estimate_tokens(message["content"]) + 4 for message in payload["messages"])
+       else:
+           prompt_tokens = estimate_tokens(payload["prompt"])
+       reused = max(prompt_tokens - evaluated, 0)
+       
+       with self._prefill_lock:
+           self.prefill["requests"] += 1
+           self.prefill["prompt_tokens"] += prompt_tokens
+           self.prefill["evaluated_tokens"] += evaluated
+           self.prefill["eval_seconds"] += seconds
+           self.prefill["reused_tokens"] += reused
+           if evaluated:
+               self.prefill["saved_seconds"] += reused * seconds / evaluated
+   
+   def _record_usage(self, payload: Dict[str, Any], result: Dict[str, Any]):
+       """Account prefill and generation speed of a final response"""
+       self._record_prefill(payload, result)
+       self.metrics.observe_generation(payload["model"], result)
+       self.limits.observe(result)
+   
+   def get_prefill_stats(self) -> Dict[str, float]:
+       """
+       Get cumulative prefill statistics.
+       
+       Returns:
+           Dict with requests, prompt_tokens (estimated), evaluated_tokens and
+           eval_seconds (as reported by Ollama), reused_tokens and
+           saved_seconds (estimated prefix cache savings)
+       """
+       with self._prefill_lock:
+           return dict(self.prefill)
+
+class OllamaLLM(_OllamaBase):
    """
    Handles communication with Ollama LLM API.
    
@@ -14,75 +252,625 @@ class OllamaLLM:
    - Prompt formatting and context management
    - Error handling and timeout management
    - Configurable model parameters
+   - Pooled keep-alive HTTP session with bounded, jittered retries
+   - Per-endpoint request latency metrics
+   - Response cache for repeated prompts (see ResponseCache), bypassed per
+     request with use_cache=False
+   - Bounded, fair LLM concurrency with coalescing of identical in-flight
+     prompts (see LLMScheduler); failed or shed requests return an error
+     message typed as FailedGeneration
+   - Routing across several Ollama endpoints with health checks and
+     optional session affinity (see BackendPool)
+   - Prompt formatting, queue wait, generation, time-to-first-token and
+     tokens/sec recorded in PipelineMetrics
+   - Per-request generation options translated to Ollama's (see
+     ollama_options), capped by a latency profile (see AdaptiveLimits)
+   - Cooperative cancellation (see Cancellation): cancel() aborts a stream
+     mid-read, and a deadline bounds the queue wait and every read;
+     cancellable requests are sent without transport retries
+   
+   HTTP behaviour is configured through environment variables:
+   OLLAMA_MAX_CONNECTIONS (keep-alive pool size), OLLAMA_CONNECT_TIMEOUT and
+   OLLAMA_READ_TIMEOUT (seconds), OLLAMA_MAX_RETRIES and
+   OLLAMA_BACKOFF_FACTOR (retries on 5xx responses).
+   OLLAMA_BASE_URLS lists several endpoints; with more than one, each is
+   re-checked every OLLAMA_HEALTH_INTERVAL seconds in the background.
+   OLLAMA_KEEP_ALIVE sets how long the model stays loaded between requests.
+   LLM_TEMPERATURE, LLM_MAX_TOKENS (num_predict) and LLM_CONTEXT_TOKENS
+   (num_ctx) are the default generation options.
+   
+   Conversations go through /api/chat (chat_response, stream_chat) with the
+   system prompt and earlier turns as a stable prefix, so Ollama can reuse
+   the KV cache of the previous turn instead of re-evaluating the history;
+   get_prefill_stats() reports the prefill work measured by Ollama.
    """
    
-   def __init__(self):
-       self.base_url = os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
-       self.model_name = os.getenv('MODEL_NAME', 'llama2:7b-chat')
-       self._check_ollama_connection()
+   def __init__(self, metrics: Optional[PipelineMetrics] = None):
+       super().__init__(metrics, default_max_connections=10)
+       self.scheduler = LLMScheduler()
+       self.session = self._build_session()
+       # Requests with a Cancellation are sent once: retry backoff would
+       # run past the caller's deadline and can't be interrupted by cancel()
+       self.cancellable_session = self._build_session(retries=0)
+       # Probing can take up to the connect timeout per endpoint; don't make
+       # construction wait for it (endpoints count as healthy until checked)
+       threading.Thread(target=self._check_ollama_connection, name="ollama-check", daemon=True).start()
    
-   def _check_ollama_connection(self):
-       """Check if Ollama is running and model is available"""
+   def _build_session(self, retries: Optional[int] = None) -> requests.Session:
+       """Create a keep-alive session with a bounded retry policy (default: OLLAMA_MAX_RETRIES)"""
+       # Refused connections fail fast (Ollama is down) and 5xx responses
+       # retry. Nothing is resent once it may have reached Ollama: a read
+       # timeout or reset on a generation would start the same work again.
+       retry = Retry(
+           total=self.max_retries if retries is None else retries,
+           connect=0,
+           read=0,
+           backoff_factor=self.backoff_factor,
+           backoff_jitter=self.backoff_factor,
+           status_forcelist=[500, 502, 503, 504],
+           allowed_methods=frozenset(["GET", "POST"]),
+           raise_on_status=False
+       )
+       adapter = HTTPAdapter(
+           pool_connections=len(self.backends.backends),
+           pool_maxsize=self.max_connections,
+           max_retries=retry
+       )
+       session = requests.Session()
+       session.mount("http://", adapter)
+       session.mount("https://", adapter)
+       return session
+   
+   def _session_for(self, cancel: Optional[Cancellation]) -> requests.Session:
+       """Session to send a generation with: no transport retries when it is cancellable"""
+       return self.session if cancel is None else self.cancellable_session
+   
+   def _queue_timeout(self, cancel: Optional[Cancellation]) -> Optional[float]:
+       """Seconds to wait for a scheduler slot (None: LLM_QUEUE_TIMEOUT)"""
+       remaining = cancel.remaining() if cancel is not None else None
+       return None if remaining is None else min(remaining, self.scheduler.queue_timeout)
+   
+   def _check_backend(self, backend: OllamaBackend, verbose: bool = False) -> bool:
+       """Check an endpoint is running and serves the model"""
        try:
-           response = requests.get(f"{self.base_url}/api/tags")
+           started = time.perf_counter()
+           response = self.session.get(f"{backend.url}/api/tags", timeout=self.timeout)
+           self._record_latency("/api/tags", started)
            if response.status_code == 200:
                models = [model['name'] for model in response.json().get('models', [])]
                if self.model_name not in models:
-                   print(f"Warning: Model {self.model_name} not found. Available models: {models}")
-               else:
-                   print(f"Ollama connected successfully. Using model: {self.model_name}")
-           else:
-               print("Warning: Could not connect to Ollama")
+                   if verbose:
+                       print(f"Warning: Model {self.model_name} not found at {backend.url}. "
+                             f"Available models: {models}")
+                   return False
+               if verbose:
+                   print(f"Ollama connected successfully ({backend.url}). Using model: {self.model_name}")
+               return True
+           if verbose:
+               print(f"Warning: Could not connect to Ollama at {backend.url}")
        except Exception as e:
-           print(f"Warning: Ollama connection check failed: {e}")
+           if verbose:
+               print(f"Warning: Ollama connection check failed ({backend.url}): {e}")
+       return False
    
-   def _format_prompt(self, prompt: str, context: str) -> str:
-       """Format prompt with conversation context"""
-       if context and len(context.strip()) > 0:
-           return f"""You are a helpful AI assistant. Here is our previous conversation:
+   def _check_ollama_connection(self):
+       """Check every endpoint, then keep checking in the background if there are several"""
+       for backend in self.backends.backends:
+           self.backends.mark(backend, self._check_backend(backend, verbose=True))
+       if len(self.backends.backends) > 1:
+           self.backends.start_health_checks(
+               self._check_backend, float(os.getenv('OLLAMA_HEALTH_INTERVAL', '10'))
+           )
 
-            {context}
+   def generate_response(self, prompt: str, context: str = "", summary: str = "",
+                         use_cache: bool = True, session_id: str = "default",
+                         priority: int = PRIORITY_INTERACTIVE, options: Optional[Dict[str, Any]] = None,
+                         cancel: Optional[Cancellation] = None) -> str:
+       """
+       Generate response using Ollama API.
 
-            Based on our conversation history above, please respond to: {prompt}
+       Args:
+           prompt: User input message
+           context: Previous conversation context
+           summary: Running summary of turns older than the context
+           use_cache: Set False to skip the response cache for this request
+           session_id: Session the request belongs to (for fair scheduling)
+           priority: Scheduling priority (lower is served first)
+           options: Generation options for this request (see ollama_options)
+           cancel: Cancellation whose deadline bounds the queue wait and the request
 
-            Remember to use information from our previous conversation when relevant."""
-       else:
-           return f"You are a helpful AI assistant.\n\nHuman: {prompt}\n\nAssistant:"
+       Returns:
+           Generated response string, or a FailedGeneration
+       """
+       with self.metrics.stage("format", self.model_name):
+           payload = self._build_payload(prompt, context, stream=False, summary=summary, options=options)
+           key = self._cache_key(prompt, context, summary, payload)
+       return self._complete("/api/generate", payload, key, use_cache, session_id, priority, cancel)
    
-   def generate_response(self, prompt: str, context: str = "") -> str:
+   def chat_response(self, prompt: str, window: ContextWindow, use_cache: bool = True,
+                     session_id: str = "default", priority: int = PRIORITY_INTERACTIVE,
+                     options: Optional[Dict[str, Any]] = None, cancel: Optional[Cancellation] = None) -> str:
        """
-       Generate response using Ollama API.
+       Generate a reply through /api/chat with a prefix-stable message layout.
        
        Args:
            prompt: User input message
-           context: Previous conversation context
-           
+           window: Context from ContextBuilder (recent turns, summary, memories)
+           use_cache: Set False to skip the response cache for this request
+           session_id: Session the request belongs to (for scheduling and routing)
+           priority: Scheduling priority (lower is served first)
+           options: Generation options for this request (see ollama_options)
+           cancel: Cancellation whose deadline bounds the queue wait and the request
+       
        Returns:
-           Generated response string
+           Generated response string, or a FailedGeneration
        """
-       full_prompt = self._format_prompt(prompt, context)
+       with self.metrics.stage("format", self.model_name):
+           payload = self._build_chat_payload(prompt, window, stream=False, options=options)
+           key = self._cache_key(prompt, window.text, window.summary, payload)
+       return self._complete("/api/chat", payload, key, use_cache, session_id, priority, cancel)
+   
+   def _complete(self, endpoint: str, payload: Dict[str, Any], key: ResponseKey, use_cache: bool,
+                 session_id: str, priority: int, cancel: Optional[Cancellation] = None) -> str:
+       """Serve a response from the cache, or schedule a generation"""
+       if use_cache:
+           cached = self.response_cache.get(key)
+           if cached is not None:
+               return cached
+
+       queued = time.perf_counter()
        
+       def call() -> str:
+           self.metrics.observe("queue_wait", payload["model"], time.perf_counter() - queued)
+           if cancel is not None and cancel.cancelled:
+               return _cancelled(cancel)
+           return self._generate(endpoint, payload, key, use_cache, session_id, cancel)
+       
+       try:
+           # Identical cacheable requests in flight share one generation; a
+           # cancellable one runs alone so its cancel can't cut off other callers
+           shared = key if use_cache and cancel is None else None
+           return self.scheduler.run(shared, call, session_id, priority, timeout=self._queue_timeout(cancel))
+       except LLMBusyError as e:
+           return FailedGeneration(f"Error: LLM is busy, please try again ({e})")
+
+   def _generate(self, endpoint: str, payload: Dict[str, Any], key: ResponseKey, use_cache: bool,
+                 session_id: str, cancel: Optional[Cancellation] = None) -> str:
+       """POST a non-streaming generation and cache a successful response"""
+       try:
+           with self.backends.route(session_id) as lease:
+               started = time.perf_counter()
+               try:
+                   response = self._session_for(cancel).post(
+                       f"{lease.url}{endpoint}",
+                       json=payload,
+                       timeout=self._request_timeout(cancel)
+                   )
+               except requests.exceptions.RequestException:
+                   if cancel is None or not cancel.cancelled:
+                       raise
+                   # Timed out at the caller's deadline: not the endpoint's failure
+                   return _cancelled(cancel)
+               self._record_latency(endpoint, started)
+               self.metrics.observe("generate", payload["model"], time.perf_counter() - started)
+               lease.ok = response.status_code < 500
+
+           if response.status_code == 200:
+               result = response.json()
+               self._record_usage(payload, result)
+               text = _response_text(result)
+               if not text:
+                   return FailedGeneration('Sorry, I could not generate a response.')
+               if use_cache:
+                   self.response_cache.put(key, text)
+               return text
+           else:
+               return FailedGeneration(f"Error: Could not connect to LLM (Status: {response.status_code})")
+
+       except requests.exceptions.RequestException as e:
+           return FailedGeneration(f"Error: Connection to LLM failed - {str(e)}")
+
+   def stream_response(self, prompt: str, context: str = "", summary: str = "",
+                       use_cache: bool = True, session_id: str = "default",
+                       priority: int = PRIORITY_INTERACTIVE, options: Optional[Dict[str, Any]] = None,
+                       cancel: Optional[Cancellation] = None) -> Iterator[str]:
+       """
+       Stream response tokens from Ollama API as they are generated.
+
+       Ollama sends one JSON object per line; each chunk's `response` text is
+       yielded as soon as it arrives. Closing the generator closes the HTTP
+       stream so Ollama stops generating. So does `cancel`, from any thread
+       and even while a read is blocked; a cancelled stream just ends (with
+       an error message if nothing was generated yet). A cached response is
+       yielded as a single fragment; only streams that finish are cached.
+
+       Args:
+           prompt: User input message
+           context: Previous conversation context
+           summary: Running summary of turns older than the context
+           use_cache: Set False to skip the response cache for this request
+           session_id: Session the request belongs to (for fair scheduling)
+           priority: Scheduling priority (lower is served first)
+           options: Generation options for this request (see ollama_options)
+           cancel: Cancellation that aborts the stream (its deadline also
+               bounds the queue wait)
+
+       Yields:
+           Response text fragments (or a single FailedGeneration)
+       """
+       with self.metrics.stage("format", self.model_name):
+           payload = self._build_payload(prompt, context, stream=True, summary=summary, options=options)
+           key = self._cache_key(prompt, context, summary, payload)
+       yield from self._stream_scheduled("/api/generate", payload, key, use_cache, session_id, priority, cancel)
+   
+   def stream_chat(self, prompt: str, window: ContextWindow, use_cache: bool = True,
+                   session_id: str = "default", priority: int = PRIORITY_INTERACTIVE,
+                   options: Optional[Dict[str, Any]] = None, cancel: Optional[Cancellation] = None) -> Iterator[str]:
+       """Stream a reply through /api/chat (see chat_response and stream_response)"""
+       with self.metrics.stage("format", self.model_name):
+           payload = self._build_chat_payload(prompt, window, stream=True, options=options)
+           key = self._cache_key(prompt, window.text, window.summary, payload)
+       yield from self._stream_scheduled("/api/chat", payload, key, use_cache, session_id, priority, cancel)
+   
+   def _stream_scheduled(self, endpoint: str, payload: Dict[str, Any], key: ResponseKey, use_cache: bool,
+                         session_id: str, priority: int, cancel: Optional[Cancellation] = None) -> Iterator[str]:
+       """Replay a cached response, or stream a generation inside a scheduler slot"""
+       if use_cache:
+           cached = self.response_cache.get(key)
+           if cached is not None:
+               yield cached
+               return
+
+       # The slot is held until the stream finishes or the consumer stops
+       queued = time.perf_counter()
+       try:
+           with self.scheduler.slot(session_id, priority, timeout=self._queue_timeout(cancel)):
+               self.metrics.observe("queue_wait", payload["model"], time.perf_counter() - queued)
+               if cancel is not None and cancel.cancelled:
+                   yield _cancelled(cancel)
+                   return
+               yield from self._stream(endpoint, payload, key, use_cache, session_id, cancel)
+       except LLMBusyError as e:
+           yield FailedGeneration(f"Error: LLM is busy, please try again ({e})")
+
+   def _stream(self, endpoint: str, payload: Dict[str, Any], key: ResponseKey, use_cache: bool,
+               session_id: str, cancel: Optional[Cancellation] = None) -> Iterator[str]:
+       """POST a streaming generation and yield its NDJSON fragments"""
+       parts = []
+       started = time.perf_counter()
+       unregister = None
+       try:
+           with self.backends.route(session_id) as lease:
+               try:
+                   with self._session_for(cancel).post(
+                       f"{lease.url}{endpoint}",
+                       json=payload,
+                       stream=True,
+                       timeout=self._request_timeout(cancel)
+                   ) as response:
+                       if response.status_code != 200:
+                           lease.ok = response.status_code < 500
+                           yield FailedGeneration(f"Error: Could not connect to LLM (Status: {response.status_code})")
+                           return
+                       if cancel is not None:
+                           unregister = cancel.on_cancel(lambda: _abort(response))
+
+                       for line in response.iter_lines():
+                           if cancel is not None and cancel.cancelled:
+                               return
+                           if not line:
+                               continue
+                           chunk = json.loads(line)
+                           if chunk.get('error'):
+                               yield FailedGeneration(f"Error: {chunk['error']}")
+                               return
+                           text = _response_text(chunk)
+                           if text:
+                               if not parts:
+                                   self.metrics.observe("first_token", payload["model"],
+                                                        time.perf_counter() - started)
+                               parts.append(text)
+                               yield text
+                           if chunk.get('done'):
+                               self._record_usage(payload, chunk)
+                               if use_cache and parts:
+                                   self.response_cache.put(key, "".join(parts))
+                               return
+               except requests.exceptions.RequestException:
+                   if cancel is None or not cancel.cancelled:
+                       raise
+                   # Aborted by cancel() or the deadline: not the endpoint's failure
+                   if not parts:
+                       yield _cancelled(cancel)
+
+       except requests.exceptions.RequestException as e:
+           yield FailedGeneration(f"Error: Connection to LLM failed - {str(e)}")
+       finally:
+           if unregister is not None:
+               unregister()
+           self._record_latency(f"{endpoint}:stream", started)
+           self.metrics.observe("generate", payload["model"], time.perf_counter() - started)
+
+   def summarize_conversation(self, transcript: str, previous_summary: str = "") -> Optional[str]:
+       """
+       Fold older conversation turns into the running summary.
+
+       Args:
+           transcript: Human/Assistant lines to add to the summary
+           previous_summary: Summary of everything before the transcript
+
+       Returns:
+           Updated summary, or None if the LLM call failed
+       """
+       prompt = (
+           "Update the summary of a conversation between a user and an AI assistant. "
+           "Keep every fact the user shared about themselves (names, preferences, "
+           "work, location) and any open questions. Reply with the summary only.\n\n"
+           f"Current summary: {previous_summary or '(none)'}\n\n"
+           f"New messages:\n{transcript}\n\nUpdated summary:"
+       )
+       options = {"temperature": 0.2}
+       # Same context size as chat requests, or Ollama reloads the model between them
+       num_ctx = self._options().get("num_ctx")
+       if num_ctx is not None:
+           options["num_ctx"] = num_ctx
        payload = {
            "model": self.model_name,
-           "prompt": full_prompt,
+           "prompt": prompt,
            "stream": False,
-           "options": {
-               "temperature": 0.7,
-               "max_tokens": 500,
-           }
+           "keep_alive": self.keep_alive,
+           "options": options,
        }
-       
+
        try:
-           response = requests.post(
-               f"{self.base_url}/api/generate",
-               json=payload,
-               timeout=30
-           )
-           
+           with self.scheduler.slot("summarizer", PRIORITY_BACKGROUND), self.backends.route() as lease:
+               started = time.perf_counter()
+               response = self.session.post(
+                   f"{lease.url}/api/generate",
+                   json=payload,
+                   timeout=self.timeout
+               )
+               self._record_latency("/api/generate:summary", started)
+               lease.ok = response.status_code < 500
+           if response.status_code == 200:
+               return response.json().get('response', '').strip() or None
+           print(f"Warning: Summarization failed (Status: {response.status_code})")
+       except (requests.exceptions.RequestException, LLMBusyError) as e:
+           print(f"Warning: Summarization failed - {e}")
+       return None
+
+   def embed(self, texts: List[str], model: str,
+             priority: int = PRIORITY_BACKGROUND) -> Optional[List[List[float]]]:
+       """
+       Embed a batch of texts with one /api/embed call.
+
+       Args:
+           texts: Texts to embed
+           model: Ollama embedding model (e.g. nomic-embed-text)
+           priority: Scheduler priority; PRIORITY_INTERACTIVE for a query
+               embedded while a user turn waits
+
+       Returns:
+           One vector per text, or None if the LLM call failed
+       """
+       try:
+           with self.scheduler.slot("embedder", priority), self.backends.route() as lease:
+               started = time.perf_counter()
+               response = self.session.post(
+                   f"{lease.url}/api/embed",
+                   json={"model": model, "input": texts, "keep_alive": self.keep_alive},
+                   timeout=self.timeout
+               )
+               self._record_latency("/api/embed", started)
+               lease.ok = response.status_code < 500
+           if response.status_code == 200:
+               return response.json().get('embeddings')
+           print(f"Warning: Embedding failed (Status: {response.status_code})")
+       except (requests.exceptions.RequestException, LLMBusyError) as e:
+           print(f"Warning: Embedding failed - {e}")
+       return None
+   
+   def close(self):
+       """Stop health checks and close pooled HTTP connections"""
+       self.backends.stop()
+       self.session.close()
+       self.cancellable_session.close()
+
+class AsyncOllamaLLM(_OllamaBase):
+   """
+   Async variant of OllamaLLM on a shared httpx connection pool.
+
+   Prompt formatting and payloads are identical to OllamaLLM; requests are
+   awaited instead of blocking a thread, so many concurrent generations can
+   share one event loop. Uses the same OLLAMA_* settings as OllamaLLM
+   (OLLAMA_MAX_CONNECTIONS defaults to 100 here); retries only cover
+   connection failures, which is what httpx transports support.
+   Concurrency is bounded by the httpx pool (OLLAMA_MAX_CONNECTIONS) rather
+   than LLMScheduler, whose waits would block the event loop. Endpoints are
+   routed like OllamaLLM, but only checked at open(); failing endpoints are
+   ejected and readmitted after OLLAMA_EJECT_SECONDS. A Cancellation is
+   checked between chunks and its deadline bounds each request; cancelling
+   the awaiting task aborts a request at once. Summaries and embeddings are
+   produced by the sync OllamaLLM (background workers), so they are not
+   offered here.
+   Call `await aclose()` on shutdown.
+   """
+
+   def __init__(self, metrics: Optional[PipelineMetrics] = None):
+       super().__init__(metrics, default_max_connections=100)
+       self.client = httpx.AsyncClient(
+           timeout=httpx.Timeout(self.read_timeout, connect=self.connect_timeout),
+           limits=httpx.Limits(
+               max_connections=self.max_connections,
+               max_keepalive_connections=self.max_connections
+           ),
+           transport=httpx.AsyncHTTPTransport(retries=self.max_retries)
+       )
+
+   async def _check_ollama_connection(self):
+       """Check if every endpoint is running and serves the model"""
+       for backend in self.backends.backends:
+           healthy = False
+           try:
+               started = time.perf_counter()
+               response = await self.client.get(f"{backend.url}/api/tags")
+               self._record_latency("/api/tags", started)
+               if response.status_code == 200:
+                   models = [model['name'] for model in response.json().get('models', [])]
+                   healthy = self.model_name in models
+                   if not healthy:
+                       print(f"Warning: Model {self.model_name} not found at {backend.url}. "
+                             f"Available models: {models}")
+                   else:
+                       print(f"Ollama connected successfully ({backend.url}). Using model: {self.model_name}")
+               else:
+                   print(f"Warning: Could not connect to Ollama at {backend.url}")
+           except Exception as e:
+               print(f"Warning: Ollama connection check failed ({backend.url}): {e}")
+           self.backends.mark(backend, healthy)
+
+   def _httpx_timeout(self, cancel: Optional[Cancellation]):
+       """Client default timeouts, or ones shortened to a cancellation's deadline"""
+       if cancel is None or cancel.deadline is None:
+           return httpx.USE_CLIENT_DEFAULT
+       connect, read = self._request_timeout(cancel)
+       return httpx.Timeout(read, connect=connect)
+   
+   async def generate_response(self, prompt: str, context: str = "", summary: str = "",
+                               use_cache: bool = True, session_id: str = "default",
+                               options: Optional[Dict[str, Any]] = None,
+                               cancel: Optional[Cancellation] = None) -> str:
+       """Async version of OllamaLLM.generate_response"""
+       with self.metrics.stage("format", self.model_name):
+           payload = self._build_payload(prompt, context, stream=False, summary=summary, options=options)
+           key = self._cache_key(prompt, context, summary, payload)
+       return await self._acomplete("/api/generate", payload, key, use_cache, session_id, cancel)
+   
+   async def chat_response(self, prompt: str, window: ContextWindow, use_cache: bool = True,
+                           session_id: str = "default", options: Optional[Dict[str, Any]] = None,
+                           cancel: Optional[Cancellation] = None) -> str:
+       """Async version of OllamaLLM.chat_response"""
+       with self.metrics.stage("format", self.model_name):
+           payload = self._build_chat_payload(prompt, window, stream=False, options=options)
+           key = self._cache_key(prompt, window.text, window.summary, payload)
+       return await self._acomplete("/api/chat", payload, key, use_cache, session_id, cancel)
+   
+   async def _acomplete(self, endpoint: str, payload: Dict[str, Any], key: ResponseKey,
+                        use_cache: bool, session_id: str, cancel: Optional[Cancellation] = None) -> str:
+       if use_cache:
+           cached = self.response_cache.get(key)
+           if cached is not None:
+               return cached
+       if cancel is not None and cancel.cancelled:
+           return _cancelled(cancel)
+
+       try:
+           with self.backends.route(session_id) as lease:
+               started = time.perf_counter()
+               try:
+                   response = await self.client.post(f"{lease.url}{endpoint}", json=payload,
+                                                     timeout=self._httpx_timeout(cancel))
+               except httpx.HTTPError:
+                   if cancel is None or not cancel.cancelled:
+                       raise
+                   return _cancelled(cancel)
+               self._record_latency(endpoint, started)
+               self.metrics.observe("generate", payload["model"], time.perf_counter() - started)
+               lease.ok = response.status_code < 500
+
            if response.status_code == 200:
-               return response.json().get('response', 'Sorry, I could not generate a response.')
+               result = response.json()
+               self._record_usage(payload, result)
+               text = _response_text(result)
+               if not text:
+                   return FailedGeneration('Sorry, I could not generate a response.')
+               if use_cache:
+                   self.response_cache.put(key, text)
+               return text
            else:
-               return f"Error: Could not connect to LLM (Status: {response.status_code})"
-               
-       except requests.exceptions.RequestException as e:
-           return f"Error: Connection to LLM failed - {str(e)}"
\ No newline at end of file
+               return FailedGeneration(f"Error: Could not connect to LLM (Status: {response.status_code})")
+
+       except httpx.HTTPError as e:
+           return FailedGeneration(f"Error: Connection to LLM failed - {str(e)}")
+
+   async def stream_response(self, prompt: str, context: str = "", summary: str = "",
+                             use_cache: bool = True, session_id: str = "default",
+                             options: Optional[Dict[str, Any]] = None,
+                             cancel: Optional[Cancellation] = None) -> AsyncIterator[str]:
+       """Async version of OllamaLLM.stream_response"""
+       with self.metrics.stage("format", self.model_name):
+           payload = self._build_payload(prompt, context, stream=True, summary=summary, options=options)
+           key = self._cache_key(prompt, context, summary, payload)
+       async for text in self._astream("/api/generate", payload, key, use_cache, session_id, cancel):
+           yield text
+   
+   async def stream_chat(self, prompt: str, window: ContextWindow, use_cache: bool = True,
+                         session_id: str = "default", options: Optional[Dict[str, Any]] = None,
+                         cancel: Optional[Cancellation] = None) -> AsyncIterator[str]:
+       """Async version of OllamaLLM.stream_chat"""
+       with self.metrics.stage("format", self.model_name):
+           payload = self._build_chat_payload(prompt, window, stream=True, options=options)
+           key = self._cache_key(prompt, window.text, window.summary, payload)
+       async for text in self._astream("/api/chat", payload, key, use_cache, session_id, cancel):
+           yield text
+   
+   async def _astream(self, endpoint: str, payload: Dict[str, Any], key: ResponseKey,
+                      use_cache: bool, session_id: str, cancel: Optional[Cancellation] = None) -> AsyncIterator[str]:
+       if use_cache:
+           cached = self.response_cache.get(key)
+           if cached is not None:
+               yield cached
+               return
+       if cancel is not None and cancel.cancelled:
+           yield _cancelled(cancel)
+           return
+
+       parts = []
+       started = time.perf_counter()
+       try:
+           with self.backends.route(session_id) as lease:
+               try:
+                   async with self.client.stream("POST", f"{lease.url}{endpoint}", json=payload,
+                                                 timeout=self._httpx_timeout(cancel)) as response:
+                       if response.status_code != 200:
+                           lease.ok = response.status_code < 500
+                           yield FailedGeneration(f"Error: Could not connect to LLM (Status: {response.status_code})")
+                           return
+
+                       async for line in response.aiter_lines():
+                           if cancel is not None and cancel.cancelled:
+                               return
+                           if not line:
+                               continue
+                           chunk = json.loads(line)
+                           if chunk.get('error'):
+                               yield FailedGeneration(f"Error: {chunk['error']}")
+                               return
+                           text = _response_text(chunk)
+                           if text:
+                               if not parts:
+                                   self.metrics.observe("first_token", payload["model"],
+                                                        time.perf_counter() - started)
+                               parts.append(text)
+                               yield text
+                           if chunk.get('done'):
+                               self._record_usage(payload, chunk)
+                               if use_cache and parts:
+                                   self.response_cache.put(key, "".join(parts))
+                               return
+               except httpx.HTTPError:
+                   if cancel is None or not cancel.cancelled:
+                       raise
+                   # Timed out at the caller's deadline: not the endpoint's failure
+                   if not parts:
+                       yield _cancelled(cancel)
+
+       except httpx.HTTPError as e:
+           yield FailedGeneration(f"Error: Connection to LLM failed - {str(e)}")
+       finally:
+           self._record_latency(f"{endpoint}:stream", started)
+           self.metrics.observe("generate", payload["model"], time.perf_counter() - started)
+
+   async def aclose(self):
+       """Close the shared HTTP connection pool"""
+       await self.client.aclose()
\ No newline at end of file
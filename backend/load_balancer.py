@@ -0,0 +1,165 @@
+import os
+import time
+import hashlib
+import threading
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+class OllamaBackend:
+    """Routing state of one Ollama endpoint"""
+    
+    def __init__(self, url: str):
+        self.url = url.rstrip("/")
+        self.outstanding = 0
+        self.ewma_latency = 0.0
+        self.healthy = True
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.requests = 0
+        self.failures = 0
+    
+    def available(self, now: float) -> bool:
+        return self.healthy and self.ejected_until <= now
+
+class Lease:
+    """A routed request; set `ok = False` for failed responses (e.g. 5xx)"""
+    __slots__ = ("backend", "url", "ok")
+    
+    def __init__(self, backend: OllamaBackend):
+        self.backend = backend
+        self.url = backend.url
+        self.ok = True
+
+class BackendPool:
+    """
+    Health-aware router over one or more Ollama endpoints.
+    
+    Key responsibilities:
+    - Send each request to the available endpoint with the fewest
+      outstanding requests (ties broken by latency EWMA)
+    - Optionally pin sessions to an endpoint by rendezvous hashing, so a
+      conversation keeps hitting the node with its KV cache warm and
+      only moves when that node becomes unavailable
+    - Eject an endpoint after OLLAMA_EJECT_FAILURES consecutive failures
+      for OLLAMA_EJECT_SECONDS, and track health reported by check()
+    - Fall back to every endpoint when none is available
+    
+    Endpoints come from OLLAMA_BASE_URLS (comma-separated) or
+    OLLAMA_BASE_URL; affinity is enabled with OLLAMA_SESSION_AFFINITY=1.
+    """
+    
+    # Weight of the newest sample in the latency EWMA
+    EWMA_ALPHA = 0.2
+    
+    def __init__(self, urls: List[str], session_affinity: Optional[bool] = None):
+        if not urls:
+            raise ValueError("At least one Ollama endpoint is required")
+        self.backends = [OllamaBackend(url) for url in urls]
+        self.session_affinity = (session_affinity if session_affinity is not None
+                                 else os.getenv('OLLAMA_SESSION_AFFINITY', '0') == '1')
+        self.eject_failures = int(os.getenv('OLLAMA_EJECT_FAILURES', '3'))
+        self.eject_seconds = float(os.getenv('OLLAMA_EJECT_SECONDS', '30'))
+        self._lock = threading.Lock()
+        self._checker: Optional[threading.Thread] = None
+        self._stop = threading.Event()
+    
+    @classmethod
+    def from_env(cls) -> "BackendPool":
+        urls = os.getenv('OLLAMA_BASE_URLS') or os.getenv('OLLAMA_BASE_URL', 'http://localhost:11434')
+        return cls([url.strip() for url in urls.split(",") if url.strip()])
+    
+    def _affinity_backend(self, session_id: str, candidates: List[OllamaBackend]) -> OllamaBackend:
+        """Rendezvous hashing: highest hash of (session, url) wins"""
+        return max(
+            candidates,
+            key=lambda backend: hashlib.blake2b(f"{session_id}|{backend.url}".encode(), digest_size=8).digest()
+        )
+    
+    def choose(self, session_id: Optional[str] = None) -> OllamaBackend:
+        """Pick the endpoint for a request and count it as outstanding"""
+        with self._lock:
+            now = time.monotonic()
+            candidates = [backend for backend in self.backends if backend.available(now)] or self.backends
+            if self.session_affinity and session_id is not None:
+                backend = self._affinity_backend(session_id, candidates)
+            else:
+                backend = min(candidates, key=lambda b: (b.outstanding, b.ewma_latency))
+            backend.outstanding += 1
+            backend.requests += 1
+            return backend
+    
+    def release(self, backend: OllamaBackend, latency: float, ok: bool):
+        """Finish a request: update latency EWMA and the failure streak"""
+        with self._lock:
+            backend.outstanding -= 1
+            if ok:
+                backend.consecutive_failures = 0
+                backend.ewma_latency = (latency if backend.ewma_latency == 0.0 else
+                                        self.EWMA_ALPHA * latency + (1 - self.EWMA_ALPHA) * backend.ewma_latency)
+                return
+            backend.failures += 1
+            backend.consecutive_failures += 1
+            if backend.consecutive_failures >= self.eject_failures and len(self.backends) > 1:
+                backend.ejected_until = time.monotonic() + self.eject_seconds
+                print(f"Warning: Ejecting Ollama endpoint {backend.url} after "
+                      f"{backend.consecutive_failures} consecutive failures")
+    
+    @contextmanager
+    def route(self, session_id: Optional[str] = None) -> Iterator[Lease]:
+        """Hold a routed endpoint for one request; exceptions count as failures"""
+        lease = Lease(self.choose(session_id))
+        started = time.perf_counter()
+        try:
+            yield lease
+        except Exception:
+            # GeneratorExit (a consumer closing a stream) is not a failure
+            lease.ok = False
+            raise
+        finally:
+            self.release(lease.backend, time.perf_counter() - started, lease.ok)
+    
+    def mark(self, backend: OllamaBackend, healthy: bool):
+        """Record a health check result; a healthy check readmits an ejected endpoint"""
+        with self._lock:
+            if healthy and (not backend.healthy or backend.ejected_until > time.monotonic()):
+                print(f"Ollama endpoint {backend.url} is healthy again")
+            elif not healthy and backend.healthy and len(self.backends) > 1:
+                print(f"Warning: Ollama endpoint {backend.url} failed its health check")
+            backend.healthy = healthy
+            if healthy:
+                backend.ejected_until = 0.0
+                backend.consecutive_failures = 0
+    
+    def start_health_checks(self, check: Callable[[OllamaBackend], bool], interval: float):
+        """Run `check` on every endpoint every `interval` seconds in a daemon thread"""
+        if self._checker is not None:
+            return
+        self._checker = threading.Thread(
+            target=self._run_checks, args=(check, interval), name="ollama-health", daemon=True
+        )
+        self._checker.start()
+    
+    def _run_checks(self, check: Callable[[OllamaBackend], bool], interval: float):
+        while not self._stop.wait(interval):
+            for backend in self.backends:
+                self.mark(backend, check(backend))
+    
+    def stop(self):
+        """Stop background health checks"""
+        self._stop.set()
+    
+    def get_stats(self) -> List[Dict[str, Any]]:
+        """Get per-endpoint routing state"""
+        with self._lock:
+            now = time.monotonic()
+            return [
+                {
+                    "url": backend.url,
+                    "available": backend.available(now),
+                    "outstanding": backend.outstanding,
+                    "ewma_latency": backend.ewma_latency,
+                    "requests": backend.requests,
+                    "failures": backend.failures,
+                }
+                for backend in self.backends
+            ]
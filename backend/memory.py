@@ -0,0 +1,268 @@
+import os
+import re
+import queue
+import threading
+import zlib
+from collections import OrderedDict
+from typing import Dict, Iterable, List, NamedTuple, Optional, Set, Tuple
+import numpy as np
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from .scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE
+
+_TOKEN_PATTERN = re.compile(r"\w+")
+
+class Memory(NamedTuple):
+    """A past message recalled for the current turn"""
+    role: str
+    content: str
+    score: float
+
+class HashingEmbedder:
+    """
+    Local bag-of-words embedder using feature hashing (no model required).
+    
+    Captures lexical overlap only, which is enough to recall facts such as
+    "my favorite color is ..." when asked about a favorite color. Use
+    OllamaEmbedder for semantic similarity.
+    """
+    
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+    
+    def embed(self, texts: List[str], query: bool = False) -> np.ndarray:
+        vectors = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for token in _TOKEN_PATTERN.findall(text.lower()):
+                vectors[row, zlib.crc32(token.encode()) % self.dim] += 1.0
+        return vectors
+
+class OllamaEmbedder:
+    """
+    Embeds text batches through Ollama's /api/embed endpoint.
+    
+    Indexing runs at background priority; a query (`query=True`) is
+    embedded while a user turn waits, so it is scheduled as interactive.
+    """
+    
+    def __init__(self, llm, model: str):
+        self.llm = llm
+        self.model = model
+    
+    def embed(self, texts: List[str], query: bool = False) -> np.ndarray:
+        priority = PRIORITY_INTERACTIVE if query else PRIORITY_BACKGROUND
+        vectors = self.llm.embed(texts, self.model, priority=priority)
+        if vectors is None:
+            raise RuntimeError(f"Embedding model {self.model} unavailable")
+        return np.asarray(vectors, dtype=np.float32)
+
+def build_embedder(llm):
+    """Select the embedder from EMBEDDING_BACKEND ("hash" or "ollama")"""
+    if os.getenv('EMBEDDING_BACKEND', 'hash') == 'ollama':
+        return OllamaEmbedder(llm, os.getenv('EMBEDDING_MODEL', 'nomic-embed-text'))
+    return HashingEmbedder(int(os.getenv('EMBEDDING_DIM', '512')))
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return vectors / norms
+
+class _SessionIndex:
+    """Row-normalized embedding matrix of one session"""
+    __slots__ = ("roles", "contents", "matrix")
+    
+    def __init__(self, roles: List[str], contents: List[str], matrix: np.ndarray):
+        self.roles = roles
+        self.contents = contents
+        self.matrix = matrix
+    
+    def extend(self, roles: List[str], contents: List[str], matrix: np.ndarray):
+        self.roles.extend(roles)
+        self.contents.extend(contents)
+        self.matrix = np.vstack([self.matrix, matrix]) if len(self.matrix) else matrix
+
+class SemanticMemory:
+    """
+    Long-term memory: embedding index over a session's past messages.
+    
+    Key responsibilities:
+    - Embed new messages in batches on a background worker and store them
+      in chat_memories (one embedder call and one INSERT batch per flush)
+    - Keep per-session normalized embedding matrices in an LRU so recall is
+      a single matrix-vector product plus argpartition
+    - Return the top-k most similar past messages for the current prompt
+    - Drop a session's queued messages when it is cleared, so they can't
+      be written back afterwards
+    
+    Configured through MEMORY_TOP_K, MEMORY_MIN_SCORE, MEMORY_BATCH_SIZE and
+    MEMORY_CACHE_SESSIONS; the embedder through EMBEDDING_BACKEND.
+    """
+    
+    def __init__(self, db_manager, embedder):
+        self.db_manager = db_manager
+        self.embedder = embedder
+        self.top_k = int(os.getenv('MEMORY_TOP_K', '3'))
+        self.min_score = float(os.getenv('MEMORY_MIN_SCORE', '0.3'))
+        self.batch_size = int(os.getenv('MEMORY_BATCH_SIZE', '64'))
+        self.max_sessions = int(os.getenv('MEMORY_CACHE_SESSIONS', '256'))
+        self._indexes: "OrderedDict[str, _SessionIndex]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._queue: "queue.Queue[Optional[Tuple[str, str, str, int]]]" = queue.Queue()
+        self._worker: Optional[threading.Thread] = None
+        # Bumped by discard(); queued messages of an older generation are skipped
+        self._generations: Dict[str, int] = {}
+        # Held while a batch is embedded and written
+        self._store_lock = threading.Lock()
+    
+    def _role(self, message: BaseMessage) -> Optional[str]:
+        if isinstance(message, HumanMessage):
+            return "Human"
+        if isinstance(message, AIMessage):
+            return "Assistant"
+        return None
+    
+    def index(self, session_id: str, messages: List[BaseMessage]):
+        """Queue persisted messages of a session (UUID) for embedding"""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="memory-indexer", daemon=True)
+                self._worker.start()
+            generation = self._generations.get(session_id, 0)
+        for message in messages:
+            role = self._role(message)
+            if role is not None and message.content:
+                self._queue.put((session_id, role, str(message.content), generation))
+    
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            batch = [item]
+            while len(batch) < self.batch_size:
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None:
+                    self._queue.put(None)
+                    self._queue.task_done()
+                    break
+                batch.append(item)
+            try:
+                self._store(batch)
+            except Exception as e:
+                print(f"Warning: Indexing {len(batch)} memories failed: {e}")
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+    
+    def _store(self, batch: List[Tuple[str, str, str, int]]):
+        with self._store_lock:
+            with self._lock:
+                batch = [item for item in batch if self._generations.get(item[0], 0) == item[3]]
+            if not batch:
+                return
+            vectors = _normalize(self.embedder.embed([content for _, _, content, _ in batch]))
+            self.db_manager.add_memories([
+                (session_id, role, content, vector.tobytes())
+                for (session_id, role, content, _), vector in zip(batch, vectors)
+            ])
+            with self._lock:
+                for row, (session_id, role, content, _) in enumerate(batch):
+                    session_index = self._indexes.get(session_id)
+                    if session_index is not None:
+                        session_index.extend([role], [content], vectors[row:row + 1])
+    
+    def _load(self, session_id: str) -> _SessionIndex:
+        with self._lock:
+            session_index = self._indexes.get(session_id)
+            if session_index is not None:
+                self._indexes.move_to_end(session_id)
+                return session_index
+        
+        rows = self.db_manager.get_memories(session_id)
+        dim = len(rows[-1][2]) // 4 if rows else 0
+        # Rows from a different embedder (other dimension) are ignored
+        rows = [row for row in rows if len(row[2]) // 4 == dim]
+        matrix = (np.frombuffer(b"".join(bytes(row[2]) for row in rows), dtype=np.float32).reshape(len(rows), dim)
+                  if rows else np.zeros((0, 0), dtype=np.float32))
+        session_index = _SessionIndex([row[0] for row in rows], [row[1] for row in rows], matrix)
+        
+        with self._lock:
+            self._indexes[session_id] = session_index
+            while len(self._indexes) > self.max_sessions:
+                self._indexes.popitem(last=False)
+        return session_index
+    
+    def search(self, session_id: str, query: str, exclude: Iterable[str] = ()) -> List[Memory]:
+        """
+        Find the past messages of a session most similar to `query`.
+        
+        Args:
+            session_id: Session UUID
+            query: Current user message
+            exclude: Contents already present in the context (skipped)
+        
+        Returns:
+            Up to MEMORY_TOP_K memories above MEMORY_MIN_SCORE, best first
+        """
+        session_index = self._load(session_id)
+        if not session_index.contents:
+            return []
+        
+        query_vector = _normalize(self.embedder.embed([query], query=True))[0]
+        if query_vector.shape[0] != session_index.matrix.shape[1]:
+            return []
+        scores = session_index.matrix @ query_vector
+        
+        excluded: Set[str] = set(exclude)
+        # Over-fetch so excluded/duplicate contents don't starve the result
+        k = min(len(scores), self.top_k + len(excluded))
+        candidates = np.argpartition(-scores, k - 1)[:k]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        
+        memories = []
+        seen = set()
+        for i in candidates:
+            content = session_index.contents[i]
+            if scores[i] < self.min_score or content in excluded or content in seen:
+                continue
+            seen.add(content)
+            memories.append(Memory(session_index.roles[i], content, float(scores[i])))
+            if len(memories) == self.top_k:
+                break
+        return memories
+    
+    def invalidate(self, session_id: Optional[str] = None):
+        """Drop one session's in-process index, or all when None"""
+        with self._lock:
+            if session_id is None:
+                self._indexes.clear()
+            else:
+                self._indexes.pop(session_id, None)
+    
+    def discard(self, session_id: str):
+        """
+        Forget a session (UUID) that is being cleared.
+        
+        Its queued messages are skipped, and a batch being written is
+        waited for, so once this returns no memory of the session will be
+        written until it is indexed again.
+        """
+        with self._lock:
+            self._generations[session_id] = self._generations.get(session_id, 0) + 1
+            self._indexes.pop(session_id, None)
+        with self._store_lock:
+            pass
+    
+    def join(self):
+        """Wait until every queued message has been embedded and stored"""
+        self._queue.join()
+    
+    def stop(self):
+        """Stop the worker after the messages already queued and wait for it"""
+        if self._worker is not None:
+            self._queue.put(None)
+            if self._worker is not threading.current_thread():
+                self._worker.join()
\ No newline at end of file
@@ -0,0 +1,250 @@
+import os
+import time
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+try:
+    from opentelemetry import trace
+except ImportError:
+    trace = None
+
+# Upper bounds (seconds) of the stage latency buckets
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# Upper bounds of the generation speed buckets
+TOKENS_PER_SECOND_BUCKETS = (1.0, 2.5, 5.0, 10.0, 20.0, 30.0, 50.0, 75.0, 100.0, 200.0, 500.0)
+
+_NOOP = nullcontext()
+
+class _Histogram:
+    """Cumulative-bucket histogram in the Prometheus layout"""
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = buckets
+        # One extra slot for +Inf
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """Upper bound of the bucket holding the q-quantile"""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class _Stage:
+    """Times one pipeline stage and records it on exit"""
+    __slots__ = ("metrics", "name", "model", "started")
+
+    def __init__(self, metrics: "PipelineMetrics", name: str, model: str):
+        self.metrics = metrics
+        self.name = name
+        self.model = model
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.metrics.observe(self.name, self.model, time.perf_counter() - self.started)
+        return False
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+class PipelineMetrics:
+    """
+    Per-stage latency and throughput metrics of the chat pipeline.
+
+    Key responsibilities:
+    - Time stages (history, memory, context, format, queue_wait, generate,
+      first_token, db_write and the whole turn) into histograms per model
+    - Record generation speed from Ollama's eval_count/eval_duration
+    - Export everything in the Prometheus text format (render(), or an
+      HTTP endpoint started by serve())
+    - Optionally emit each stage as an OpenTelemetry span, nested under
+      the turn's span
+
+    CHAT_METRICS_ENABLED=0 turns every call into a no-op. Tracing is enabled
+    with CHAT_TRACING_ENABLED=1 and needs the opentelemetry-api package
+    (spans go to whatever tracer provider the application configured).
+    """
+
+    def __init__(self, enabled: Optional[bool] = None, tracing: Optional[bool] = None):
+        self.enabled = enabled if enabled is not None else os.getenv('CHAT_METRICS_ENABLED', '1') == '1'
+        tracing = tracing if tracing is not None else os.getenv('CHAT_TRACING_ENABLED', '0') == '1'
+        self.tracer = None
+        if tracing:
+            if trace is None:
+                print("Warning: CHAT_TRACING_ENABLED is set but opentelemetry is not installed")
+            else:
+                self.tracer = trace.get_tracer("ai-chatbot-with-memory")
+        self.active = self.enabled or self.tracer is not None
+        self._stages: Dict[Tuple[str, str], _Histogram] = {}
+        self._speeds: Dict[str, _Histogram] = {}
+        self._tokens: Dict[str, int] = {}
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+
+    def stage(self, name: str, model: str = ""):
+        """Context manager timing one stage (a shared no-op when disabled)"""
+        if not self.active:
+            return _NOOP
+        return _Stage(self, name, model)
+
+    @contextmanager
+    def turn(self, model: str = "") -> Iterator[None]:
+        """Time a whole chat turn; with tracing, its stages become child spans"""
+        if not self.active:
+            yield
+            return
+        if self.tracer is None:
+            with _Stage(self, "turn", model):
+                yield
+            return
+        with self.tracer.start_as_current_span("chat.turn", attributes={"llm.model": model}):
+            started = time.perf_counter()
+            try:
+                yield
+            finally:
+                self._record("turn", model, time.perf_counter() - started)
+
+    def _record(self, name: str, model: str, seconds: float):
+        if not self.enabled:
+            return
+        with self._lock:
+            histogram = self._stages.get((name, model))
+            if histogram is None:
+                histogram = self._stages[(name, model)] = _Histogram(SECONDS_BUCKETS)
+            histogram.observe(seconds)
+
+    def observe(self, name: str, model: str, seconds: float):
+        """Record a stage that took `seconds` and ended now"""
+        if not self.active:
+            return
+        self._record(name, model, seconds)
+        if self.tracer is not None:
+            end = time.time_ns()
+            span = self.tracer.start_span(
+                f"chat.{name}", start_time=end - int(seconds * 1e9), attributes={"llm.model": model}
+            )
+            span.end(end_time=end)
+
+    def observe_generation(self, model: str, result: Dict[str, Any]):
+        """Record tokens/sec from a final Ollama response (eval_count, eval_duration in ns)"""
+        if not self.enabled:
+            return
+        tokens = result.get('eval_count')
+        duration = result.get('eval_duration')
+        if not tokens or not duration:
+            return
+        with self._lock:
+            histogram = self._speeds.get(model)
+            if histogram is None:
+                histogram = self._speeds[model] = _Histogram(TOKENS_PER_SECOND_BUCKETS)
+            histogram.observe(tokens / (duration / 1e9))
+            self._tokens[model] = self._tokens.get(model, 0) + tokens
+
+    def get_stats(self) -> Dict[str, Dict[str, float]]:
+        """
+        Get a summary per stage and model.
+
+        Returns:
+            Dict mapping "stage/model" (and "tokens_per_second/model") to
+            count, avg, and p50/p95 as bucket upper bounds
+        """
+        with self._lock:
+            series = [(f"{name}/{model}", h) for (name, model), h in self._stages.items()]
+            series += [(f"tokens_per_second/{model}", h) for model, h in self._speeds.items()]
+            return {
+                label: {
+                    "count": h.count,
+                    "avg": h.sum / h.count,
+                    "p50": h.quantile(0.50),
+                    "p95": h.quantile(0.95),
+                }
+                for label, h in series
+            }
+
+    def _render_histogram(self, lines: List[str], name: str, labels: str, histogram: _Histogram):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            lines.append(f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}')
+        lines.append(f'{name}_bucket{{{labels},le="+Inf"}} {histogram.count}')
+        lines.append(f'{name}_sum{{{labels}}} {histogram.sum}')
+        lines.append(f'{name}_count{{{labels}}} {histogram.count}')
+
+    def render(self) -> str:
+        """Render every metric in the Prometheus text exposition format"""
+        lines = [
+            "# HELP chat_stage_seconds Time spent in each stage of a chat turn",
+            "# TYPE chat_stage_seconds histogram",
+        ]
+        with self._lock:
+            for (name, model), histogram in sorted(self._stages.items()):
+                labels = f'stage="{_escape(name)}",model="{_escape(model)}"'
+                self._render_histogram(lines, "chat_stage_seconds", labels, histogram)
+
+            lines += [
+                "# HELP chat_generation_tokens_per_second Generation speed reported by Ollama",
+                "# TYPE chat_generation_tokens_per_second histogram",
+            ]
+            for model, histogram in sorted(self._speeds.items()):
+                self._render_histogram(lines, "chat_generation_tokens_per_second",
+                                       f'model="{_escape(model)}"', histogram)
+
+            lines += [
+                "# HELP chat_generated_tokens_total Tokens generated by Ollama",
+                "# TYPE chat_generated_tokens_total counter",
+            ]
+            for model, tokens in sorted(self._tokens.items()):
+                lines.append(f'chat_generated_tokens_total{{model="{_escape(model)}"}} {tokens}')
+        return "\n".join(lines) + "\n"
+
+    def serve(self, port: int, host: str = "0.0.0.0"):
+        """Serve render() at /metrics from a daemon thread"""
+        if self._server is not None:
+            return
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), Handler)
+        except OSError as e:
+            print(f"Warning: Could not serve metrics on port {port}: {e}")
+            return
+        threading.Thread(target=self._server.serve_forever, name="metrics-server", daemon=True).start()
+
+    def stop(self):
+        """Stop the metrics endpoint"""
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
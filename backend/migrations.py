@@ -0,0 +1,378 @@
+import threading
+from typing import List, NamedTuple, Set, Tuple
+import psycopg
+
+# Fixed when migration 3 creates the partitions; changing it needs a new migration
+HISTORY_PARTITIONS = 16
+
+# Text search configuration of chat_history.search_vector (migration 5);
+# queries must use the same one to match
+SEARCH_CONFIG = "english"
+
+class Migration(NamedTuple):
+    """One schema version: statements applied together in a transaction"""
+    version: int
+    description: str
+    statements: Tuple[str, ...]
+
+# Append new versions at the end; never edit a migration once released
+MIGRATIONS: List[Migration] = [
+    Migration(1, "chat history, summaries, memories and response cache", (
+        """
+        CREATE TABLE IF NOT EXISTS chat_history (
+            id SERIAL PRIMARY KEY,
+            session_id UUID NOT NULL,
+            message JSONB NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        """,
+        # Serves windowed "last N messages" and keyset pagination queries
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_history_session_id_id
+        ON chat_history (session_id, id);
+        """,
+        # Announce every write so other processes can drop cached context. The
+        # payload is "<session uuid> <origin>", where origin identifies the
+        # writing process (set per connection through the chatbot.origin option)
+        """
+        CREATE OR REPLACE FUNCTION notify_chat_history_changed() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'chat_history_changed',
+                (CASE TG_OP WHEN 'DELETE' THEN OLD.session_id ELSE NEW.session_id END)::text
+                || ' ' || COALESCE(current_setting('chatbot.origin', true), '')
+            );
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE TRIGGER chat_history_changed
+        AFTER INSERT OR DELETE ON chat_history
+        FOR EACH ROW EXECUTE FUNCTION notify_chat_history_changed();
+        """,
+        # Rolling per-session summary of messages older than the context window
+        """
+        CREATE TABLE IF NOT EXISTS chat_summaries (
+            session_id UUID PRIMARY KEY,
+            summary TEXT NOT NULL,
+            summarized_through_id INTEGER NOT NULL,
+            updated_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        """,
+        # Long-term semantic memory: one float32 embedding per stored message
+        """
+        CREATE TABLE IF NOT EXISTS chat_memories (
+            id SERIAL PRIMARY KEY,
+            session_id UUID NOT NULL,
+            role TEXT NOT NULL,
+            content TEXT NOT NULL,
+            embedding BYTEA NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_memories_session_id
+        ON chat_memories (session_id, id);
+        """,
+        # Optional persistent tier of the LLM response cache
+        """
+        CREATE TABLE IF NOT EXISTS llm_response_cache (
+            cache_key TEXT PRIMARY KEY,
+            response TEXT NOT NULL,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        """,
+    )),
+    # Replace the LangChain JSONB envelope with plain columns: role
+    # (0 human, 1 ai, 2 system), content (TOAST-compressed when large) and
+    # the token count previously kept in additional_kwargs
+    Migration(2, "lean message columns", (
+        """
+        ALTER TABLE chat_history
+            ADD COLUMN IF NOT EXISTS role SMALLINT,
+            ADD COLUMN IF NOT EXISTS content TEXT,
+            ADD COLUMN IF NOT EXISTS token_count INTEGER;
+        """,
+        # Other message types leave role NULL and make SET NOT NULL abort the migration
+        """
+        UPDATE chat_history SET
+            role = CASE message->>'type' WHEN 'human' THEN 0 WHEN 'ai' THEN 1 WHEN 'system' THEN 2 END,
+            content = message->'data'->>'content',
+            token_count = (message->'data'->'additional_kwargs'->>'token_count')::integer;
+        """,
+        """
+        ALTER TABLE chat_history
+            ALTER COLUMN role SET NOT NULL,
+            ALTER COLUMN content SET NOT NULL,
+            DROP COLUMN message;
+        """,
+    )),
+    # Hash-partition chat_history by session so every per-session query
+    # touches one partition's (smaller) primary key index, and keep a
+    # per-session index (message count, last activity) for lifecycle jobs
+    Migration(3, "partitioned chat_history, chat_sessions and chat_archive", (
+        "ALTER TABLE chat_history RENAME TO chat_history_unpartitioned;",
+        "ALTER TABLE chat_history_unpartitioned RENAME CONSTRAINT chat_history_pkey TO chat_history_unpartitioned_pkey;",
+        # Keep the id sequence: ids order messages and summaries point at them
+        "ALTER SEQUENCE chat_history_id_seq OWNED BY NONE;",
+        """
+        CREATE TABLE chat_history (
+            id INTEGER NOT NULL DEFAULT nextval('chat_history_id_seq'),
+            session_id UUID NOT NULL,
+            role SMALLINT NOT NULL,
+            content TEXT NOT NULL,
+            token_count INTEGER,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            PRIMARY KEY (session_id, id)
+        ) PARTITION BY HASH (session_id);
+        """,
+        *(
+            f"CREATE TABLE chat_history_p{remainder} PARTITION OF chat_history "
+            f"FOR VALUES WITH (MODULUS {HISTORY_PARTITIONS}, REMAINDER {remainder});"
+            for remainder in range(HISTORY_PARTITIONS)
+        ),
+        "ALTER SEQUENCE chat_history_id_seq OWNED BY chat_history.id;",
+        """
+        INSERT INTO chat_history (id, session_id, role, content, token_count, created_at)
+        SELECT id, session_id, role, content, token_count, created_at FROM chat_history_unpartitioned;
+        """,
+        "DROP TABLE chat_history_unpartitioned;",
+        """
+        CREATE OR REPLACE TRIGGER chat_history_changed
+        AFTER INSERT OR DELETE ON chat_history
+        FOR EACH ROW EXECUTE FUNCTION notify_chat_history_changed();
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS chat_sessions (
+            session_id UUID PRIMARY KEY,
+            message_count INTEGER NOT NULL DEFAULT 0,
+            created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+            last_active_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
+        );
+        """,
+        # Expiry scans every session; archival only those with live messages
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_last_active
+        ON chat_sessions (last_active_at);
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_archivable
+        ON chat_sessions (last_active_at) WHERE message_count > 0;
+        """,
+        """
+        INSERT INTO chat_sessions (session_id, message_count, created_at, last_active_at)
+        SELECT session_id, COUNT(*), MIN(created_at), COALESCE(MAX(created_at), NOW())
+        FROM chat_history GROUP BY session_id;
+        """,
+        # Maintained once per statement (a turn's INSERT, a COPY, a clear),
+        # sessions locked in a fixed order so concurrent batches can't deadlock
+        """
+        CREATE OR REPLACE FUNCTION chat_sessions_count_inserted() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO chat_sessions (session_id, message_count)
+            SELECT session_id, COUNT(*) FROM inserted GROUP BY session_id ORDER BY session_id
+            ON CONFLICT (session_id) DO UPDATE SET
+                message_count = chat_sessions.message_count + EXCLUDED.message_count,
+                last_active_at = NOW();
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE FUNCTION chat_sessions_count_deleted() RETURNS trigger AS $$
+        BEGIN
+            UPDATE chat_sessions SET message_count = GREATEST(chat_sessions.message_count - deleted_counts.count, 0)
+            FROM (SELECT session_id, COUNT(*) AS count FROM deleted GROUP BY session_id ORDER BY session_id) AS deleted_counts
+            WHERE chat_sessions.session_id = deleted_counts.session_id;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE TRIGGER chat_sessions_count_inserted
+        AFTER INSERT ON chat_history REFERENCING NEW TABLE AS inserted
+        FOR EACH STATEMENT EXECUTE FUNCTION chat_sessions_count_inserted();
+        """,
+        """
+        CREATE OR REPLACE TRIGGER chat_sessions_count_deleted
+        AFTER DELETE ON chat_history REFERENCING OLD TABLE AS deleted
+        FOR EACH STATEMENT EXECUTE FUNCTION chat_sessions_count_deleted();
+        """,
+        # Cold storage: messages of idle sessions, one zlib-compressed JSON
+        # batch per archival run (already compressed, so stored EXTERNAL)
+        """
+        CREATE TABLE IF NOT EXISTS chat_archive (
+            id SERIAL PRIMARY KEY,
+            session_id UUID NOT NULL,
+            first_id INTEGER NOT NULL,
+            last_id INTEGER NOT NULL,
+            message_count INTEGER NOT NULL,
+            data BYTEA NOT NULL,
+            archived_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        );
+        """,
+        "ALTER TABLE chat_archive ALTER COLUMN data SET STORAGE EXTERNAL;",
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_archive_session_id
+        ON chat_archive (session_id, first_id);
+        """,
+    )),
+    # Sessions belong to an owner and get a title (by default the start of
+    # their first human message); listing is a keyset scan of one owner's
+    # sessions by recency
+    Migration(4, "session owners, titles and per-owner listing", (
+        """
+        ALTER TABLE chat_sessions
+            ADD COLUMN IF NOT EXISTS owner TEXT,
+            ADD COLUMN IF NOT EXISTS title TEXT;
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_sessions_owner_recent
+        ON chat_sessions (owner, last_active_at, session_id);
+        """,
+        """
+        UPDATE chat_sessions SET title = (
+            SELECT LEFT(content, 80) FROM chat_history
+            WHERE chat_history.session_id = chat_sessions.session_id AND role = 0
+            ORDER BY id LIMIT 1
+        );
+        """,
+        """
+        CREATE OR REPLACE FUNCTION chat_sessions_count_inserted() RETURNS trigger AS $$
+        BEGIN
+            INSERT INTO chat_sessions (session_id, message_count, title)
+            SELECT session_id, COUNT(*), LEFT((ARRAY_AGG(content ORDER BY id) FILTER (WHERE role = 0))[1], 80)
+            FROM inserted GROUP BY session_id ORDER BY session_id
+            ON CONFLICT (session_id) DO UPDATE SET
+                message_count = chat_sessions.message_count + EXCLUDED.message_count,
+                last_active_at = NOW(),
+                title = COALESCE(chat_sessions.title, EXCLUDED.title);
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+    )),
+    # Full-text search: the tsvector is computed on insert (a stored
+    # generated column) and indexed per partition with GIN, whose pending
+    # list keeps inserts cheap
+    Migration(5, "full-text search over chat_history", (
+        f"""
+        ALTER TABLE chat_history ADD COLUMN IF NOT EXISTS search_vector tsvector
+        GENERATED ALWAYS AS (to_tsvector('{SEARCH_CONFIG}', content)) STORED;
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS idx_chat_history_search
+        ON chat_history USING GIN (search_vector);
+        """,
+    )),
+    # Announce changes once per statement and session instead of once per
+    # row, so clearing, archiving or restoring a long session runs a single
+    # trigger call per statement (same channel and payload as before)
+    Migration(6, "statement-level chat_history change notifications", (
+        "DROP TRIGGER IF EXISTS chat_history_changed ON chat_history;",
+        """
+        CREATE OR REPLACE FUNCTION notify_chat_history_statement() RETURNS trigger AS $$
+        BEGIN
+            PERFORM pg_notify(
+                'chat_history_changed',
+                changed_sessions.session_id::text || ' ' || COALESCE(current_setting('chatbot.origin', true), '')
+            )
+            FROM (SELECT DISTINCT session_id FROM changed) AS changed_sessions;
+            RETURN NULL;
+        END;
+        $$ LANGUAGE plpgsql;
+        """,
+        """
+        CREATE OR REPLACE TRIGGER chat_history_inserted
+        AFTER INSERT ON chat_history REFERENCING NEW TABLE AS changed
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_chat_history_statement();
+        """,
+        """
+        CREATE OR REPLACE TRIGGER chat_history_deleted
+        AFTER DELETE ON chat_history REFERENCING OLD TABLE AS changed
+        FOR EACH STATEMENT EXECUTE FUNCTION notify_chat_history_statement();
+        """,
+        "DROP FUNCTION IF EXISTS notify_chat_history_changed();",
+    )),
+]
+
+LATEST_VERSION = MIGRATIONS[-1].version
+
+# Serializes concurrent migrations across processes
+SCHEMA_LOCK_ID = 7414201
+
+VERSION_TABLE = """
+CREATE TABLE IF NOT EXISTS schema_migrations (
+    version INTEGER PRIMARY KEY,
+    description TEXT NOT NULL,
+    applied_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+);
+"""
+
+CURRENT_VERSION_QUERY = "SELECT COALESCE(MAX(version), 0) FROM schema_migrations"
+
+RECORD_VERSION_QUERY = "INSERT INTO schema_migrations (version, description) VALUES (%s, %s)"
+
+# Databases (by URL) already checked by this process
+_migrated: Set[str] = set()
+_migrated_lock = threading.Lock()
+
+def _pending(current: int) -> List[Migration]:
+    return [migration for migration in MIGRATIONS if migration.version > current]
+
+def _current_version(conn: psycopg.Connection) -> int:
+    try:
+        return conn.execute(CURRENT_VERSION_QUERY).fetchone()[0]
+    except psycopg.errors.UndefinedTable:
+        conn.rollback()
+        return 0
+
+def migrate(pool, db_url: str):
+    """
+    Bring the database schema up to LATEST_VERSION.
+
+    A process checks each database once: one version query when the schema
+    is current. Pending migrations are applied in one transaction under an
+    advisory lock, so concurrent processes apply each version exactly once.
+
+    Args:
+        pool: psycopg ConnectionPool to borrow a connection from
+        db_url: Identity of the database for the per-process check
+    """
+    with _migrated_lock:
+        if db_url in _migrated:
+            return
+        with pool.connection() as conn:
+            if _current_version(conn) < LATEST_VERSION:
+                conn.execute(f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_ID})")
+                conn.execute(VERSION_TABLE)
+                # Another process may have migrated while we waited for the lock
+                for migration in _pending(conn.execute(CURRENT_VERSION_QUERY).fetchone()[0]):
+                    for statement in migration.statements:
+                        conn.execute(statement)
+                    conn.execute(RECORD_VERSION_QUERY, (migration.version, migration.description))
+                    print(f"Applied schema migration {migration.version}: {migration.description}")
+        _migrated.add(db_url)
+
+async def amigrate(pool, db_url: str):
+    """Async version of migrate for an AsyncConnectionPool"""
+    if db_url in _migrated:
+        return
+    async with pool.connection() as conn:
+        try:
+            cursor = await conn.execute(CURRENT_VERSION_QUERY)
+            current = (await cursor.fetchone())[0]
+        except psycopg.errors.UndefinedTable:
+            await conn.rollback()
+            current = 0
+        if current < LATEST_VERSION:
+            await conn.execute(f"SELECT pg_advisory_xact_lock({SCHEMA_LOCK_ID})")
+            await conn.execute(VERSION_TABLE)
+            cursor = await conn.execute(CURRENT_VERSION_QUERY)
+            for migration in _pending((await cursor.fetchone())[0]):
+                for statement in migration.statements:
+                    await conn.execute(statement)
+                await conn.execute(RECORD_VERSION_QUERY, (migration.version, migration.description))
+                print(f"Applied schema migration {migration.version}: {migration.description}")
+    _migrated.add(db_url)
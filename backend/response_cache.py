@@ -0,0 +1,209 @@
+import os
+import re
+import time
+import json
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, FrozenSet, NamedTuple, Optional
+
+_WHITESPACE_PATTERN = re.compile(r"\s+")
+
+def normalize_prompt(prompt: str) -> str:
+    """Fold case and collapse whitespace; punctuation and symbols are kept"""
+    return _WHITESPACE_PATTERN.sub(" ", prompt.casefold()).strip()
+
+def _shingles(text: str, size: int = 3) -> FrozenSet[str]:
+    """Character n-grams of normalized text for near-duplicate matching"""
+    if len(text) <= size:
+        return frozenset([text])
+    return frozenset(text[i:i + size] for i in range(len(text) - size + 1))
+
+class ResponseKey(NamedTuple):
+    """Cache key: everything but the prompt is hashed into `scope`"""
+    scope: str
+    prompt: str
+    
+    @property
+    def digest(self) -> str:
+        """Stable key for the persistent tier"""
+        return hashlib.sha256(f"{self.scope}\x00{self.prompt}".encode()).hexdigest()
+
+class _ResponseEntry:
+    __slots__ = ("response", "shingles", "size", "expires_at")
+    
+    def __init__(self, response: str, shingles: FrozenSet[str], size: int, expires_at: float):
+        self.response = response
+        self.shingles = shingles
+        self.size = size
+        self.expires_at = expires_at
+
+class ResponseCache:
+    """
+    LRU/TTL cache of LLM responses in front of OllamaLLM.
+    
+    Key responsibilities:
+    - Key responses on (model, normalized prompt, context hash, options)
+    - Bound memory by total response bytes, evicting least recently used
+    - Optionally match near-duplicate prompts (same model, context and
+      options) by Jaccard similarity of character shingles
+    - Optionally read through to / write through a persistent store
+    - Count exact, near-duplicate and store hits and misses
+    
+    Configured through RESPONSE_CACHE_ENABLED, RESPONSE_CACHE_TTL (seconds),
+    RESPONSE_CACHE_MAX_BYTES and RESPONSE_CACHE_SIMILARITY (0 disables
+    near-duplicate matching, e.g. 0.85 enables it). The persistent tier is
+    used when RESPONSE_CACHE_BACKING=postgres and a store is attached.
+    """
+    
+    # Near-duplicate candidates examined per lookup (most recent first)
+    MAX_SCAN = 256
+    
+    def __init__(self, ttl: Optional[float] = None, max_bytes: Optional[int] = None,
+                 similarity: Optional[float] = None):
+        self.enabled = os.getenv('RESPONSE_CACHE_ENABLED', '1') == '1'
+        self.ttl = ttl or float(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+        self.max_bytes = max_bytes or int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(8 * 1024 * 1024)))
+        self.similarity = similarity if similarity is not None else float(os.getenv('RESPONSE_CACHE_SIMILARITY', '0'))
+        self.store = None
+        self._entries: "OrderedDict[ResponseKey, _ResponseEntry]" = OrderedDict()
+        self._scopes: Dict[str, "OrderedDict[str, None]"] = {}
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.near_hits = 0
+        self.store_hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def attach_store(self, store):
+        """
+        Use `store` as the persistent tier if RESPONSE_CACHE_BACKING=postgres.
+        
+        `store` must provide get_cached_response(digest, max_age) and
+        save_cached_response(digest, response) (see DatabaseManager).
+        """
+        if os.getenv('RESPONSE_CACHE_BACKING', 'memory') == 'postgres':
+            self.store = store
+    
+    def make_key(self, model: str, prompt: str, context: str, options: Dict[str, Any]) -> ResponseKey:
+        """Build the cache key for one generation request"""
+        scope = hashlib.sha256(
+            json.dumps([model, context, options], sort_keys=True).encode()
+        ).hexdigest()
+        return ResponseKey(scope, normalize_prompt(prompt))
+    
+    def _remove(self, key: ResponseKey):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.total_bytes -= entry.size
+        prompts = self._scopes.get(key.scope)
+        if prompts is not None:
+            prompts.pop(key.prompt, None)
+            if not prompts:
+                del self._scopes[key.scope]
+    
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self._entries:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+    
+    def _lookup(self, key: ResponseKey) -> Optional[str]:
+        now = time.monotonic()
+        entry = self._entries.get(key)
+        if entry is not None:
+            if entry.expires_at >= now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry.response
+            self._remove(key)
+        
+        if self.similarity <= 0 or key.scope not in self._scopes:
+            return None
+        
+        shingles = _shingles(key.prompt)
+        best_key, best_score = None, self.similarity
+        for scanned, prompt in enumerate(reversed(self._scopes[key.scope])):
+            if scanned == self.MAX_SCAN:
+                break
+            candidate = self._entries[ResponseKey(key.scope, prompt)]
+            if candidate.expires_at < now:
+                continue
+            overlap = len(shingles & candidate.shingles)
+            score = overlap / (len(shingles) + len(candidate.shingles) - overlap)
+            if score >= best_score:
+                best_key, best_score = ResponseKey(key.scope, prompt), score
+        
+        if best_key is None:
+            return None
+        self._entries.move_to_end(best_key)
+        self.near_hits += 1
+        return self._entries[best_key].response
+    
+    def get(self, key: ResponseKey) -> Optional[str]:
+        """Return a cached response for the key (or a near-duplicate), or None"""
+        if not self.enabled:
+            return None
+        with self._lock:
+            response = self._lookup(key)
+            if response is not None:
+                return response
+        
+        if self.store is not None:
+            try:
+                response = self.store.get_cached_response(key.digest, self.ttl)
+            except Exception as e:
+                print(f"Warning: Response cache store lookup failed: {e}")
+                response = None
+            if response is not None:
+                self._put_local(key, response)
+                with self._lock:
+                    self.store_hits += 1
+                return response
+        
+        with self._lock:
+            self.misses += 1
+        return None
+    
+    def _put_local(self, key: ResponseKey, response: str):
+        with self._lock:
+            self._remove(key)
+            size = len(response) + len(key.prompt)
+            self._entries[key] = _ResponseEntry(
+                response, _shingles(key.prompt), size, time.monotonic() + self.ttl
+            )
+            self._scopes.setdefault(key.scope, OrderedDict())[key.prompt] = None
+            self.total_bytes += size
+            self._evict()
+    
+    def put(self, key: ResponseKey, response: str):
+        """Cache a successful response (and write it to the store, if attached)"""
+        if not self.enabled:
+            return
+        self._put_local(key, response)
+        if self.store is not None:
+            try:
+                self.store.save_cached_response(key.digest, response)
+            except Exception as e:
+                print(f"Warning: Response cache store write failed: {e}")
+    
+    def invalidate(self):
+        """Drop every in-process entry"""
+        with self._lock:
+            self._entries.clear()
+            self._scopes.clear()
+            self.total_bytes = 0
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get hit/miss/eviction counters and current memory use"""
+        with self._lock:
+            return {
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "hits": self.hits,
+                "near_hits": self.near_hits,
+                "store_hits": self.store_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
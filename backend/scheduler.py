@@ -0,0 +1,214 @@
+import os
+import time
+import threading
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Hashable, Iterator, Optional
+
+# Lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 10
+
+class LLMBusyError(Exception):
+    """Raised when a request is shed: queue full or deadline passed while waiting"""
+
+class _Ticket:
+    __slots__ = ("session_id", "priority", "deadline", "enqueued_at", "granted", "event")
+    
+    def __init__(self, session_id: str, priority: int, deadline: float):
+        self.session_id = session_id
+        self.priority = priority
+        self.deadline = deadline
+        self.enqueued_at = time.monotonic()
+        self.granted = False
+        self.event = threading.Event()
+
+class _Flight:
+    """An in-flight call that identical requests wait on instead of repeating"""
+    __slots__ = ("done", "result", "error")
+    
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+class LLMScheduler:
+    """
+    Admission control in front of the LLM server.
+    
+    Key responsibilities:
+    - Cap concurrent LLM calls at LLM_MAX_IN_FLIGHT
+    - Queue the rest fairly: by priority, then round-robin across sessions,
+      FIFO within a session
+    - Shed requests when LLM_MAX_QUEUE is reached or their deadline
+      (LLM_QUEUE_TIMEOUT seconds by default) passes before a slot frees up
+    - Coalesce identical in-flight requests into a single call
+    - Report queue depth, in-flight count and queue wait percentiles
+    """
+    
+    def __init__(self, max_in_flight: Optional[int] = None, max_queue: Optional[int] = None,
+                 queue_timeout: Optional[float] = None):
+        self.max_in_flight = max_in_flight or int(os.getenv('LLM_MAX_IN_FLIGHT', '4'))
+        self.max_queue = max_queue or int(os.getenv('LLM_MAX_QUEUE', '256'))
+        self.queue_timeout = queue_timeout or float(os.getenv('LLM_QUEUE_TIMEOUT', '30'))
+        self._lock = threading.Lock()
+        self._in_flight = 0
+        # priority -> session -> waiting tickets; session order is the round-robin order
+        self._waiting: Dict[int, "OrderedDict[str, Deque[_Ticket]]"] = {}
+        self._queued = 0
+        self._flights: Dict[Hashable, _Flight] = {}
+        self.waits: Deque[float] = deque(maxlen=1000)
+        self.completed = 0
+        self.shed = 0
+        self.coalesced = 0
+    
+    def _next_ticket(self) -> Optional[_Ticket]:
+        """Pop the next waiting ticket (lock held); expired tickets are skipped"""
+        now = time.monotonic()
+        for priority in sorted(self._waiting):
+            sessions = self._waiting[priority]
+            while sessions:
+                session_id, tickets = sessions.popitem(last=False)
+                ticket = tickets.popleft()
+                if tickets:
+                    sessions[session_id] = tickets
+                self._queued -= 1
+                if ticket.deadline < now:
+                    self.shed += 1
+                    ticket.event.set()
+                    continue
+                if not sessions:
+                    del self._waiting[priority]
+                return ticket
+            del self._waiting[priority]
+        return None
+    
+    def _release(self):
+        with self._lock:
+            ticket = self._next_ticket()
+            if ticket is None:
+                self._in_flight -= 1
+                return
+            ticket.granted = True
+            self.waits.append(time.monotonic() - ticket.enqueued_at)
+        ticket.event.set()
+    
+    def _withdraw(self, ticket: _Ticket):
+        """Remove a ticket that gave up waiting (lock held)"""
+        sessions = self._waiting.get(ticket.priority, {})
+        tickets = sessions.get(ticket.session_id)
+        if tickets is not None and ticket in tickets:
+            tickets.remove(ticket)
+            self._queued -= 1
+            if not tickets:
+                del sessions[ticket.session_id]
+            if not sessions:
+                self._waiting.pop(ticket.priority, None)
+    
+    def _acquire(self, session_id: str, priority: int, timeout: Optional[float]):
+        deadline = time.monotonic() + (timeout if timeout is not None else self.queue_timeout)
+        with self._lock:
+            if self._in_flight < self.max_in_flight and not self._queued:
+                self._in_flight += 1
+                self.waits.append(0.0)
+                return
+            if self._queued >= self.max_queue:
+                self.shed += 1
+                raise LLMBusyError("LLM queue is full")
+            ticket = _Ticket(session_id, priority, deadline)
+            self._waiting.setdefault(priority, OrderedDict()).setdefault(session_id, deque()).append(ticket)
+            self._queued += 1
+        
+        ticket.event.wait(max(0.0, deadline - time.monotonic()))
+        with self._lock:
+            if ticket.granted:
+                return
+            if ticket.event.is_set():
+                # Already counted as shed by _next_ticket
+                raise LLMBusyError("LLM queue deadline exceeded")
+            self._withdraw(ticket)
+            self.shed += 1
+        raise LLMBusyError("LLM queue deadline exceeded")
+    
+    @contextmanager
+    def slot(self, session_id: str = "default", priority: int = PRIORITY_INTERACTIVE,
+             timeout: Optional[float] = None) -> Iterator[None]:
+        """
+        Hold one of the LLM_MAX_IN_FLIGHT execution slots.
+        
+        Args:
+            session_id: Session the call belongs to (for fair queueing)
+            priority: PRIORITY_INTERACTIVE, PRIORITY_BACKGROUND or any int
+            timeout: Seconds to wait for a slot (default LLM_QUEUE_TIMEOUT)
+        
+        Raises:
+            LLMBusyError: The request was shed
+        """
+        self._acquire(session_id, priority, timeout)
+        try:
+            yield
+        finally:
+            with self._lock:
+                self.completed += 1
+            self._release()
+    
+    def run(self, key: Optional[Hashable], call: Callable[[], Any], session_id: str = "default",
+            priority: int = PRIORITY_INTERACTIVE, timeout: Optional[float] = None) -> Any:
+        """
+        Run `call` in a slot; concurrent runs with the same key share one call.
+        
+        Args:
+            key: Identity of the request (None disables coalescing)
+            call: Function performing the LLM request
+        
+        Returns:
+            The call's result (the leader's result for coalesced callers)
+        
+        Raises:
+            LLMBusyError: The request was shed
+        """
+        if key is None:
+            with self.slot(session_id, priority, timeout):
+                return call()
+        
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+            else:
+                self.coalesced += 1
+        
+        if not leader:
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        
+        try:
+            with self.slot(session_id, priority, timeout):
+                flight.result = call()
+        except BaseException as e:
+            flight.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result
+    
+    def get_stats(self) -> Dict[str, float]:
+        """Get queue depth, in-flight count, counters and queue wait percentiles (seconds)"""
+        with self._lock:
+            waits = sorted(self.waits)
+            stats = {
+                "in_flight": self._in_flight,
+                "queue_depth": self._queued,
+                "completed": self.completed,
+                "shed": self.shed,
+                "coalesced": self.coalesced,
+            }
+        for name, quantile in (("wait_p50", 0.50), ("wait_p95", 0.95), ("wait_p99", 0.99)):
+            stats[name] = waits[int(quantile * (len(waits) - 1))] if waits else 0.0
+        stats["wait_max"] = waits[-1] if waits else 0.0
+        return stats
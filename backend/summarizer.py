@@ -0,0 +1,120 @@
+import os
+import queue
+import threading
+from typing import Callable, List, Optional, Set, Tuple
+from langchain_core.messages import BaseMessage, HumanMessage, AIMessage
+from .context_builder import ContextBuilder
+
+class ConversationSummarizer:
+    """
+    Background worker that compacts old turns into a per-session summary.
+    
+    Key responsibilities:
+    - Accept summarization requests without blocking the chat request path
+    - Fold every message the prompt no longer includes into the stored
+      summary, oldest first, in batches through the LLM
+    - Find those messages with the chat's own ContextBuilder: of the last
+      `keep_recent` messages (what a turn loads), the ones that don't fit
+      next to the summary, and everything older
+    - Re-check after each batch, since a longer summary leaves room for
+      fewer recent turns
+    
+    `db_manager` must provide get_chat_history() and `llm` must provide
+    summarize_conversation(transcript, previous_summary), so tests can pass
+    stubs. Configured through SUMMARY_BATCH_SIZE.
+    """
+    
+    def __init__(self, db_manager, llm, keep_recent: int,
+                 on_summary: Optional[Callable[[str, str], None]] = None,
+                 context_builder: Optional[ContextBuilder] = None):
+        self.db_manager = db_manager
+        self.llm = llm
+        self.keep_recent = keep_recent
+        self.on_summary = on_summary
+        self.context_builder = context_builder or ContextBuilder()
+        self.batch_size = int(os.getenv('SUMMARY_BATCH_SIZE', '40'))
+        self._queue: "queue.Queue[Optional[str]]" = queue.Queue()
+        self._pending: Set[str] = set()
+        self._lock = threading.Lock()
+        self._worker: Optional[threading.Thread] = None
+    
+    def schedule(self, session_id: str):
+        """Queue a session for summarization (no-op if already queued)"""
+        with self._lock:
+            if session_id in self._pending:
+                return
+            self._pending.add(session_id)
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="conversation-summarizer", daemon=True)
+                self._worker.start()
+        self._queue.put(session_id)
+    
+    def _run(self):
+        while True:
+            session_id = self._queue.get()
+            try:
+                if session_id is None:
+                    return
+                with self._lock:
+                    self._pending.discard(session_id)
+                self.summarize(session_id)
+            except Exception as e:
+                print(f"Warning: Summarization of session {session_id} failed: {e}")
+            finally:
+                self._queue.task_done()
+    
+    def _format_transcript(self, rows: List[Tuple[int, BaseMessage]]) -> str:
+        lines = []
+        for _, message in rows:
+            if isinstance(message, HumanMessage):
+                lines.append(f"Human: {message.content}")
+            elif isinstance(message, AIMessage):
+                lines.append(f"Assistant: {message.content}")
+        return "\n".join(lines)
+    
+    def _window_start(self, recent: List[Tuple[int, BaseMessage]], summary: str) -> int:
+        """Id of the oldest message a prompt with this summary includes (past the end if none)"""
+        turns = [(id_, message) for id_, message in recent if isinstance(message, (HumanMessage, AIMessage))]
+        included = self.context_builder.build([message for _, message in turns], summary).message_count
+        if included:
+            return turns[-included][0]
+        return recent[-1][0] + 1 if recent else 0
+    
+    def summarize(self, session_id: str) -> bool:
+        """
+        Fold all unsummarized messages the prompt no longer includes into the summary.
+        
+        Returns:
+            True if the stored summary was updated
+        """
+        history = self.db_manager.get_chat_history(session_id)
+        summary, through_id = history.get_summary_state()
+        recent = history.get_messages_page(self.keep_recent)
+        
+        updated = False
+        while True:
+            cutoff = self._window_start(recent, summary)
+            rows = history.get_messages_range(through_id, cutoff, self.batch_size)
+            if not rows:
+                break
+            new_summary = self.llm.summarize_conversation(self._format_transcript(rows), summary)
+            if not new_summary:
+                break
+            summary, through_id = new_summary, rows[-1][0]
+            history.save_summary(summary, through_id)
+            updated = True
+        
+        if updated and self.on_summary is not None:
+            self.on_summary(history.session_id, summary)
+        return updated
+    
+    def join(self):
+        """Wait until every queued session has been processed"""
+        self._queue.join()
+    
+    def stop(self):
+        """Stop the worker after the sessions already queued and wait for it"""
+        if self._worker is not None:
+            self._queue.put(None)
+            if self._worker is not threading.current_thread():
+                self._worker.join()
\ No newline at end of file
@@ -0,0 +1,147 @@
+import os
+import atexit
+import threading
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from langchain_core.messages import BaseMessage
+
+class MessageWriteBuffer:
+    """
+    Write-behind buffer that persists many sessions' messages in bulk.
+    
+    Key responsibilities:
+    - Accept finished turns without a database round-trip on the request path
+    - Flush every buffered message in one COPY when WRITE_BUFFER_MAX_MESSAGES
+      is reached or WRITE_BUFFER_FLUSH_INTERVAL seconds have passed
+    - Keep failed batches buffered (in order) and retry every
+      WRITE_BUFFER_FLUSH_INTERVAL seconds until the database is back
+    - Hold at most WRITE_BUFFER_MAX_PENDING messages, dropping (and
+      counting) the oldest ones during a long outage
+    - Flush on close() and at interpreter exit
+    
+    Messages acknowledged but not yet flushed are lost if the process
+    crashes; ChatService only uses the buffer when CHAT_WRITE_MODE=buffered.
+    `db_manager` must provide add_messages_bulk(rows), so tests can pass stubs.
+    """
+    
+    def __init__(self, db_manager, max_messages: Optional[int] = None,
+                 flush_interval: Optional[float] = None, max_pending: Optional[int] = None):
+        self.db_manager = db_manager
+        self.max_messages = max_messages or int(os.getenv('WRITE_BUFFER_MAX_MESSAGES', '200'))
+        self.flush_interval = flush_interval or float(os.getenv('WRITE_BUFFER_FLUSH_INTERVAL', '1.0'))
+        self.max_pending = max_pending or int(os.getenv('WRITE_BUFFER_MAX_PENDING', str(self.max_messages * 50)))
+        self._pending: List[Tuple[str, BaseMessage]] = []
+        self._inflight: List[Tuple[str, BaseMessage]] = []
+        # Pending + in-flight messages per session, so has_pending() is O(1)
+        self._counts: Counter = Counter()
+        # Set while the database is failing: size triggers wait for the next interval
+        self._failing = False
+        self._lock = threading.Lock()
+        # Serializes flushes so batches reach the database in order
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._closed = threading.Event()
+        self._worker: Optional[threading.Thread] = None
+        self.flushes = 0
+        self.flushed_messages = 0
+        self.failures = 0
+        self.dropped = 0
+    
+    def _forget(self, rows: List[Tuple[str, BaseMessage]]):
+        """Stop counting rows that were written or dropped (lock held)"""
+        for session_id, _ in rows:
+            self._counts[session_id] -= 1
+            if not self._counts[session_id]:
+                del self._counts[session_id]
+    
+    def _trim(self):
+        """Drop the oldest pending messages beyond max_pending (lock held)"""
+        excess = len(self._pending) + len(self._inflight) - self.max_pending
+        if excess > 0:
+            dropped, self._pending = self._pending[:excess], self._pending[excess:]
+            self._forget(dropped)
+            self.dropped += len(dropped)
+    
+    def add(self, session_id: str, messages: List[BaseMessage]):
+        """Buffer messages of a session (UUID); they are written on the next flush"""
+        with self._lock:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="message-writer", daemon=True)
+                self._worker.start()
+                atexit.register(self.close)
+            self._pending.extend((session_id, message) for message in messages)
+            self._counts[session_id] += len(messages)
+            self._trim()
+            full = len(self._pending) >= self.max_messages and not self._failing
+        if full:
+            self._wakeup.set()
+    
+    def has_pending(self, session_id: str) -> bool:
+        """Whether a session has messages not yet committed to the database"""
+        with self._lock:
+            return session_id in self._counts
+    
+    def flush(self) -> int:
+        """
+        Write every buffered message in one transaction.
+        
+        Returns:
+            Number of messages written
+        
+        Raises:
+            The database error; the batch stays buffered for the next flush,
+            up to max_pending messages
+        """
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, []
+                self._inflight = batch
+            if not batch:
+                return 0
+            
+            try:
+                self.db_manager.add_messages_bulk(batch)
+            except Exception:
+                with self._lock:
+                    self._pending[:0] = batch
+                    self._inflight = []
+                    self.failures += 1
+                    self._failing = True
+                    self._trim()
+                raise
+            
+            with self._lock:
+                self._inflight = []
+                self._failing = False
+                self._forget(batch)
+                self.flushes += 1
+                self.flushed_messages += len(batch)
+            return len(batch)
+    
+    def _run(self):
+        while not self._closed.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Warning: Flushing buffered messages failed: {e}")
+    
+    def close(self):
+        """Stop the worker and flush whatever is still buffered"""
+        self._closed.set()
+        self._wakeup.set()
+        if self._worker is not None and self._worker is not threading.current_thread():
+            self._worker.join()
+        self.flush()
+    
+    def get_stats(self) -> Dict[str, int]:
+        """Get buffer depth and flush counters"""
+        with self._lock:
+            return {
+                "pending": len(self._pending) + len(self._inflight),
+                "flushes": self.flushes,
+                "flushed_messages": self.flushed_messages,
+                "failures": self.failures,
+                "dropped": self.dropped,
+            }
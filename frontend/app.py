@@ -1,11 +1,19 @@
 import streamlit as st
-import sys
 import os
+import json
+import uuid
+import requests
 
-# Add backend to path
-sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
-
-from backend.chat_service import ChatService
+# Chat API server (see backend/api.py)
+API_URL = os.getenv('CHAT_API_URL', 'http://localhost:8000').rstrip("/")
+# Owner of the conversations when the URL names none (single-user deployments)
+DEFAULT_USER_ID = os.getenv('CHAT_USER_ID')
+# Sessions listed per sidebar page
+SESSION_PAGE_SIZE = int(os.getenv('CHAT_SESSION_PAGE_SIZE', '20'))
+# (human, ai) pairs fetched per history page
+HISTORY_PAGE_SIZE = int(os.getenv('CHAT_HISTORY_PAGE_SIZE', '20'))
+# Seconds a health probe result is reused across reruns and browser sessions
+HEALTH_TTL = float(os.getenv('CHAT_HEALTH_TTL', '30'))
 
 # Page configuration
 st.set_page_config(
@@ -14,83 +22,213 @@ st.set_page_config(
     layout="wide"
 )
 
-def initialize_chat_service():
-    """Initialize chat service with error handling"""
+@st.cache_resource
+def get_http_session() -> requests.Session:
+    """One keep-alive HTTP session shared by every browser session"""
+    return requests.Session()
+
+def new_session_id() -> str:
+    """Id for a new conversation; the server records it (under the user) with its first message"""
+    return str(uuid.uuid4())
+
+def load_sessions_page(user_id: str, cursor=None):
+    """Fetch one page of the user's sessions (most recent first) and the next cursor"""
+    params = {"limit": SESSION_PAGE_SIZE}
+    if cursor is not None:
+        params["cursor"] = cursor
+    response = get_http_session().get(f"{API_URL}/users/{user_id}/sessions", params=params, timeout=30)
+    response.raise_for_status()
+    page = response.json()
+    return page["sessions"], page["next_cursor"]
+
+def current_identity():
+    """
+    (user id, session id) from the URL, filled in on first visit.
+
+    The ids live in the query string (?user=...&session=...), so a
+    bookmarked or reloaded page returns to the same user and conversation.
+    A new user gets a random id; a user without a session resumes their
+    most recent one, or starts a new one. Nothing is written until the
+    first message, so visits that never chat leave no empty sessions.
+    """
+    user_id = st.query_params.get("user") or DEFAULT_USER_ID or uuid.uuid4().hex
+    session_id = st.query_params.get("session")
+    if not session_id:
+        sessions, _ = load_sessions_page(user_id)
+        session_id = sessions[0]["session_id"] if sessions else new_session_id()
+    st.query_params["user"] = user_id
+    st.query_params["session"] = session_id
+    return user_id, session_id
+
+def switch_session(session_id: str):
+    """Show another conversation: its history is loaded on the next run"""
+    st.query_params["session"] = session_id
+    for key in ("messages", "history_cursor", "session_pages"):
+        st.session_state.pop(key, None)
+    st.rerun()
+
+def load_history_page(session_id: str, before_id=None):
+    """Fetch one page of (human, ai) pairs older than `before_id` and the next cursor"""
+    params = {"limit": HISTORY_PAGE_SIZE}
+    if before_id is not None:
+        params["before_id"] = before_id
+    response = get_http_session().get(f"{API_URL}/sessions/{session_id}/history", params=params, timeout=30)
+    response.raise_for_status()
+    page = response.json()
+    messages = []
+    for human_msg, ai_msg in page["pairs"]:
+        messages.append({"role": "user", "content": human_msg})
+        messages.append({"role": "assistant", "content": ai_msg})
+    return messages, page["next_before_id"]
+
+def stream_reply(prompt: str, user_id: str, session_id: str):
+    """Yield reply tokens from the API's Server-Sent Events stream (the session is listed under `user_id`)"""
+    with get_http_session().post(
+        f"{API_URL}/chat/stream",
+        json={"message": prompt, "session_id": session_id, "owner": user_id},
+        stream=True,
+        timeout=(5, 300)
+    ) as response:
+        response.raise_for_status()
+        event = None
+        for line in response.iter_lines(decode_unicode=True):
+            if line.startswith("event: "):
+                event = line[len("event: "):]
+            elif line.startswith("data: ") and event == "token":
+                yield json.loads(line[len("data: "):])["token"]
+
+@st.cache_data(ttl=HEALTH_TTL, show_spinner=False)
+def check_health() -> dict:
+    """API and database status (probed at most every HEALTH_TTL seconds); empty if unreachable"""
     try:
-        return ChatService()
-    except Exception as e:
-        st.error(f"Failed to initialize chat service: {e}")
-        st.stop()
+        return get_http_session().get(f"{API_URL}/health", timeout=5).json()
+    except (requests.RequestException, ValueError):
+        return {}
+
+@st.fragment
+def render_sessions(user_id: str, session_id: str):
+    """Sidebar list of the user's sessions, a page at a time, most recent first"""
+    if st.button("➕ New chat", use_container_width=True):
+        switch_session(new_session_id())
+
+    if "session_pages" not in st.session_state:
+        st.session_state.session_pages = [load_sessions_page(user_id)]
+    for sessions, _ in st.session_state.session_pages:
+        for session in sessions:
+            current = session["session_id"] == session_id
+            if st.button(session["title"] or "New chat", key=f"session-{session['session_id']}",
+                         type="primary" if current else "secondary", use_container_width=True,
+                         disabled=current):
+                switch_session(session["session_id"])
+
+    cursor = st.session_state.session_pages[-1][1]
+    if cursor is not None:
+        # Runs before the rerun, so the new page renders right away
+        st.button("More sessions", use_container_width=True,
+                  on_click=lambda: st.session_state.session_pages.append(load_sessions_page(user_id, cursor)))
+
+@st.fragment
+def render_history(session_id: str):
+    """
+    Render the loaded messages, with a button fetching the next older page.
+
+    Only loaded pages are rendered, and paging reruns just this fragment.
+    """
+    if st.session_state.history_cursor is not None:
+        if st.button("Load older messages"):
+            try:
+                older, st.session_state.history_cursor = load_history_page(
+                    session_id, st.session_state.history_cursor
+                )
+                st.session_state.messages[:0] = older
+            except Exception as e:
+                st.warning(f"Could not load older messages: {e}")
+
+    # Turns sent during the last full run are still on screen below the
+    # fragment; rendering them here too would show them twice
+    messages = st.session_state.messages
+    for message in messages[:len(messages) - st.session_state.live_messages]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
 
 def main():
     st.title("🤖 AI Chatbot with Memory")
     st.write("Chat with an AI assistant powered by local LLM and persistent memory")
-    
-    # Initialize chat service
-    if 'chat_service' not in st.session_state:
-        st.session_state.chat_service = initialize_chat_service()
-    
-    # Initialize session state for messages
+
+    try:
+        user_id, session_id = current_identity()
+    except Exception as e:
+        st.error(f"❌ Chat API unreachable at {API_URL}: {e}")
+        return
+
+    # Load only the newest page; older pages are fetched on demand
     if 'messages' not in st.session_state:
         st.session_state.messages = []
-        # Load existing history
+        st.session_state.history_cursor = None
         try:
-            history = st.session_state.chat_service.get_chat_history()
-            for human_msg, ai_msg in history:
-                st.session_state.messages.append({"role": "user", "content": human_msg})
-                st.session_state.messages.append({"role": "assistant", "content": ai_msg})
+            st.session_state.messages, st.session_state.history_cursor = load_history_page(session_id)
         except Exception as e:
             st.warning(f"Could not load chat history: {e}")
-    
+
     # Sidebar with controls
     with st.sidebar:
+        st.header("Conversations")
+        render_sessions(user_id, session_id)
+
+        st.divider()
         st.header("Chat Controls")
-        
+
         if st.button("Clear Chat History", type="secondary"):
             try:
-                st.session_state.chat_service.clear_history()
+                get_http_session().delete(
+                    f"{API_URL}/sessions/{session_id}/history", timeout=30
+                ).raise_for_status()
                 st.session_state.messages = []
+                st.session_state.history_cursor = None
                 st.success("Chat history cleared!")
                 st.rerun()
             except Exception as e:
                 st.error(f"Failed to clear history: {e}")
-        
+
         st.divider()
         st.subheader("System Status")
-        
+
         # Check system status
-        try:
-            # Test database connection
-            st.session_state.chat_service.db_manager.get_chat_history("test")
+        health = check_health()
+        if not health:
+            st.error(f"❌ Chat API unreachable at {API_URL}")
+        elif health.get("database"):
             st.success("✅ Database connected")
-        except:
+        else:
             st.error("❌ Database connection failed")
-        
+
         st.info("💡 Ollama service required for AI responses")
-    
-    # Display chat messages
-    for message in st.session_state.messages:
-        with st.chat_message(message["role"]):
-            st.markdown(message["content"])
-    
+
+    st.session_state.live_messages = 0
+    render_history(session_id)
+
     # Chat input
     if prompt := st.chat_input("Type your message here..."):
         # Add user message to chat
         st.session_state.messages.append({"role": "user", "content": prompt})
+        st.session_state.live_messages += 1
         with st.chat_message("user"):
             st.markdown(prompt)
-        
+
         # Generate and display assistant response
         with st.chat_message("assistant"):
-            with st.spinner("Thinking..."):
-                try:
-                    response = st.session_state.chat_service.chat(prompt)
-                    st.markdown(response)
-                    st.session_state.messages.append({"role": "assistant", "content": response})
-                except Exception as e:
-                    error_msg = f"Sorry, I encountered an error: {str(e)}"
-                    st.error(error_msg)
-                    st.session_state.messages.append({"role": "assistant", "content": error_msg})
+            try:
+                # Render tokens as they arrive instead of waiting for the full reply
+                response = st.write_stream(stream_reply(prompt, user_id, session_id))
+                st.session_state.messages.append({"role": "assistant", "content": response})
+                st.session_state.live_messages += 1
+                # This session moved to the top of the list (and may have a title now)
+                st.session_state.pop("session_pages", None)
+            except Exception as e:
+                error_msg = f"Sorry, I encountered an error: {str(e)}"
+                st.error(error_msg)
+                st.session_state.messages.append({"role": "assistant", "content": error_msg})
+                st.session_state.live_messages += 1
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
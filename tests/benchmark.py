@@ -0,0 +1,599 @@
+"""
+Load-testing harness for ChatService.
+
+Runs N sessions x M turns against a local stub Ollama and an ephemeral
+Postgres database, then reports latency percentiles, throughput, database
+connection use and memory, optionally saving the results as JSON so runs of
+different commits can be compared.
+
+Usage:
+    python -m tests.benchmark --sessions 20 --turns 5 --output before.json
+    python -m tests.benchmark --mode open --rate 40 --stream --output after.json
+    python -m tests.benchmark --compare before.json after.json
+    python -m tests.benchmark --search-rows 10000000 --output search.json
+
+The ephemeral database is created (and dropped afterwards) on the server
+configured by POSTGRES_HOST/PORT/USER/PASSWORD, so the role needs CREATEDB.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import platform
+import threading
+import subprocess
+import concurrent.futures
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, Iterator, List, Optional
+from unittest.mock import patch
+
+import psycopg
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+
+from backend.chat_service import ChatService
+from backend.database import DatabaseManager
+from backend.generation import FailedGeneration
+from langchain_core.messages import HumanMessage
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+class StubOllama:
+    """
+    In-process Ollama stand-in serving /api/tags, /api/generate, /api/chat and /api/embed.
+    
+    Each generation waits `latency` seconds (prefill), then produces
+    `reply_tokens` tokens (fewer if options.num_predict asks for fewer) at
+    `token_rate` tokens/sec (0 for instant), streamed
+    as NDJSON when the request asks for it. Final responses carry the
+    eval_count/eval_duration and prompt_eval_* fields Ollama reports. With
+    a `status` other than 200, generations fail with that status after the
+    prefill wait. Peak concurrency and request counts are tracked for
+    assertions.
+    """
+    
+    def __init__(self, latency: float = 0.05, token_rate: float = 200.0, reply_tokens: int = 20,
+                 model: Optional[str] = None, status: int = 200):
+        self.latency = latency
+        self.status = status
+        self.token_rate = token_rate
+        self.reply_tokens = reply_tokens
+        self.model = model or os.getenv('MODEL_NAME', 'llama2:7b-chat')
+        self.requests = 0
+        self.active = 0
+        self.peak = 0
+        self._lock = threading.Lock()
+        self._server: Optional[ThreadingHTTPServer] = None
+    
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self._server.server_address[1]}"
+    
+    def start(self) -> "StubOllama":
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, name="stub-ollama", daemon=True).start()
+        return self
+    
+    def stop(self):
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+    
+    def __enter__(self) -> "StubOllama":
+        return self.start()
+    
+    def __exit__(self, *exc_info):
+        self.stop()
+    
+    def _final_fields(self, prompt_chars: int, reply_tokens: int) -> Dict[str, Any]:
+        eval_seconds = reply_tokens / self.token_rate if self.token_rate else 0.001
+        return {
+            "done": True,
+            "eval_count": reply_tokens,
+            "eval_duration": int(eval_seconds * 1e9),
+            "prompt_eval_count": max(prompt_chars // 4, 1),
+            "prompt_eval_duration": int(self.latency * 1e9),
+        }
+    
+    def _handler(self):
+        stub = self
+        
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            
+            def log_message(self, *args):
+                pass
+            
+            def _reply(self, body: Dict[str, Any], status: int = 200):
+                data = json.dumps(body).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+            
+            def _chunk(self, body: Dict[str, Any]):
+                line = (json.dumps(body) + "\n").encode()
+                self.wfile.write(b"%x\r\n%s\r\n" % (len(line), line))
+                self.wfile.flush()
+            
+            def do_GET(self):
+                self._reply({"models": [{"name": stub.model}]})
+            
+            def do_POST(self):
+                request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+                if self.path == "/api/embed":
+                    texts = request["input"] if isinstance(request["input"], list) else [request["input"]]
+                    self._reply({"embeddings": [[float(len(text) % 7), 1.0, 0.5, 0.25] for text in texts]})
+                    return
+                
+                with stub._lock:
+                    stub.requests += 1
+                    stub.active += 1
+                    stub.peak = max(stub.peak, stub.active)
+                try:
+                    self._generate(request)
+                finally:
+                    with stub._lock:
+                        stub.active -= 1
+            
+            def _generate(self, request: Dict[str, Any]):
+                chat = self.path == "/api/chat"
+                prompt = (json.dumps(request["messages"]) if chat else request.get("prompt", ""))
+                limit = request.get("options", {}).get("num_predict", -1)
+                count = stub.reply_tokens if limit < 0 else min(stub.reply_tokens, limit)
+                tokens = [f"token{i} " for i in range(count)]
+                per_token = 1 / stub.token_rate if stub.token_rate else 0.0
+                time.sleep(stub.latency)
+                if stub.status != 200:
+                    self._reply({"error": "stub failure"}, stub.status)
+                    return
+                
+                def body(text: str) -> Dict[str, Any]:
+                    if chat:
+                        return {"message": {"role": "assistant", "content": text}, "done": False}
+                    return {"response": text, "done": False}
+                
+                if not request.get("stream"):
+                    time.sleep(per_token * len(tokens))
+                    self._reply({**body("".join(tokens)), **stub._final_fields(len(prompt), count)})
+                    return
+                
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                try:
+                    for token in tokens:
+                        time.sleep(per_token)
+                        self._chunk(body(token))
+                    self._chunk({**body(""), **stub._final_fields(len(prompt), count)})
+                    self.wfile.write(b"0\r\n\r\n")
+                except ConnectionError:
+                    # The client cancelled: stop generating, as Ollama does
+                    self.close_connection = True
+        
+        return Handler
+
+def _admin_url() -> str:
+    user = os.getenv('POSTGRES_USER', 'chatbot_user')
+    password = os.getenv('POSTGRES_PASSWORD', 'chatbot_password')
+    host = os.getenv('POSTGRES_HOST', 'localhost')
+    port = os.getenv('POSTGRES_PORT', '5434')
+    return f"postgresql://{user}:{password}@{host}:{port}/{os.getenv('POSTGRES_DB', 'chatbot_db')}"
+
+@contextmanager
+def ephemeral_database() -> Iterator[str]:
+    """Create a throwaway database, point POSTGRES_DB at it, and drop it afterwards"""
+    name = f"chatbot_bench_{uuid.uuid4().hex[:12]}"
+    with psycopg.connect(_admin_url(), autocommit=True) as conn:
+        conn.execute(f'CREATE DATABASE "{name}" ENCODING \'UTF8\' TEMPLATE template0')
+    try:
+        with patch.dict(os.environ, {"POSTGRES_DB": name}):
+            yield name
+    finally:
+        with psycopg.connect(_admin_url(), autocommit=True) as conn:
+            conn.execute(f'DROP DATABASE IF EXISTS "{name}" WITH (FORCE)')
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    ordered = sorted(samples)
+    if not ordered:
+        return {}
+    return {
+        "count": len(ordered),
+        "mean": sum(ordered) / len(ordered),
+        "p50": ordered[int(0.50 * (len(ordered) - 1))],
+        "p95": ordered[int(0.95 * (len(ordered) - 1))],
+        "p99": ordered[int(0.99 * (len(ordered) - 1))],
+        "max": ordered[-1],
+    }
+
+def _rss_peak_mb() -> Optional[float]:
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True,
+            cwd=os.path.dirname(__file__), check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+class _ConnectionSampler:
+    """Samples client pool and server connection counts while a run is in progress"""
+    
+    def __init__(self, service: ChatService, database: str, interval: float = 0.05):
+        self.service = service
+        self.database = database
+        self.interval = interval
+        self.pool_in_use_peak = 0
+        self.requests_waiting_peak = 0
+        self.server_connections_peak = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="bench-sampler", daemon=True)
+    
+    def _run(self):
+        with psycopg.connect(_admin_url(), autocommit=True) as conn:
+            while not self._stop.wait(self.interval):
+                stats = self.service.db_manager.pool.get_stats()
+                self.pool_in_use_peak = max(
+                    self.pool_in_use_peak, stats.get("pool_size", 0) - stats.get("pool_available", 0)
+                )
+                self.requests_waiting_peak = max(self.requests_waiting_peak, stats.get("requests_waiting", 0))
+                count = conn.execute(
+                    "SELECT count(*) FROM pg_stat_activity WHERE datname = %s", (self.database,)
+                ).fetchone()[0]
+                self.server_connections_peak = max(self.server_connections_peak, count)
+    
+    def __enter__(self) -> "_ConnectionSampler":
+        self._thread.start()
+        return self
+    
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+def _timed_turn(service: ChatService, session_id: str, message: str, stream: bool,
+                scheduled: float) -> Dict[str, Any]:
+    """Run one turn; latency is measured from its scheduled start"""
+    first_token = None
+    if stream:
+        parts = []
+        for token in service.chat_stream(message, session_id):
+            if first_token is None:
+                first_token = time.perf_counter() - scheduled
+            parts.append(token)
+    else:
+        parts = [service.chat(message, session_id)]
+    return {
+        "latency": time.perf_counter() - scheduled,
+        "first_token": first_token,
+        "error": any(isinstance(part, FailedGeneration) for part in parts),
+    }
+
+def _message(session: int, turn: int) -> str:
+    return f"Session {session}, turn {turn}: what did I tell you about topic {turn % 7}?"
+
+def _closed_loop(service: ChatService, sessions: int, turns: int, stream: bool,
+                 think_time: float, prefix: str) -> List[Dict[str, Any]]:
+    """Every session sends its next turn as soon as the previous reply (plus think time) is done"""
+    def run_session(session: int) -> List[Dict[str, Any]]:
+        samples = []
+        for turn in range(turns):
+            samples.append(_timed_turn(service, f"{prefix}{session}", _message(session, turn),
+                                       stream, time.perf_counter()))
+            if think_time:
+                time.sleep(think_time)
+        return samples
+    
+    with concurrent.futures.ThreadPoolExecutor(max_workers=sessions) as executor:
+        return [sample for samples in executor.map(run_session, range(sessions)) for sample in samples]
+
+def _open_loop(service: ChatService, sessions: int, turns: int, stream: bool, rate: float,
+               seed: int, prefix: str) -> List[Dict[str, Any]]:
+    """
+    Turns arrive as a Poisson process at `rate` per second regardless of replies.
+    
+    Latency counts from the scheduled arrival, so time spent queued behind a
+    slow system is not hidden (no coordinated omission).
+    """
+    rng = random.Random(seed)
+    total = sessions * turns
+    futures = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=min(total, 256)) as executor:
+        arrival = time.perf_counter()
+        for k in range(total):
+            arrival += rng.expovariate(rate)
+            delay = arrival - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            session, turn = k % sessions, k // sessions
+            futures.append(executor.submit(
+                _timed_turn, service, f"{prefix}{session}", _message(session, turn), stream, arrival
+            ))
+        return [future.result() for future in futures]
+
+def run_benchmark(sessions: int = 10, turns: int = 5, mode: str = "closed", rate: float = 10.0,
+                  stream: bool = False, think_time: float = 0.0, latency: float = 0.05,
+                  token_rate: float = 200.0, reply_tokens: int = 20, seed: int = 0,
+                  env: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """
+    Drive one ChatService with N sessions x M turns and collect results.
+    
+    Args:
+        sessions, turns: Load shape (N x M)
+        mode: "closed" (sessions wait for replies) or "open" (Poisson arrivals at `rate`/sec)
+        stream: Use chat_stream and also report time-to-first-token
+        think_time: Pause between a session's turns in closed mode (seconds)
+        latency, token_rate, reply_tokens: Stub Ollama behaviour
+        seed: Seed of the open-loop arrival process
+        env: Extra environment for the service (e.g. LLM_MAX_IN_FLIGHT)
+    
+    Returns:
+        JSON-serializable results (see save_results)
+    """
+    config = {
+        "sessions": sessions, "turns": turns, "mode": mode, "rate": rate, "stream": stream,
+        "think_time": think_time, "latency": latency, "token_rate": token_rate,
+        "reply_tokens": reply_tokens, "seed": seed, "env": env or {},
+    }
+    with StubOllama(latency, token_rate, reply_tokens) as stub, ephemeral_database() as database:
+        with patch.dict(os.environ, {"OLLAMA_BASE_URL": stub.url, **(env or {})}):
+            service = ChatService()
+            # Unique per run so response caches never serve earlier runs
+            prefix = f"bench-{uuid.uuid4().hex[:8]}-"
+            try:
+                started = time.perf_counter()
+                with _ConnectionSampler(service, database) as sampler:
+                    if mode == "open":
+                        samples = _open_loop(service, sessions, turns, stream, rate, seed, prefix)
+                    else:
+                        samples = _closed_loop(service, sessions, turns, stream, think_time, prefix)
+                elapsed = time.perf_counter() - started
+                pool_stats = service.db_manager.pool.get_stats()
+                stages = service.metrics.get_stats()
+            finally:
+                service.close()
+    
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "config": config,
+        "turns": len(samples),
+        "errors": sum(sample["error"] for sample in samples),
+        "elapsed_seconds": elapsed,
+        "throughput": len(samples) / elapsed,
+        "latency": _percentiles([sample["latency"] for sample in samples]),
+        "first_token": _percentiles([s["first_token"] for s in samples if s["first_token"] is not None]),
+        "database": {
+            "pool_in_use_peak": sampler.pool_in_use_peak,
+            "requests_waiting_peak": sampler.requests_waiting_peak,
+            "server_connections_peak": sampler.server_connections_peak,
+            "connections_opened": pool_stats.get("connections_num", 0),
+            "pool_requests": pool_stats.get("requests_num", 0),
+            "pool_wait_ms": pool_stats.get("requests_wait_ms", 0),
+        },
+        "memory": {"rss_peak_mb": _rss_peak_mb()},
+        "llm": {"requests": stub.requests, "peak_concurrency": stub.peak},
+        "stages": stages,
+    }
+
+# Synthetic search corpus: word i of the vocabulary is drawn with a skew so
+# term0 is in most messages and the last term in under 1%
+SEARCH_VOCABULARY = 500
+SEARCH_WORDS_PER_MESSAGE = 12
+SEARCH_MESSAGES_PER_SESSION = 50
+SEARCH_SESSIONS_PER_OWNER = 20
+SEARCH_LOAD_CHUNK = 1000000
+SEARCH_TERMS = {
+    "common": "term0",
+    "medium": "term40",
+    "rare": f"term{SEARCH_VOCABULARY - 1}",
+    "phrase": '"term1 term2"',
+}
+
+def _load_search_corpus(conn: psycopg.Connection, rows: int):
+    """Insert `rows` messages (and their owned sessions) server-side, a chunk per statement"""
+    sessions = -(-rows // SEARCH_MESSAGES_PER_SESSION)
+    conn.execute(
+        "INSERT INTO chat_sessions (session_id, owner) "
+        "SELECT md5('session-' || s)::uuid, 'owner-' || (s / %s) FROM generate_series(0, %s) AS s",
+        (SEARCH_SESSIONS_PER_OWNER, sessions - 1)
+    )
+    for start in range(0, rows, SEARCH_LOAD_CHUNK):
+        conn.execute(
+            "INSERT INTO chat_history (session_id, role, content, token_count) "
+            "SELECT md5('session-' || (m / %(per_session)s))::uuid, m %% 2, "
+            "(SELECT string_agg('term' || floor(%(vocabulary)s * power(random(), 3))::int, ' ') "
+            " FROM generate_series(1, %(words)s) WHERE m >= 0), %(words)s "
+            "FROM generate_series(%(start)s, %(end)s) AS m",
+            {"per_session": SEARCH_MESSAGES_PER_SESSION, "vocabulary": SEARCH_VOCABULARY,
+             "words": SEARCH_WORDS_PER_MESSAGE, "start": start, "end": min(start + SEARCH_LOAD_CHUNK, rows) - 1}
+        )
+        conn.commit()
+    conn.execute("ANALYZE chat_history")
+    conn.execute("ANALYZE chat_sessions")
+    conn.commit()
+
+def run_search_benchmark(rows: int = 1000000, queries: int = 50, inserts: int = 200,
+                         seed: int = 0) -> Dict[str, Any]:
+    """
+    Time full-text search over a synthetic history of `rows` messages.
+    
+    Each term of SEARCH_TERMS is searched `queries` times in a random
+    session and a random owner's sessions (first page, then the next page
+    by cursor); single-message inserts are timed against the loaded index.
+    
+    Returns:
+        JSON-serializable results: load time, and latency percentiles per
+        scope/term and for inserts
+    """
+    rng = random.Random(seed)
+    sessions = -(-rows // SEARCH_MESSAGES_PER_SESSION)
+    owners = -(-sessions // SEARCH_SESSIONS_PER_OWNER)
+    session_id = lambda: str(uuid.UUID(hashlib.md5(f"session-{rng.randrange(sessions)}".encode()).hexdigest()))
+    with ephemeral_database():
+        db_manager = DatabaseManager()
+        try:
+            started = time.perf_counter()
+            with psycopg.connect(_admin_url()) as conn:
+                _load_search_corpus(conn, rows)
+                index_bytes = conn.execute("SELECT SUM(pg_relation_size(relid))::bigint "
+                                           "FROM pg_partition_tree('idx_chat_history_search')").fetchone()[0]
+            load_seconds = time.perf_counter() - started
+            
+            search: Dict[str, Dict[str, Any]] = {}
+            for term_name, query in SEARCH_TERMS.items():
+                for scope in ("session", "owner"):
+                    first, following, hits = [], [], 0
+                    for _ in range(queries):
+                        scope_args = ({"session_id": session_id()} if scope == "session"
+                                      else {"owner": f"owner-{rng.randrange(owners)}"})
+                        started = time.perf_counter()
+                        page, cursor = db_manager.search_messages(query, limit=20, **scope_args)
+                        first.append(time.perf_counter() - started)
+                        hits += len(page)
+                        if cursor is not None:
+                            started = time.perf_counter()
+                            db_manager.search_messages(query, limit=20, cursor=cursor, **scope_args)
+                            following.append(time.perf_counter() - started)
+                    search[f"{scope}/{term_name}"] = {
+                        "first_page": _percentiles(first),
+                        "next_page": _percentiles(following),
+                        "hits_per_page": hits / queries,
+                    }
+            
+            insert_latency = []
+            for i in range(inserts):
+                history = db_manager.get_chat_history(session_id())
+                started = time.perf_counter()
+                history.add_message(HumanMessage(f"term{rng.randrange(SEARCH_VOCABULARY)} inserted {i}"))
+                insert_latency.append(time.perf_counter() - started)
+        finally:
+            db_manager.close()
+    
+    return {
+        "commit": _git_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "python": platform.python_version(),
+        "config": {"rows": rows, "queries": queries, "inserts": inserts, "seed": seed},
+        "load_seconds": load_seconds,
+        "index_mb": index_bytes / 2**20,
+        "search": search,
+        "insert": _percentiles(insert_latency),
+    }
+
+def print_search_results(results: Dict[str, Any]):
+    print(f"{results['config']['rows']} messages loaded in {results['load_seconds']:.1f}s, "
+          f"GIN indexes {results['index_mb']:.1f} MB")
+    for label, timing in results["search"].items():
+        following = (f", next page p50 {timing['next_page']['p50'] * 1000:.2f}ms"
+                     if timing["next_page"] else "")
+        print(f"{label:>16}: p50 {timing['first_page']['p50'] * 1000:.2f}ms, "
+              f"p95 {timing['first_page']['p95'] * 1000:.2f}ms{following} "
+              f"({timing['hits_per_page']:.1f} hits/page)")
+    print(f"Insert p50: {results['insert']['p50'] * 1000:.2f}ms, p95: {results['insert']['p95'] * 1000:.2f}ms")
+
+def save_results(results: Dict[str, Any], path: str):
+    with open(path, "w") as f:
+        json.dump(results, f, indent=2, sort_keys=True)
+
+# Metrics compared between runs; for all but throughput lower is better
+COMPARED = [
+    ("throughput", ("throughput",)),
+    ("latency p50", ("latency", "p50")),
+    ("latency p95", ("latency", "p95")),
+    ("latency p99", ("latency", "p99")),
+    ("first token p95", ("first_token", "p95")),
+    ("db connections peak", ("database", "server_connections_peak")),
+    ("rss peak MB", ("memory", "rss_peak_mb")),
+]
+
+def compare_results(before: Dict[str, Any], after: Dict[str, Any]) -> Dict[str, Dict[str, float]]:
+    """Relative change of each compared metric between two saved runs"""
+    changes = {}
+    for label, path in COMPARED:
+        old, new = before, after
+        for part in path:
+            old = old.get(part) if isinstance(old, dict) else None
+            new = new.get(part) if isinstance(new, dict) else None
+        if old is None or new is None:
+            continue
+        changes[label] = {"before": old, "after": new, "change": (new - old) / old if old else 0.0}
+    return changes
+
+def print_results(results: Dict[str, Any]):
+    latency = results["latency"]
+    print(f"{results['turns']} turns ({results['errors']} errors) in {results['elapsed_seconds']:.2f}s, "
+          f"{results['throughput']:.1f} turns/s")
+    print(f"Latency p50: {latency['p50']:.3f}s, p95: {latency['p95']:.3f}s, p99: {latency['p99']:.3f}s")
+    if results["first_token"]:
+        print(f"First token p50: {results['first_token']['p50']:.3f}s, p95: {results['first_token']['p95']:.3f}s")
+    database = results["database"]
+    print(f"DB connections peak: {database['server_connections_peak']} server, "
+          f"{database['pool_in_use_peak']} in use; pool wait {database['pool_wait_ms']}ms")
+    print(f"LLM requests: {results['llm']['requests']}, peak concurrency: {results['llm']['peak_concurrency']}")
+    if results["memory"]["rss_peak_mb"] is not None:
+        print(f"Peak RSS: {results['memory']['rss_peak_mb']:.1f} MB")
+
+def main(argv: Optional[List[str]] = None):
+    parser = argparse.ArgumentParser(description="Benchmark ChatService against a stub Ollama")
+    parser.add_argument("--sessions", type=int, default=10)
+    parser.add_argument("--turns", type=int, default=5)
+    parser.add_argument("--mode", choices=("closed", "open"), default="closed")
+    parser.add_argument("--rate", type=float, default=10.0, help="Open-loop arrivals per second")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--think-time", type=float, default=0.0)
+    parser.add_argument("--latency", type=float, default=0.05, help="Stub prefill seconds")
+    parser.add_argument("--token-rate", type=float, default=200.0, help="Stub tokens/sec (0 = instant)")
+    parser.add_argument("--reply-tokens", type=int, default=20)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Save results as JSON")
+    parser.add_argument("--compare", nargs=2, metavar=("BEFORE", "AFTER"), help="Compare two saved runs")
+    parser.add_argument("--search-rows", type=int, help="Benchmark full-text search over this many messages instead")
+    args = parser.parse_args(argv)
+    
+    if args.search_rows:
+        results = run_search_benchmark(args.search_rows, seed=args.seed)
+        print_search_results(results)
+        if args.output:
+            save_results(results, args.output)
+            print(f"Results saved to {args.output}")
+        return
+    
+    if args.compare:
+        with open(args.compare[0]) as f:
+            before = json.load(f)
+        with open(args.compare[1]) as f:
+            after = json.load(f)
+        print(f"{before.get('commit')} -> {after.get('commit')}")
+        for label, change in compare_results(before, after).items():
+            print(f"{label:>20}: {change['before']:.3f} -> {change['after']:.3f} ({change['change']:+.1%})")
+        return
+    
+    results = run_benchmark(
+        args.sessions, args.turns, args.mode, args.rate, args.stream, args.think_time,
+        args.latency, args.token_rate, args.reply_tokens, args.seed
+    )
+    print_results(results)
+    if args.output:
+        save_results(results, args.output)
+        print(f"Results saved to {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,92 +1,1740 @@
 import pytest
 import os
 import sys
-from unittest.mock import Mock, patch
+import time
+import json
+import asyncio
+import datetime
+import threading
+import httpx
+from unittest.mock import MagicMock, Mock, patch
 
 # Add backend to path
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from backend.database import DatabaseManager
-from backend.llm_handler import OllamaLLM
+from backend.database import (ROLE_AI, ROLE_HUMAN, AsyncDatabaseManager, AsyncPooledChatMessageHistory,
+                              DatabaseManager, PooledChatMessageHistory, SearchHit, SessionInfo, StoredMessage,
+                              _pack_archive, _unpack_archive, resolve_session_id)
+from backend import migrations
+from backend.lifecycle import SessionLifecycle
+from backend.llm_handler import AsyncOllamaLLM, OllamaLLM
+from backend.generation import (LATENCY_PROFILES, MIN_PREDICT, AdaptiveLimits, Cancellation, FailedGeneration,
+                                ollama_options)
 from backend.chat_service import ChatService
+from backend.context_builder import ContextBuilder, estimate_tokens, with_token_count
+from backend.context_cache import ContextCache
+from backend.summarizer import ConversationSummarizer
+from backend.memory import HashingEmbedder, Memory, OllamaEmbedder, SemanticMemory
+from backend.write_buffer import MessageWriteBuffer
+from backend.response_cache import ResponseCache
+from backend.scheduler import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, LLMBusyError, LLMScheduler
+from backend.load_balancer import BackendPool
+from backend.metrics import PipelineMetrics
+from backend.api import create_app
+from backend.batch import BatchRunner, load_checkpoint, load_sessions
+from starlette.testclient import TestClient
+from langchain_core.messages import HumanMessage, AIMessage, SystemMessage, ToolMessage
 
 class TestDatabaseManager:
     """
     Tests database connection logic and URL construction in isolation.
-    
+
     Key test areas:
     - Database URL formatting validation
     - Connection parameter verification
     - Configuration handling without actual DB calls
     """
-    
+
     def test_build_db_url(self):
         """Test database URL construction"""
         db_manager = DatabaseManager()
         assert "postgresql://" in db_manager.db_url
         assert "chatbot_db" in db_manager.db_url
 
+    def test_pooled_history_borrows_connection(self):
+        """Test each history operation checks out and returns a pooled connection"""
+        mock_pool = MagicMock()
+        conn = mock_pool.connection.return_value.__enter__.return_value
+        history = PooledChatMessageHistory("chat_history", "session", mock_pool)
+
+        history.add_user_message("Hello")
+        history.clear()
+
+        assert mock_pool.connection.call_count == 2
+        assert mock_pool.connection.return_value.__exit__.call_count == 2
+        assert "DELETE FROM" in conn.execute.call_args_list[1][0][0].as_string(None)
+
+    def test_turn_written_with_one_insert(self):
+        """Test both messages of a turn go out in a single multi-row INSERT of plain columns"""
+        mock_pool = MagicMock()
+        conn = mock_pool.connection.return_value.__enter__.return_value
+        history = PooledChatMessageHistory("chat_history", "session", mock_pool)
+
+        history.add_messages([HumanMessage(content="Hi"), with_token_count(AIMessage(content="Hello!"))])
+
+        conn.execute.assert_called_once()
+        query, params = conn.execute.call_args[0]
+        assert query.as_string(None).count("(%s, %s, %s, %s)") == 2
+        assert params == ["session", ROLE_HUMAN, "Hi", None,
+                          "session", ROLE_AI, "Hello!", estimate_tokens("Hello!")]
+
+    def test_stored_rows_read_without_langchain(self):
+        """Test stored rows come back as StoredMessage tuples and convert on demand"""
+        mock_pool = MagicMock()
+        conn = mock_pool.connection.return_value.__enter__.return_value
+        # The page query reads newest first
+        conn.execute.return_value.fetchall.return_value = [(2, ROLE_AI, "Hello!", 2), (1, ROLE_HUMAN, "Hi", None)]
+        history = PooledChatMessageHistory("chat_history", "session", mock_pool)
+
+        rows = history.get_stored_page(2)
+        assert rows == [StoredMessage(1, ROLE_HUMAN, "Hi", None), StoredMessage(2, ROLE_AI, "Hello!", 2)]
+
+        (_, human), (_, ai) = history.get_messages_page(2)
+        assert isinstance(human, HumanMessage) and human.additional_kwargs == {}
+        assert isinstance(ai, AIMessage) and ai.additional_kwargs == {"token_count": 2}
+
+    def test_unsupported_message_type_rejected(self):
+        """Test only human, AI and system messages fit the role column"""
+        history = PooledChatMessageHistory("chat_history", "session", MagicMock())
+        history.add_messages([SystemMessage(content="Be brief")])
+        with pytest.raises(ValueError):
+            history.add_messages([ToolMessage(content="42", tool_call_id="t1")])
+    
+    def test_session_ids_resolved_once(self):
+        """Test session-id resolution is memoized and UUIDs pass through normalized"""
+        resolve_session_id.cache_clear()
+        db_manager = DatabaseManager.__new__(DatabaseManager)
+        
+        first = db_manager._ensure_valid_uuid("alice")
+        assert db_manager._ensure_valid_uuid("alice") == first
+        assert resolve_session_id.cache_info().hits == 1
+        assert db_manager._ensure_valid_uuid("6F9619FF-8B86-D011-B42D-00C04FC964FF") == "6f9619ff-8b86-d011-b42d-00c04fc964ff"
+    
+    def test_list_sessions_keyset_cursor(self):
+        """Test a full page returns a (last_active_at, session_id) cursor that feeds the next query"""
+        active = datetime.datetime(2024, 5, 1, 12, 0, tzinfo=datetime.timezone.utc)
+        sid = "6f9619ff-8b86-d011-b42d-00c04fc964ff"
+        mock_pool = MagicMock()
+        conn = mock_pool.connection.return_value.__enter__.return_value
+        conn.execute.return_value.fetchall.return_value = [(sid, "Hi", active, 4), (sid, None, active, 0)]
+        db_manager = DatabaseManager.__new__(DatabaseManager)
+        db_manager.pool = mock_pool
+        
+        sessions, cursor = db_manager.list_sessions("alice", limit=1)
+        assert sessions == [SessionInfo(sid, "Hi", active, 4)]
+        
+        db_manager.list_sessions("alice", limit=1, cursor=cursor)
+        params = conn.execute.call_args[0][1]
+        assert (params["before_at"], params["before_id"], params["limit"]) == (active, sid, 2)
+        with pytest.raises(ValueError):
+            db_manager.list_sessions("alice", cursor="not-a-cursor")
+    
+    def test_claim_session_once_per_process(self):
+        """Test a session is claimed for an owner with one upsert, not on every turn"""
+        sid = "6f9619ff-8b86-d011-b42d-00c04fc964ff"
+        mock_pool = MagicMock()
+        conn = mock_pool.connection.return_value.__enter__.return_value
+        with patch.object(DatabaseManager, '_build_pool', return_value=mock_pool), \
+                patch('backend.database.migrate'):
+            db_manager = DatabaseManager()
+        
+        db_manager.claim_session(sid, "alice")
+        db_manager.claim_session(sid, "alice")
+        db_manager.claim_session(sid, "bob")
+        
+        assert [call.args[1] for call in conn.execute.call_args_list] == [
+            {"session_id": sid, "owner": "alice"}, {"session_id": sid, "owner": "bob"}
+        ]
+        assert "WHERE chat_sessions.owner IS NULL" in conn.execute.call_args.args[0]
+    
+    def test_restore_skips_sessions_known_to_have_no_archive(self):
+        """Test short reads of an unarchived session look for an archive once, until it is archived"""
+        sid = "6f9619ff-8b86-d011-b42d-00c04fc964ff"
+        created = datetime.datetime(2024, 5, 1, 12, 0, tzinfo=datetime.timezone.utc)
+        mock_pool = MagicMock()
+        conn = mock_pool.connection.return_value.__enter__.return_value
+        conn.execute.return_value.fetchall.side_effect = [
+            [], [(sid,)], [(1, ROLE_HUMAN, "hi", 1, created)], []
+        ]
+        with patch.object(DatabaseManager, '_build_pool', return_value=mock_pool), \
+                patch('backend.database.migrate'):
+            db_manager = DatabaseManager()
+        # The memo is only trusted while the change listener runs
+        db_manager._listener_thread = Mock()
+        
+        def lookups():
+            return sum("RETURNING" in call.args[0] for call in conn.execute.call_args_list)
+        
+        assert db_manager.restore_session(sid) == 0
+        assert db_manager.restore_session(sid) == 0
+        assert lookups() == 1
+        
+        assert db_manager.archive_idle_sessions(60, 10) == [sid]
+        assert db_manager.restore_session(sid) == 0
+        assert lookups() == 2
+    
+    def test_search_messages_rank_cursor(self):
+        """Test search pages by a (rank, id) cursor and needs a session or owner scope"""
+        created = datetime.datetime(2024, 5, 1, 12, 0, tzinfo=datetime.timezone.utc)
+        sid = "6f9619ff-8b86-d011-b42d-00c04fc964ff"
+        mock_pool = MagicMock()
+        conn = mock_pool.connection.return_value.__enter__.return_value
+        conn.execute.return_value.fetchall.return_value = [
+            (sid, 7, ROLE_AI, created, 0.25, "**vacuum** settings"), (sid, 3, ROLE_HUMAN, created, 0.1, "vacuum")
+        ]
+        db_manager = DatabaseManager.__new__(DatabaseManager)
+        db_manager.pool = mock_pool
+        
+        hits, cursor = db_manager.search_messages("vacuum", owner="alice", limit=1)
+        assert hits == [SearchHit(sid, 7, ROLE_AI, created, 0.25, "**vacuum** settings")]
+        
+        db_manager.search_messages("vacuum", owner="alice", limit=1, cursor=cursor)
+        params = conn.execute.call_args[0][1]
+        assert (params["before_rank"], params["before_id"], params["limit"]) == (0.25, 7, 2)
+        assert params["session_id"] is None and params["owner"] == "alice"
+        with pytest.raises(ValueError):
+            db_manager.search_messages("vacuum")
+        with pytest.raises(ValueError):
+            db_manager.search_messages("vacuum", owner="alice", cursor="0.25")
+
+    def test_pool_stats(self):
+        """Test pool statistics are derived from psycopg_pool counters"""
+        db_manager = DatabaseManager.__new__(DatabaseManager)
+        db_manager.pool = Mock()
+        db_manager.pool.get_stats.return_value = {
+            "pool_min": 1, "pool_max": 10, "pool_size": 4,
+            "pool_available": 1, "requests_waiting": 2, "connections_num": 6
+        }
+
+        stats = db_manager.get_pool_stats()
+        assert stats["in_use"] == 3
+        assert stats["waiting"] == 2
+        assert stats["created"] == 6
+        assert stats["recycled"] == 2
+
+class StubMigrationConnection:
+    """Records statements; reports `version` once schema_migrations exists"""
+
+    def __init__(self, version=None):
+        self.version = version
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append(query)
+        if query == migrations.CURRENT_VERSION_QUERY:
+            if self.version is None:
+                raise migrations.psycopg.errors.UndefinedTable("schema_migrations")
+            return Mock(**{"fetchone.return_value": (self.version,)})
+        if query == migrations.VERSION_TABLE and self.version is None:
+            self.version = 0
+        if query == migrations.RECORD_VERSION_QUERY:
+            self.version = params[0]
+        return Mock()
+
+    def rollback(self):
+        pass
+
+class TestMigrations:
+    """Tests versioned migrations run once per database and once per process"""
+
+    def _pool(self, conn):
+        pool = MagicMock()
+        pool.connection.return_value.__enter__.return_value = conn
+        return pool
+
+    def test_fresh_database_is_migrated_once(self):
+        """Test a new database gets every migration and a recorded version"""
+        conn = StubMigrationConnection()
+        pool = self._pool(conn)
+        with patch.object(migrations, "_migrated", set()):
+            migrations.migrate(pool, "postgresql://fresh")
+            migrations.migrate(pool, "postgresql://fresh")
+
+        assert conn.version == migrations.LATEST_VERSION
+        assert pool.connection.call_count == 1
+        assert any("pg_advisory_xact_lock" in statement for statement in conn.statements)
+        assert sum("CREATE TABLE IF NOT EXISTS chat_history" in s for s in conn.statements) == 1
+
+    def test_current_database_only_checks_version(self):
+        """Test an up-to-date database costs a single version query"""
+        conn = StubMigrationConnection(version=migrations.LATEST_VERSION)
+        with patch.object(migrations, "_migrated", set()):
+            migrations.migrate(self._pool(conn), "postgresql://current")
+
+        assert conn.statements == [migrations.CURRENT_VERSION_QUERY]
+
+class StubLifecycleDatabase:
+    """Hands out idle/expired session ids in batches"""
+
+    def __init__(self, idle, expired):
+        self.idle = list(idle)
+        self.expired = list(expired)
+        self.calls = []
+
+    def _take(self, sessions, limit):
+        batch, sessions[:] = sessions[:limit], sessions[limit:]
+        return batch
+
+    def archive_idle_sessions(self, idle_seconds, limit):
+        self.calls.append(("archive", idle_seconds, limit))
+        return self._take(self.idle, limit)
+
+    def expire_sessions(self, ttl_seconds, limit):
+        self.calls.append(("expire", ttl_seconds, limit))
+        return self._take(self.expired, limit)
+
+class TestSessionLifecycle:
+    """Tests archival/expiry batching and configuration"""
+
+    @patch.dict(os.environ, {"CHAT_ARCHIVE_AFTER_DAYS": "30", "CHAT_SESSION_TTL_DAYS": "365",
+                             "CHAT_LIFECYCLE_BATCH": "2"})
+    def test_run_once_drains_in_batches(self):
+        """Test expiry runs first and each job repeats until a short batch"""
+        db = StubLifecycleDatabase(idle=["a", "b", "c"], expired=["x", "y"])
+        changed = []
+
+        counts = SessionLifecycle(db, on_change=changed.append).run_once()
+
+        assert counts == {"expired": 2, "archived": 3}
+        assert changed == ["x", "y", "a", "b", "c"]
+        assert [call[0] for call in db.calls] == ["expire", "expire", "archive", "archive"]
+        assert db.calls[0][1] == 365 * 86400 and db.calls[-1][1] == 30 * 86400
+
+    def test_disabled_by_default(self):
+        """Test nothing is archived or expired unless configured"""
+        with patch.dict(os.environ):
+            os.environ.pop("CHAT_ARCHIVE_AFTER_DAYS", None)
+            os.environ.pop("CHAT_SESSION_TTL_DAYS", None)
+            lifecycle = SessionLifecycle(StubLifecycleDatabase([], []))
+
+        lifecycle.start()
+        assert not lifecycle.enabled and lifecycle._worker is None
+        assert lifecycle.run_once() == {"expired": 0, "archived": 0}
+
+    def test_archive_round_trip(self):
+        """Test archived rows decompress to the stored columns"""
+        created_at = datetime.datetime(2024, 1, 1, tzinfo=datetime.timezone.utc)
+        rows = [(1, ROLE_HUMAN, "Hi", None, created_at), (2, ROLE_AI, "Hello! " * 100, 200, created_at)]
+
+        data = _pack_archive(rows)
+
+        assert len(data) < len("Hello! " * 100)
+        assert _unpack_archive(data) == [[id_, role, content, tokens, created_at.isoformat()]
+                                         for id_, role, content, tokens, _ in rows]
+
 class TestOllamaLLM:
     """
     Tests LLM handler functionality using mocked HTTP responses.
-    
+
     Key test areas:
     - Health check API validation
     - Response generation with controlled inputs
     - Error handling for network failures
     """
-    
-    @patch('requests.get')
+
+    @patch('requests.Session.get')
     def test_check_connection(self, mock_get):
         """Test Ollama connection check"""
         mock_get.return_value.status_code = 200
         mock_get.return_value.json.return_value = {"models": [{"name": "llama2:7b-chat"}]}
-        
+
         llm = OllamaLLM()
         assert llm.model_name == "llama2:7b-chat"
-    
-    @patch('requests.post')
+
+    @patch('requests.Session.post')
     def test_generate_response(self, mock_post):
         """Test response generation"""
         mock_post.return_value.status_code = 200
         mock_post.return_value.json.return_value = {"response": "Test response"}
-        
+
         llm = OllamaLLM()
         response = llm.generate_response("Test prompt")
         assert response == "Test response"
 
+    @patch('requests.Session.post')
+    def test_stream_response(self, mock_post):
+        """Test NDJSON chunks are yielded incrementally"""
+        mock_response = mock_post.return_value.__enter__.return_value
+        mock_response.status_code = 200
+        mock_response.iter_lines.return_value = [
+            b'{"response": "Hel", "done": false}',
+            b'{"response": "lo", "done": false}',
+            b'{"response": "", "done": true}',
+        ]
+
+        llm = OllamaLLM()
+        assert list(llm.stream_response("Test prompt")) == ["Hel", "lo"]
+        assert mock_post.call_args.kwargs["json"]["stream"] is True
+
+        # A finished stream is cached and replayed as one fragment
+        assert list(llm.stream_response("test  prompt")) == ["Hello"]
+        assert mock_post.call_count == 1
+
+    @patch('requests.Session.post')
+    def test_response_cache_and_bypass(self, mock_post):
+        """Test repeated prompts skip the LLM unless the cache is bypassed"""
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {"response": "Hi there"}
+
+        llm = OllamaLLM()
+        assert llm.generate_response("Hello, how are you?") == "Hi there"
+        assert llm.generate_response("hello,  HOW are you?") == "Hi there"
+        assert mock_post.call_count == 1
+
+        llm.generate_response("Hello, how are you?", context="Human: I'm Bob\n")
+        llm.generate_response("Hello, how are you?", use_cache=False)
+        assert mock_post.call_count == 3
+        assert llm.response_cache.get_stats()["hits"] == 1
+    
+    @patch('requests.Session.post')
+    def test_failures_are_typed(self, mock_post):
+        """Test error replies come back as FailedGeneration and are not cached"""
+        mock_post.return_value.status_code = 500
+        
+        llm = OllamaLLM()
+        response = llm.generate_response("Hello")
+        assert isinstance(response, FailedGeneration)
+        assert response == "Error: Could not connect to LLM (Status: 500)"
+        
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {"response": "Hi there"}
+        response = llm.generate_response("Hello")
+        assert response == "Hi there" and not isinstance(response, FailedGeneration)
+
+    def test_session_retry_and_timeouts(self):
+        """Test the pooled session mounts a bounded retry policy and split timeouts"""
+        with patch.dict(os.environ, {"OLLAMA_MAX_RETRIES": "3", "OLLAMA_CONNECT_TIMEOUT": "2"}):
+            with patch('requests.Session.get'):
+                llm = OllamaLLM()
+
+        adapter = llm.session.get_adapter(llm.base_url)
+        assert adapter.max_retries.total == 3
+        assert 503 in adapter.max_retries.status_forcelist
+        # A timed-out generation must not be sent again
+        assert adapter.max_retries.read == 0
+        assert llm.timeout == (2.0, 30.0)
+        assert llm.get_latency_stats()["/api/tags"]["count"] == 1
+
+    def test_prompt_includes_summary_before_recent_turns(self):
+        """Test the running summary precedes the recent conversation"""
+        llm = OllamaLLM.__new__(OllamaLLM)
+        prompt = llm._format_prompt("What's my job?", "Human: hi\n", summary="User is a Data Scientist")
+
+        assert prompt.index("User is a Data Scientist") < prompt.index("Human: hi")
+
+    def test_chat_layout_keeps_prefix_stable(self):
+        """Test consecutive turns share the system prompt and earlier turns byte for byte"""
+        llm = OllamaLLM.__new__(OllamaLLM)
+        llm.model_name, llm.keep_alive = "m", "30m"
+        llm._load_generation_config()
+        builder = ContextBuilder(token_budget=1000)
+        history = [HumanMessage(content="I'm Alice"), AIMessage(content="Hi Alice!")]
+        memories = [Memory("Human", "My favorite color is Pink", 0.9)]
+
+        first = llm._build_chat_payload("Where do I work?", builder.build(history, "User likes tea", memories), False)
+        history += [HumanMessage(content="Where do I work?"), AIMessage(content="At Acme.")]
+        second = llm._build_chat_payload("And my name?", builder.build(history, "User likes tea"), False)
+
+        assert second["messages"][:len(first["messages"]) - 1] == first["messages"][:-1]
+        assert "User likes tea" in first["messages"][0]["content"]
+        assert "Pink" in first["messages"][-1]["content"]
+        assert second["messages"][-1] == {"role": "user", "content": "And my name?"}
+        assert second["keep_alive"] == "30m"
+
+    @patch('requests.Session.post')
+    def test_chat_response_records_prefill(self, mock_post):
+        """Test /api/chat replies are parsed and prefill savings are measured"""
+        mock_post.return_value.status_code = 200
+        mock_post.return_value.json.return_value = {
+            "message": {"role": "assistant", "content": "You work at Acme."},
+            "done": True, "prompt_eval_count": 10, "prompt_eval_duration": 50_000_000,
+        }
+        history = [HumanMessage(content="I work at Acme " * 20), AIMessage(content="Noted " * 20)]
+
+        llm = OllamaLLM()
+        response = llm.chat_response("Where do I work?", ContextBuilder().build(history))
+
+        assert response == "You work at Acme."
+        assert mock_post.call_args[0][0].endswith("/api/chat")
+        stats = llm.get_prefill_stats()
+        assert stats["evaluated_tokens"] == 10
+        assert stats["reused_tokens"] == stats["prompt_tokens"] - 10
+        assert stats["saved_seconds"] == pytest.approx(stats["reused_tokens"] * 0.005)
+
+    def test_async_generate_response(self):
+        """Test async generation against a mocked HTTP transport"""
+        def handler(request):
+            return httpx.Response(200, json={"response": "Async response"})
+
+        llm = AsyncOllamaLLM()
+        llm.client = httpx.AsyncClient(base_url=llm.base_url, transport=httpx.MockTransport(handler))
+
+        assert asyncio.run(llm.generate_response("Test prompt")) == "Async response"
+    
+    def test_async_classes_offer_only_async_methods(self):
+        """Test the async client and manager don't inherit sync methods they can't serve"""
+        for name in ("close", "summarize_conversation", "embed", "scheduler"):
+            assert not hasattr(AsyncOllamaLLM, name)
+        for name in ("archive_idle_sessions", "add_memories", "get_cached_response", "add_messages_bulk"):
+            assert not hasattr(AsyncDatabaseManager, name)
+        assert not hasattr(AsyncPooledChatMessageHistory, "clear")
+    
+    def test_async_stream_stops_on_cancel(self):
+        """Test a cancelled stream stops reading between chunks and is not cached"""
+        lines = [json.dumps({"message": {"content": word}, "done": False}).encode() + b"\n"
+                 for word in ("one ", "two ", "three ")]
+        cancel = Cancellation()
+        
+        async def body():
+            for line in lines:
+                yield line
+        
+        def handler(request):
+            assert json.loads(request.content)["options"]["num_predict"] == 8
+            return httpx.Response(200, content=body())
+        
+        async def consume(llm):
+            parts = []
+            async for text in llm.stream_chat("Hi", ContextBuilder().build([]), options={"max_tokens": 8},
+                                              cancel=cancel):
+                parts.append(text)
+                cancel.cancel()
+            return parts
+        
+        llm = AsyncOllamaLLM()
+        llm.client = httpx.AsyncClient(base_url=llm.base_url, transport=httpx.MockTransport(handler))
+        
+        assert asyncio.run(consume(llm)) == ["one "]
+        assert llm.response_cache.get_stats()["entries"] == 0
+
+class TestGenerationOptions:
+    """
+    Tests generation options, latency profiles and cancellation in isolation.
+    
+    Key test areas:
+    - Translation of request options to Ollama's names and validation
+    - num_predict caps derived from observed speed
+    - Cancellation callbacks and deadlines
+    """
+    
+    def test_options_translated_and_validated(self):
+        """Test max_tokens becomes num_predict and bad options are rejected"""
+        assert ollama_options({"max_tokens": 64, "temperature": 1, "stop": "Human:"}) == {
+            "num_predict": 64, "temperature": 1.0, "stop": ["Human:"]
+        }
+        assert ollama_options({"num_ctx": 4096}) == {"num_ctx": 4096}
+        for bad in ({"max_tokens": 1.5}, {"temperature": "hot"}, {"top_p": True}, {"beam_width": 4}):
+            with pytest.raises(ValueError):
+                ollama_options(bad)
+    
+    def test_payload_uses_ollama_option_names(self):
+        """Test defaults and per-request options reach the payload under Ollama's names"""
+        llm = OllamaLLM.__new__(OllamaLLM)
+        llm.model_name, llm.keep_alive = "m", "30m"
+        with patch.dict(os.environ, {"LLM_MAX_TOKENS": "300"}):
+            llm._load_generation_config()
+        
+        assert llm._build_payload("Hi", "", False)["options"] == {"temperature": 0.7, "num_predict": 300}
+        options = llm._build_payload("Hi", "", False, options={"max_tokens": 20})["options"]
+        assert options["num_predict"] == 20 and "max_tokens" not in options
+    
+    def test_profile_caps_follow_observed_speed(self):
+        """Test num_predict shrinks to a power of two that fits the target, and num_ctx is fixed"""
+        limits = AdaptiveLimits(LATENCY_PROFILES["realtime"], smoothing=1.0)
+        assert limits.apply({})["num_predict"] == 128
+        
+        # 1s prefill and 20 tokens/s leave 40 tokens in a 3s target
+        limits.observe({"prompt_eval_duration": 1_000_000_000, "eval_count": 100, "eval_duration": 5_000_000_000})
+        capped = limits.apply({"num_predict": 500, "num_ctx": 32768})
+        assert capped == {"num_predict": 32, "num_ctx": 2048}
+        assert limits.apply({"num_predict": 10})["num_predict"] == 10
+        
+        limits.observe({"prompt_eval_duration": 5_000_000_000, "eval_count": 1, "eval_duration": 1_000_000_000})
+        assert limits.predict_cap() == MIN_PREDICT
+        assert AdaptiveLimits().apply({"num_predict": 500}) == {"num_predict": 500}
+    
+    def test_cancellation_callbacks_and_deadline(self):
+        """Test callbacks run once on cancel, late ones at once, and deadlines cancel"""
+        cancel = Cancellation()
+        calls = []
+        cancel.on_cancel(lambda: calls.append("a"))
+        unregister = cancel.on_cancel(lambda: calls.append("b"))
+        unregister()
+        cancel.cancel()
+        cancel.cancel("again")
+        cancel.on_cancel(lambda: calls.append("late"))
+        
+        assert calls == ["a", "late"]
+        assert cancel.reason == "cancelled"
+        expired = Cancellation(timeout=0.0)
+        assert expired.cancelled and expired.reason == "deadline exceeded"
+        assert expired.remaining() == 0.0
+        assert Cancellation().remaining() is None
+
+class TestContextCache:
+    """
+    Tests the per-session context cache in isolation.
+
+    Key test areas:
+    - Window trimming on append
+    - Byte-bounded LRU eviction
+    - TTL expiry and invalidation
+    """
+
+    def test_append_trims_to_window(self):
+        """Test appended turns keep only the configured window"""
+        cache = ContextCache(window=3)
+        cache.put("s", [HumanMessage(content="1"), AIMessage(content="2")])
+        cache.append("s", [HumanMessage(content="3"), AIMessage(content="4")])
+
+        assert [m.content for m in cache.get("s", 3)] == ["2", "3", "4"]
+        assert cache.get("s", 4) is None
+
+    def test_lru_eviction_by_bytes(self):
+        """Test least recently used sessions are evicted past the byte bound"""
+        cache = ContextCache(window=10, max_bytes=1000)
+        cache.put("a", [HumanMessage(content="x" * 300)])
+        cache.put("b", [HumanMessage(content="x" * 300)])
+        cache.get("a", 1)
+        cache.put("c", [HumanMessage(content="x" * 300)])
+
+        assert cache.get("b", 1) is None
+        assert cache.get("a", 1) is not None
+        assert cache.get_stats()["evictions"] == 1
+
+    def test_ttl_and_invalidate(self):
+        """Test expired and invalidated sessions miss"""
+        cache = ContextCache(window=10, ttl=0.01)
+        cache.put("s", [HumanMessage(content="hi")])
+        time.sleep(0.02)
+        assert cache.get("s", 1) is None
+
+        cache.put("s", [HumanMessage(content="hi")])
+        cache.invalidate()
+        assert cache.get("s", 1) is None
+        assert cache.get_stats()["bytes"] == 0
+
+class StubResponseStore:
+    """In-memory stand-in for the llm_response_cache table"""
+
+    def __init__(self):
+        self.rows = {}
+
+    def get_cached_response(self, cache_key, max_age):
+        return self.rows.get(cache_key)
+
+    def save_cached_response(self, cache_key, response):
+        self.rows[cache_key] = response
+
+class TestResponseCache:
+    """
+    Tests the LLM response cache in isolation.
+
+    Key test areas:
+    - Near-duplicate matching within the same context
+    - Byte-bounded LRU eviction
+    - Read-through of the persistent tier
+    """
+    
+    def test_exact_key_keeps_punctuation(self):
+        """Test exact keys ignore case and spacing but not symbols"""
+        cache = ResponseCache()
+        cache.put(cache.make_key("m", "What is 2+2?", "", {}), "4")
+        
+        assert cache.get(cache.make_key("m", "  what IS\n2+2? ", "", {})) == "4"
+        assert cache.get(cache.make_key("m", "What is 2*2?", "", {})) is None
+        assert cache.get(cache.make_key("m", "What is 2+2", "", {})) is None
+
+    def test_near_duplicate_hit(self):
+        """Test trivially different prompts share a response when enabled"""
+        cache = ResponseCache(similarity=0.7)
+        options = {"temperature": 0.7}
+        cache.put(cache.make_key("m", "Can you tell me a joke please", "", options), "Why did...")
+
+        assert cache.get(cache.make_key("m", "Can you tell me a joke?", "", options)) == "Why did..."
+        assert cache.get(cache.make_key("m", "Tell me a joke please", "Human: hi\n", options)) is None
+        assert cache.get(cache.make_key("m", "What is Python?", "", options)) is None
+        assert cache.get_stats()["near_hits"] == 1
+
+    def test_eviction_by_bytes(self):
+        """Test least recently used responses are evicted over the byte bound"""
+        cache = ResponseCache(max_bytes=100)
+        first, second = cache.make_key("m", "first", "", {}), cache.make_key("m", "second", "", {})
+        cache.put(first, "a" * 60)
+        cache.put(second, "b" * 60)
+
+        assert cache.get(first) is None
+        assert cache.get(second) == "b" * 60
+        assert cache.get_stats()["evictions"] == 1
+
+    def test_store_read_through(self):
+        """Test a fresh process serves responses written by another"""
+        store = StubResponseStore()
+        with patch.dict(os.environ, {"RESPONSE_CACHE_BACKING": "postgres"}):
+            writer, reader = ResponseCache(), ResponseCache()
+            writer.attach_store(store)
+            reader.attach_store(store)
+        key = writer.make_key("m", "Hello", "", {})
+        writer.put(key, "Hi!")
+
+        assert reader.get(key) == "Hi!"
+        assert reader.get(key) == "Hi!"
+        assert reader.get_stats()["store_hits"] == 1
+        assert reader.get_stats()["hits"] == 1
+
+class TestLLMScheduler:
+    """
+    Tests admission control for LLM calls.
+
+    Key test areas:
+    - Priority and per-session round-robin ordering
+    - Deadline shedding
+    - Coalescing of identical in-flight requests
+    """
+
+    def _wait_for_queue(self, scheduler, depth):
+        deadline = time.time() + 5
+        while scheduler.get_stats()["queue_depth"] < depth and time.time() < deadline:
+            time.sleep(0.005)
+
+    def test_priority_then_round_robin_order(self):
+        """Test queued calls run by priority, then alternate between sessions"""
+        scheduler = LLMScheduler(max_in_flight=1)
+        order = []
+
+        def call(name, session_id, priority=0):
+            with scheduler.slot(session_id, priority):
+                order.append(name)
+
+        threads = []
+        with scheduler.slot("holder"):
+            for depth, args in enumerate([("bg", "s3", PRIORITY_BACKGROUND), ("a1", "s1"), ("a2", "s1"), ("b1", "s2")], 1):
+                threads.append(threading.Thread(target=call, args=args))
+                threads[-1].start()
+                self._wait_for_queue(scheduler, depth)
+        for thread in threads:
+            thread.join()
+
+        assert order == ["a1", "b1", "a2", "bg"]
+        assert scheduler.get_stats()["in_flight"] == 0
+
+    def test_deadline_sheds_waiting_request(self):
+        """Test a request that cannot get a slot in time is rejected"""
+        scheduler = LLMScheduler(max_in_flight=1)
+        with scheduler.slot("holder"):
+            with pytest.raises(LLMBusyError):
+                with scheduler.slot("s1", timeout=0.05):
+                    pass
+
+        stats = scheduler.get_stats()
+        assert stats["shed"] == 1
+        assert stats["queue_depth"] == 0
+
+    def test_identical_requests_coalesced(self):
+        """Test concurrent identical requests share one underlying call"""
+        scheduler = LLMScheduler(max_in_flight=4)
+        calls = []
+        started = threading.Event()
+        release = threading.Event()
+
+        def generate():
+            calls.append(1)
+            started.set()
+            release.wait(5)
+            return "shared"
+
+        results = []
+        leader = threading.Thread(target=lambda: results.append(scheduler.run("k", generate)))
+        leader.start()
+        started.wait(5)
+        followers = [threading.Thread(target=lambda: results.append(scheduler.run("k", generate))) for _ in range(3)]
+        for thread in followers:
+            thread.start()
+        while scheduler.get_stats()["coalesced"] < 3:
+            time.sleep(0.005)
+        release.set()
+        for thread in [leader] + followers:
+            thread.join()
+
+        assert results == ["shared"] * 4
+        assert len(calls) == 1
+
+class TestBackendPool:
+    """
+    Tests routing across several Ollama endpoints.
+
+    Key test areas:
+    - Least-outstanding-requests routing
+    - Session affinity and failover
+    - Ejection after failures and readmission by health checks
+    """
+
+    URLS = ["http://ollama-a:11434", "http://ollama-b:11434", "http://ollama-c:11434"]
+
+    def test_least_outstanding_routing(self):
+        """Test concurrent requests spread across idle endpoints"""
+        pool = BackendPool(self.URLS, session_affinity=False)
+        with pool.route() as first, pool.route() as second, pool.route() as third:
+            assert {first.url, second.url, third.url} == set(self.URLS)
+        assert all(stats["outstanding"] == 0 for stats in pool.get_stats())
+
+    def test_affinity_fails_over_and_returns(self):
+        """Test a pinned session moves only while its endpoint is down"""
+        pool = BackendPool(self.URLS, session_affinity=True)
+        with pool.route("session-1") as lease:
+            pinned = lease.backend
+        with pool.route("session-1") as lease:
+            assert lease.backend is pinned
+
+        pool.mark(pinned, healthy=False)
+        with pool.route("session-1") as lease:
+            assert lease.backend is not pinned
+
+        pool.mark(pinned, healthy=True)
+        with pool.route("session-1") as lease:
+            assert lease.backend is pinned
+
+    def test_ejection_after_consecutive_failures(self):
+        """Test a failing endpoint stops receiving traffic until readmitted"""
+        with patch.dict(os.environ, {"OLLAMA_EJECT_FAILURES": "2"}):
+            pool = BackendPool(self.URLS[:2], session_affinity=False)
+        failing = pool.backends[0]
+        for _ in range(2):
+            with pytest.raises(ConnectionError):
+                with pool.route() as lease:
+                    assert lease.backend is failing
+                    raise ConnectionError("refused")
+
+        assert not pool.get_stats()[0]["available"]
+        with pool.route() as lease:
+            assert lease.backend is pool.backends[1]
+
+        pool.mark(failing, healthy=True)
+        assert pool.get_stats()[0]["available"]
+
+class TestContextBuilder:
+    """
+    Tests token-budgeted context assembly.
+
+    Key test areas:
+    - Newest-first packing under the budget
+    - Per-message token count caching
+    """
+
+    def test_packs_newest_messages_within_budget(self):
+        """Test older messages are dropped once the budget is reached"""
+        messages = [
+            HumanMessage(content="old " * 100),
+            AIMessage(content="old reply"),
+            HumanMessage(content="What's my name?"),
+            AIMessage(content="Alice"),
+        ]
+        window = ContextBuilder(token_budget=30, prefix_step=1).build(messages)
+
+        assert window.message_count == 3
+        assert window.text.startswith("Assistant: old reply\n")
+        assert window.text.endswith("Assistant: Alice\n")
+        assert window.token_count <= 30
+
+    def test_window_start_moves_in_steps(self):
+        """Test the window start stays put for several turns once history overflows"""
+        def window_starts(builder):
+            messages, starts = [], []
+            for i in range(40):
+                messages += [HumanMessage(content=f"Question number {i}"), AIMessage(content=f"Answer {i} " * 5)]
+                window = builder.build(messages)
+                assert window.token_count <= builder.token_budget
+                starts.append(window.messages[0].content)
+            return starts
+
+        sliding = window_starts(ContextBuilder(token_budget=200, prefix_step=1))
+        anchored = window_starts(ContextBuilder(token_budget=200, prefix_step=4))
+
+        changes = lambda starts: sum(a != b for a, b in zip(starts, starts[1:]))
+        assert changes(anchored) < changes(sliding) / 2
+
+    def test_token_count_cached_on_message(self):
+        """Test token counts are stored in additional_kwargs for persistence"""
+        message = with_token_count(HumanMessage(content="Hello there, how are you?"))
+
+        assert message.additional_kwargs["token_count"] == estimate_tokens("Hello there, how are you?")
+
+class StubSummaryLLM:
+    """Records summarization calls and returns a deterministic summary"""
+
+    def __init__(self):
+        self.calls = []
+
+    def summarize_conversation(self, transcript, previous_summary=""):
+        self.calls.append((transcript, previous_summary))
+        return f"summary #{len(self.calls)}"
+
+class StubSummaryHistory:
+    """In-memory stand-in for PooledChatMessageHistory's summary API"""
+
+    def __init__(self, messages):
+        self.session_id = "session-uuid"
+        self.rows = list(enumerate(messages, start=1))
+        self.summary, self.through_id = "", 0
+
+    def get_summary_state(self):
+        return self.summary, self.through_id
+
+    def get_messages_page(self, limit, before_id=None):
+        return self.rows[-limit:]
+
+    def get_messages_range(self, after_id, before_id, limit):
+        return [row for row in self.rows if after_id < row[0] < before_id][:limit]
+
+    def save_summary(self, summary, through_id):
+        self.summary, self.through_id = summary, through_id
+
+class TestConversationSummarizer:
+    """
+    Tests rolling summarization with a stub LLM and in-memory history.
+
+    Key test areas:
+    - Only messages the prompt no longer includes are summarized
+    - Incremental updates build on the previous summary
+    - Background scheduling off the request path
+    """
+
+    def _summarizer(self, message_count, keep_recent=4, context_builder=None):
+        messages = [
+            HumanMessage(content=f"q{i}") if i % 2 == 0 else AIMessage(content=f"a{i}")
+            for i in range(message_count)
+        ]
+        history = StubSummaryHistory(messages)
+        db_manager = Mock()
+        db_manager.get_chat_history.return_value = history
+        llm = StubSummaryLLM()
+        on_summary = Mock()
+        with patch.dict(os.environ, {"SUMMARY_BATCH_SIZE": "4"}):
+            summarizer = ConversationSummarizer(db_manager, llm, keep_recent, on_summary, context_builder)
+        return summarizer, history, llm, on_summary
+
+    def test_summarizes_messages_outside_window(self):
+        """Test old messages are folded in batches and recent ones are kept"""
+        summarizer, history, llm, on_summary = self._summarizer(12)
+
+        assert summarizer.summarize("s") is True
+        # 8 messages outside the window of 4, in two batches of 4
+        assert len(llm.calls) == 2
+        assert llm.calls[0][0].startswith("Human: q0\nAssistant: a1")
+        assert llm.calls[1][1] == "summary #1"
+        assert history.through_id == 8
+        on_summary.assert_called_once_with("session-uuid", "summary #2")
+
+    def test_short_session_not_summarized(self):
+        """Test sessions that fit in the window are left alone"""
+        summarizer, history, llm, _ = self._summarizer(4)
+
+        assert summarizer.summarize("s") is False
+        assert llm.calls == []
+    
+    def test_folds_turns_the_token_budget_leaves_out(self):
+        """Test recent messages that don't fit next to the summary are folded too"""
+        # Each message costs 3 tokens: 12 left for turns fit the last 4 messages
+        builder = ContextBuilder(token_budget=12, prefix_step=1, memory_budget=0)
+        summarizer, history, llm, _ = self._summarizer(10, keep_recent=10, context_builder=builder)
+        
+        assert summarizer.summarize("s") is True
+        # Messages 1-4 are folded first; the summary (3 tokens) then pushes
+        # message 7 out of the window, so 5-7 follow
+        assert history.through_id == 7
+        assert llm.calls[-1][0] == "Human: q4\nAssistant: a5\nHuman: q6"
+        window = builder.build([message for _, message in history.rows], history.summary)
+        assert history.rows[-window.message_count][0] == history.through_id + 1
+
+    def test_schedule_runs_in_background(self):
+        """Test scheduled sessions are processed by the worker thread"""
+        summarizer, history, llm, _ = self._summarizer(12)
+
+        summarizer.schedule("s")
+        summarizer.join()
+        summarizer.stop()
+
+        assert history.summary == "summary #2"
+
+class StubMemoryDB:
+    """In-memory stand-in for the chat_memories table"""
+
+    def __init__(self):
+        self.rows = []
+
+    def add_memories(self, rows):
+        self.rows.extend(rows)
+
+    def get_memories(self, session_id):
+        return [(role, content, embedding) for sid, role, content, embedding in self.rows if sid == session_id]
+
+class TestSemanticMemory:
+    """
+    Tests embedding-based recall of older messages.
+
+    Key test areas:
+    - Background indexing into the memory table
+    - Top-k recall of relevant facts outside the recent window
+    - Memory lines rendered into the context budget
+    """
+
+    def test_recalls_fact_from_older_turn(self):
+        """Test a fact stated long ago is recalled for a related question"""
+        db = StubMemoryDB()
+        memory = SemanticMemory(db, HashingEmbedder())
+        memory.index("s1", [HumanMessage(content="My favorite color is Pink"), AIMessage(content="Noted!")])
+        memory.index("s1", [HumanMessage(content="Tell me about the weather"), AIMessage(content="Sunny.")])
+        memory.index("s2", [HumanMessage(content="My favorite color is Blue")])
+        memory.join()
+
+        memories = memory.search("s1", "What's my favorite color?")
+
+        assert memories[0].content == "My favorite color is Pink"
+        assert all(m.content != "My favorite color is Blue" for m in memories)
+        assert memory.search("s1", "What's my favorite color?", exclude=["My favorite color is Pink"]) == []
+        memory.stop()
+
+    def test_index_extends_loaded_session(self):
+        """Test new turns become searchable without reloading the session"""
+        db = StubMemoryDB()
+        memory = SemanticMemory(db, HashingEmbedder())
+        assert memory.search("s1", "favorite color") == []
+
+        memory.index("s1", [HumanMessage(content="My favorite color is Pink")])
+        memory.join()
+
+        assert [m.content for m in memory.search("s1", "favorite color")] == ["My favorite color is Pink"]
+        memory.stop()
+
+    def test_discard_drops_queued_messages_and_stop_drains(self):
+        """Test a cleared session's queued messages are never written, and stop() waits for the rest"""
+        db = StubMemoryDB()
+        release = threading.Event()
+        embedder = HashingEmbedder()
+        slow = Mock(side_effect=lambda texts: (release.wait(5), embedder.embed(texts))[1])
+        memory = SemanticMemory(db, Mock(embed=slow))
+        memory.index("s0", [HumanMessage(content="first batch")])
+        while slow.call_count == 0:
+            time.sleep(0.01)
+        memory.index("s1", [HumanMessage(content="My favorite color is Pink")])
+        memory.index("s2", [HumanMessage(content="My favorite color is Blue")])
+        
+        # Waits for the batch being written, so it runs alongside
+        discard = threading.Thread(target=memory.discard, args=("s1",))
+        discard.start()
+        time.sleep(0.1)
+        release.set()
+        discard.join()
+        memory.stop()
+        
+        assert [row[2] for row in db.rows] == ["first batch", "My favorite color is Blue"]
+    
+    def test_query_embedded_at_interactive_priority(self):
+        """Test recall embeds the query ahead of background indexing in the scheduler"""
+        llm = Mock()
+        llm.embed.side_effect = lambda texts, model, priority: [[1.0, 0.0]] * len(texts)
+        memory = SemanticMemory(StubMemoryDB(), OllamaEmbedder(llm, "nomic-embed-text"))
+        memory.index("s1", [HumanMessage(content="My favorite color is Pink")])
+        memory.join()
+        
+        assert [m.content for m in memory.search("s1", "favorite color")] == ["My favorite color is Pink"]
+        assert [c.kwargs["priority"] for c in llm.embed.call_args_list] == [PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE]
+        memory.stop()
+    
+    def test_builder_renders_memories(self):
+        """Test recalled memories are placed before the recent turns"""
+        window = ContextBuilder(token_budget=200).build(
+            [HumanMessage(content="Hi")], memories=[Memory("Human", "My favorite color is Pink", 0.8)]
+        )
+
+        assert window.text == ("Relevant earlier messages:\n- Human: My favorite color is Pink\n\n"
+                               "Human: Hi\n")
+        assert window.memory_count == 1
+    
+    def test_memories_do_not_change_which_turns_fit(self):
+        """Test recalled memories use their own share, so the window is the same with or without them"""
+        builder = ContextBuilder(token_budget=100, prefix_step=1, memory_budget=20)
+        messages = [HumanMessage(content=f"Message number {i} " * 3) for i in range(20)]
+        memories = [Memory("Human", "My favorite color is Pink", 0.9)] * 5
+        
+        with_memories = builder.build(messages, memories=memories)
+        assert with_memories.messages == builder.build(messages).messages
+        assert 0 < with_memories.memory_count < 5
+        assert with_memories.token_count <= 100
+
+class StubBulkDB:
+    """Records bulk writes; fails while `down` is set"""
+
+    def __init__(self):
+        self.batches = []
+        self.down = False
+        self.attempts = 0
+
+    def add_messages_bulk(self, rows):
+        self.attempts += 1
+        if self.down:
+            raise ConnectionError("database unavailable")
+        self.batches.append(list(rows))
+
+class TestMessageWriteBuffer:
+    """
+    Tests the write-behind buffer for chat messages.
+
+    Key test areas:
+    - Size and time flush thresholds
+    - Ordering and retry of failed batches
+    - Flush on close
+    """
+
+    def test_flushes_many_sessions_in_one_batch(self):
+        """Test reaching the size threshold writes all sessions at once"""
+        db = StubBulkDB()
+        buffer = MessageWriteBuffer(db, max_messages=4, flush_interval=60)
+        buffer.add("s1", [HumanMessage(content="q1"), AIMessage(content="a1")])
+        assert buffer.has_pending("s1")
+        buffer.add("s2", [HumanMessage(content="q2"), AIMessage(content="a2")])
+
+        deadline = time.time() + 5
+        while not db.batches and time.time() < deadline:
+            time.sleep(0.01)
+
+        assert [(sid, m.content) for sid, m in db.batches[0]] == [
+            ("s1", "q1"), ("s1", "a1"), ("s2", "q2"), ("s2", "a2")
+        ]
+        assert not buffer.has_pending("s1")
+        buffer.close()
+
+    def test_failed_flush_keeps_order_and_close_flushes(self):
+        """Test a failed batch is retried ahead of newer messages"""
+        db = StubBulkDB()
+        buffer = MessageWriteBuffer(db, max_messages=100, flush_interval=60)
+        buffer.add("s1", [HumanMessage(content="q1")])
+        db.down = True
+        with pytest.raises(ConnectionError):
+            buffer.flush()
+        buffer.add("s1", [AIMessage(content="a1")])
+        db.down = False
+
+        buffer.close()
+
+        assert [m.content for _, m in db.batches[0]] == ["q1", "a1"]
+        assert buffer.get_stats()["failures"] == 1
+        assert buffer.get_stats()["pending"] == 0
+
+    def test_outage_is_bounded(self):
+        """Test a long outage drops the oldest messages past the cap and doesn't retry on every add"""
+        db = StubBulkDB()
+        db.down = True
+        buffer = MessageWriteBuffer(db, max_messages=2, flush_interval=60, max_pending=4)
+        buffer.add("s1", [HumanMessage(content="q1"), AIMessage(content="a1")])
+        deadline = time.time() + 5
+        while buffer.get_stats()["failures"] == 0 and time.time() < deadline:
+            time.sleep(0.01)
+        for n in range(2, 5):
+            buffer.add(f"s{n}", [HumanMessage(content=f"q{n}"), AIMessage(content=f"a{n}")])
+        time.sleep(0.1)
+
+        assert db.attempts == 1
+        assert buffer.get_stats()["pending"] == 4 and buffer.get_stats()["dropped"] == 4
+        assert not buffer.has_pending("s1") and not buffer.has_pending("s2")
+        assert buffer.has_pending("s3") and buffer.has_pending("s4")
+
+        db.down = False
+        buffer.close()
+        assert [m.content for _, m in db.batches[0]] == ["q3", "a3", "q4", "a4"]
+        assert not buffer.has_pending("s4")
+
 class TestChatService:
     """
     Tests chat service orchestration with mocked dependencies.
-    
+
     Key test areas:
     - End-to-end conversation flow simulation
     - Context building and message handling
     - Integration between components via mocks
     """
 
+    @pytest.fixture(autouse=True)
+    def background_workers(self):
+        """Stub the summarization and retention workers, which would run against the mocked database"""
+        with patch('backend.chat_service.ConversationSummarizer'), patch('backend.chat_service.SessionLifecycle'):
+            yield
+    
     @patch('backend.chat_service.DatabaseManager')
     @patch('backend.chat_service.OllamaLLM')
     def test_chat_functionality(self, mock_llm, mock_db):
         """Test basic chat functionality"""
         # Mock LLM response
         mock_llm_instance = Mock()
-        mock_llm_instance.generate_response.return_value = "Mock response"
+        mock_llm_instance.chat_response.return_value = "Mock response"
         mock_llm.return_value = mock_llm_instance
-        
+
         # Mock database
         mock_db_instance = Mock()
         mock_history = Mock()
-        mock_history.messages = []
+        mock_history.get_recent_messages.return_value = []
+        mock_history.get_summary.return_value = ""
         mock_db_instance.get_chat_history.return_value = mock_history
+        mock_db_instance.get_memories.return_value = []
         mock_db.return_value = mock_db_instance
-        
+
         chat_service = ChatService()
         response = chat_service.chat("Test message")
-        
+
         assert response == "Mock response"
-        mock_history.add_user_message.assert_called_once_with("Test message")
-        mock_history.add_ai_message.assert_called_once_with("Mock response")
+        mock_db_instance.claim_session.assert_not_called()
+        mock_history.add_messages.assert_called_once()
+        turn = mock_history.add_messages.call_args[0][0]
+        assert [m.content for m in turn] == ["Test message", "Mock response"]
+        
+        # A client-made session id is listed under the owner of its first turn
+        chat_service.chat("Test message", owner="alice")
+        mock_db_instance.claim_session.assert_called_once_with(mock_history.session_id, "alice")
+        chat_service.close()
+
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_context_uses_windowed_history(self, mock_llm, mock_db):
+        """Test context only requests the last N messages from the database"""
+        mock_history = Mock()
+        mock_history.get_summary.return_value = ""
+        mock_history.get_recent_messages.return_value = [
+            HumanMessage(content="Hi"), AIMessage(content="Hello!")
+        ]
+        mock_db.return_value.get_chat_history.return_value = mock_history
+        mock_db.return_value.restore_session.return_value = 0
+
+        chat_service = ChatService()
+        context = chat_service.get_conversation_context("s", max_messages=4)
+
+        mock_history.get_recent_messages.assert_called_once_with(chat_service.context_cache.window)
+        assert context == "Human: Hi\nAssistant: Hello!\n"
+        chat_service.close()
+
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_context_cache_write_through(self, mock_llm, mock_db):
+        """Test hot sessions build context from the cache and see new turns"""
+        mock_llm.return_value.chat_response.return_value = "Nice to meet you"
+        mock_history = Mock(session_id="uuid-1")
+        mock_history.get_recent_messages.return_value = []
+        mock_history.get_summary.return_value = ""
+        mock_db.return_value.get_chat_history.return_value = mock_history
+        mock_db.return_value.get_memories.return_value = []
+        mock_db.return_value.restore_session.return_value = 0
+
+        chat_service = ChatService()
+        chat_service.chat("I'm Alice")
+        context = chat_service.get_conversation_context("default")
+
+        mock_history.get_recent_messages.assert_called_once()
+        assert context == "Human: I'm Alice\nAssistant: Nice to meet you\n"
+        mock_db.return_value.start_listener.assert_called_once_with(chat_service._on_history_changed)
+
+        chat_service.clear_history()
+        assert chat_service.context_cache.get("uuid-1", 10) is None
+        chat_service.close()
+
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_chat_history_page_cursor(self, mock_llm, mock_db):
+        """Test paged history pairs messages and returns a keyset cursor"""
+        mock_history = Mock()
+        # Page starts with a dangling AI reply whose question is on the older page
+        mock_history.get_stored_page.return_value = [
+            StoredMessage(4, ROLE_AI, "a1", None),
+            StoredMessage(5, ROLE_HUMAN, "q2", None), StoredMessage(6, ROLE_AI, "a2", None),
+            StoredMessage(7, ROLE_HUMAN, "q3", None),
+        ]
+        mock_db.return_value.get_chat_history.return_value = mock_history
+
+        chat_service = ChatService()
+        pairs, cursor = chat_service.get_chat_history_page("s", limit=2)
+
+        mock_history.get_stored_page.assert_called_once_with(4, None)
+        assert pairs == [("q2", "a2")]
+        assert cursor == 5
+        chat_service.close()
+    
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_archived_session_restored_on_read(self, mock_llm, mock_db):
+        """Test a short read restores archived messages and reads again; a full one does not"""
+        archived = [StoredMessage(1, ROLE_HUMAN, "q1", None), StoredMessage(2, ROLE_AI, "a1", None)]
+        mock_history = Mock(session_id="uuid-1")
+        mock_history.get_stored_page.side_effect = [[], archived]
+        mock_db.return_value.get_chat_history.return_value = mock_history
+        mock_db.return_value.restore_session.return_value = 2
+        
+        chat_service = ChatService()
+        pairs, cursor = chat_service.get_chat_history_page("s", limit=1)
+        
+        mock_db.return_value.restore_session.assert_called_once_with("uuid-1")
+        assert pairs == [("q1", "a1")] and cursor == 1
+        
+        mock_history.get_stored_page.side_effect = None
+        mock_history.get_stored_page.return_value = archived
+        chat_service.get_chat_history_page("s", limit=1)
+        assert mock_db.return_value.restore_session.call_count == 1
+        chat_service.close()
+
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_chat_stream_persists_partial_response(self, mock_llm, mock_db):
+        """Test a cancelled stream still saves the tokens received so far"""
+        mock_llm.return_value.stream_chat.return_value = iter(["Par", "tial", "never"])
+        mock_history = Mock()
+        mock_history.get_recent_messages.return_value = []
+        mock_history.get_summary.return_value = ""
+        mock_db.return_value.get_chat_history.return_value = mock_history
+        mock_db.return_value.get_memories.return_value = []
+
+        chat_service = ChatService()
+        stream = chat_service.chat_stream("Test message")
+        assert next(stream) == "Par"
+        assert next(stream) == "tial"
+        stream.close()
+
+        turn = mock_history.add_messages.call_args[0][0]
+        assert [m.content for m in turn] == ["Test message", "Partial"]
+        chat_service.close()
+
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_failed_generation_not_saved(self, mock_llm, mock_db):
+        """Test busy or failed replies are returned but never persisted"""
+        busy = FailedGeneration("Error: LLM is busy, please try again (queue full)")
+        mock_llm.return_value.chat_response.return_value = busy
+        mock_llm.return_value.stream_chat.return_value = iter(["Par", FailedGeneration("Error: model crashed")])
+        mock_history = Mock()
+        mock_history.get_recent_messages.return_value = []
+        mock_history.get_summary.return_value = ""
+        mock_db.return_value.get_chat_history.return_value = mock_history
+        mock_db.return_value.get_memories.return_value = []
+        
+        chat_service = ChatService()
+        assert chat_service.chat("Test message") is busy
+        assert list(chat_service.chat_stream("Test message")) == ["Par", "Error: model crashed"]
+        
+        mock_history.add_messages.assert_not_called()
+        chat_service.close()
+    
+    @patch.dict(os.environ, {"CHAT_WRITE_MODE": "buffered"})
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_buffered_mode_flushes_before_reads(self, mock_llm, mock_db):
+        """Test buffered turns skip the per-turn INSERT and flush before history reads"""
+        mock_llm.return_value.chat_response.return_value = "Hello!"
+        mock_history = Mock(session_id="uuid-1")
+        mock_history.get_recent_messages.return_value = []
+        mock_history.get_summary.return_value = ""
+        mock_history.get_stored_page.return_value = []
+        mock_db.return_value.get_chat_history.return_value = mock_history
+        mock_db.return_value.get_memories.return_value = []
+
+        chat_service = ChatService()
+        chat_service.write_buffer.flush_interval = 60
+        chat_service.chat("Hi")
+
+        mock_history.add_messages.assert_not_called()
+        chat_service.get_chat_history_page()
+        rows = mock_db.return_value.add_messages_bulk.call_args[0][0]
+        assert [(sid, m.content) for sid, m in rows] == [("uuid-1", "Hi"), ("uuid-1", "Hello!")]
+        chat_service.close()
+
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_turn_stages_are_timed(self, mock_llm, mock_db):
+        """Test a turn records its history, memory, context, write and total time"""
+        mock_llm.return_value.model_name = "m"
+        mock_llm.return_value.chat_response.return_value = "Hello!"
+        mock_history = Mock(session_id="uuid-1")
+        mock_history.get_recent_messages.return_value = []
+        mock_history.get_summary.return_value = ""
+        mock_db.return_value.get_chat_history.return_value = mock_history
+        mock_db.return_value.get_memories.return_value = []
+
+        chat_service = ChatService()
+        chat_service.chat("Hi")
+
+        assert mock_llm.call_args.kwargs["metrics"] is chat_service.metrics
+        stats = chat_service.metrics.get_stats()
+        for stage in ("history", "memory", "context", "db_write", "turn"):
+            assert stats[f"{stage}/m"]["count"] == 1
+        chat_service.close()
+
+    @patch('backend.chat_service.DatabaseManager')
+    @patch('backend.chat_service.OllamaLLM')
+    def test_memory_failure_does_not_fail_turn(self, mock_llm, mock_db):
+        """Test a turn is answered without memories when the embedding model is down"""
+        mock_llm.return_value.chat_response.return_value = "Hello!"
+        mock_llm.return_value.embed.return_value = None
+        mock_history = Mock(session_id="uuid-1")
+        mock_history.get_recent_messages.return_value = []
+        mock_history.get_summary.return_value = ""
+        mock_db.return_value.get_chat_history.return_value = mock_history
+        mock_db.return_value.restore_session.return_value = 0
+        mock_db.return_value.get_memories.return_value = [("Human", "My favorite color is Pink", bytes(16))]
+
+        with patch.dict(os.environ, {"EMBEDDING_BACKEND": "ollama"}):
+            chat_service = ChatService()
+
+        assert chat_service.chat("Hi") == "Hello!"
+        assert chat_service.get_context_window("uuid-1", query="Hi").memory_count == 0
+        mock_history.add_messages.assert_called_once()
+        chat_service.close()
+
+class TestPipelineMetrics:
+    """Tests stage histograms, generation speed and Prometheus export"""
+
+    def test_stages_and_generation_speed(self):
+        """Test stages land in per-model histograms and tokens/sec comes from eval_*"""
+        metrics = PipelineMetrics(enabled=True, tracing=False)
+        with metrics.stage("history", "llama"):
+            pass
+        metrics.observe("queue_wait", "llama", 0.2)
+        metrics.observe("queue_wait", "mistral", 3.0)
+        metrics.observe_generation("llama", {"eval_count": 50, "eval_duration": 2_000_000_000})
+
+        stats = metrics.get_stats()
+        assert stats["history/llama"]["count"] == 1
+        assert stats["queue_wait/llama"]["p95"] == 0.25
+        assert stats["queue_wait/mistral"]["avg"] == 3.0
+        assert stats["tokens_per_second/llama"]["avg"] == 25.0
+
+    def test_render_prometheus_text(self):
+        """Test histograms render with cumulative buckets, sum and count"""
+        metrics = PipelineMetrics(enabled=True, tracing=False)
+        metrics.observe("generate", "llama", 0.3)
+        metrics.observe("generate", "llama", 7.0)
+        metrics.observe_generation("llama", {"eval_count": 10, "eval_duration": 1_000_000_000})
+
+        text = metrics.render()
+        assert '# TYPE chat_stage_seconds histogram' in text
+        assert 'chat_stage_seconds_bucket{stage="generate",model="llama",le="0.5"} 1' in text
+        assert 'chat_stage_seconds_bucket{stage="generate",model="llama",le="10.0"} 2' in text
+        assert 'chat_stage_seconds_count{stage="generate",model="llama"} 2' in text
+        assert 'chat_generated_tokens_total{model="llama"} 10' in text
+
+    def test_disabled_is_noop(self):
+        """Test disabled metrics hand out a shared no-op and record nothing"""
+        metrics = PipelineMetrics(enabled=False, tracing=False)
+        assert metrics.stage("history", "a") is metrics.stage("context", "b")
+        with metrics.turn("a"):
+            metrics.observe("generate", "a", 1.0)
+        metrics.observe_generation("a", {"eval_count": 5, "eval_duration": 10})
+        assert metrics.get_stats() == {}
+
+class StubChatService:
+    """Records calls; streams a fixed reply and notes whether the stream was closed"""
+
+    def __init__(self):
+        self.turns = []
+        self.closed_streams = 0
+        self.cleared = []
+        self.created = []
+        self.searches = []
+        self.options = []
+        self.cancels = []
+        self.owners = []
+        self.closed = False
+        self.release = threading.Event()
+        self.release.set()
+        self.db_manager = Mock(**{"check_connection.return_value": True})
+        self.metrics = PipelineMetrics(enabled=True, tracing=False)
+
+    def chat(self, message, session_id="default", use_cache=True, options=None, cancel=None, owner=None):
+        self.release.wait(5)
+        self.turns.append((message, session_id, use_cache))
+        self.options.append(options)
+        self.owners.append(owner)
+        return f"echo: {message}"
+
+    def chat_stream(self, message, session_id="default", use_cache=True, options=None, cancel=None, owner=None):
+        self.turns.append((message, session_id, use_cache))
+        self.options.append(options)
+        self.cancels.append(cancel)
+        self.owners.append(owner)
+        try:
+            yield "echo"
+            yield ": "
+            yield message
+        finally:
+            self.closed_streams += 1
+
+    def get_chat_history_page(self, session_id="default", limit=20, before_id=None):
+        return [("Hi", "Hello!")], (7 if before_id is None else None)
+
+    def clear_history(self, session_id="default"):
+        self.cleared.append(session_id)
+    
+    def create_session(self, owner, title=None):
+        self.created.append((owner, title))
+        return "new-session"
+    
+    def list_sessions(self, owner, limit=20, cursor=None):
+        if cursor is not None and cursor != "next":
+            raise ValueError("Invalid session cursor")
+        active = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+        return [SessionInfo("s1", "Hi", active, 2)], ("next" if cursor is None else None)
+    
+    def search_history(self, query, session_id=None, owner=None, limit=20, cursor=None):
+        if cursor is not None and cursor != "next":
+            raise ValueError("Invalid search cursor")
+        self.searches.append((query, session_id, owner, limit))
+        created = datetime.datetime(2024, 5, 1, tzinfo=datetime.timezone.utc)
+        return [SearchHit(session_id or "s1", 3, ROLE_AI, created, 0.5, "**hit**")], ("next" if cursor is None else None)
+
+    def close(self):
+        self.closed = True
+
+class TestChatAPI:
+    """Tests the ASGI API over a stub service: JSON, SSE, WebSocket, history and draining"""
+
+    def test_chat_and_validation(self):
+        """Test POST /chat answers and rejects malformed bodies"""
+        service = StubChatService()
+        with TestClient(create_app(lambda: service)) as client:
+            response = client.post("/chat", json={"message": "Hi", "session_id": "s1", "use_cache": False})
+            assert response.json() == {"response": "echo: Hi", "session_id": "s1"}
+            assert service.turns == [("Hi", "s1", False)]
+            client.post("/chat", json={"message": "Hi", "owner": "alice"})
+            assert service.owners == [None, "alice"]
+            assert client.post("/chat", json={"message": "  "}).status_code == 400
+            assert client.post("/chat", content="not json").status_code == 400
+            assert client.post("/chat", json={"message": "Hi", "owner": 7}).status_code == 400
+        assert service.closed
+    
+    def test_generation_options(self):
+        """Test per-request options are validated and passed through"""
+        service = StubChatService()
+        with TestClient(create_app(lambda: service)) as client:
+            assert client.post("/chat", json={"message": "Hi", "options": {"max_tokens": 64}}).status_code == 200
+            assert service.options == [{"max_tokens": 64}]
+            for options in ({"max_tokens": "lots"}, {"beam_width": 2}, ["max_tokens"]):
+                response = client.post("/chat", json={"message": "Hi", "options": options})
+                assert response.status_code == 400 and "error" in response.json()
+
+    def test_stream_sse_events(self):
+        """Test POST /chat/stream sends token events then a done event"""
+        service = StubChatService()
+        with TestClient(create_app(lambda: service)) as client:
+            with client.stream("POST", "/chat/stream", json={"message": "Hi"}) as response:
+                body = "".join(response.iter_text())
+        events = [block.split("\n") for block in body.strip().split("\n\n")]
+        assert [lines[0] for lines in events] == ["event: token"] * 3 + ["event: done"]
+        assert '"response": "echo: Hi"' in events[-1][1]
+        assert service.closed_streams == 1
+
+    def test_websocket_turns(self):
+        """Test one WebSocket carries several turns and reports bad messages"""
+        service = StubChatService()
+        with TestClient(create_app(lambda: service)) as client:
+            with client.websocket_connect("/ws/chat") as websocket:
+                for message in ("Hi", "Again"):
+                    websocket.send_json({"message": message, "session_id": "ws"})
+                    tokens = []
+                    while True:
+                        reply = websocket.receive_json()
+                        if reply.get("done"):
+                            break
+                        tokens.append(reply["token"])
+                    assert "".join(tokens) == reply["response"] == f"echo: {message}"
+                websocket.send_json({"session_id": "ws"})
+                assert "error" in websocket.receive_json()
+        assert [turn[1] for turn in service.turns] == ["ws", "ws"]
+
+    def test_history_page_and_clear(self):
+        """Test history pagination, clearing and health"""
+        service = StubChatService()
+        with TestClient(create_app(lambda: service)) as client:
+            page = client.get("/sessions/s1/history", params={"limit": 5}).json()
+            assert page == {"pairs": [["Hi", "Hello!"]], "next_before_id": 7}
+            assert client.get("/sessions/s1/history", params={"before_id": 7}).json()["next_before_id"] is None
+            for limit in ("x", "0", "-5", "2.5"):
+                assert client.get("/sessions/s1/history", params={"limit": limit}).status_code == 400
+            assert client.delete("/sessions/s1/history").status_code == 204
+            assert client.get("/health").json() == {"status": "ok", "database": True, "in_flight": 0}
+        assert service.cleared == ["s1"]
+    
+    def test_user_sessions(self):
+        """Test creating a session and listing a user's sessions by cursor"""
+        service = StubChatService()
+        with TestClient(create_app(lambda: service)) as client:
+            created = client.post("/users/alice/sessions", json={"title": "Trip"})
+            assert created.status_code == 201 and created.json() == {"session_id": "new-session"}
+            assert client.post("/users/alice/sessions").status_code == 201
+            assert client.post("/users/alice/sessions", json={"title": 3}).status_code == 400
+            
+            page = client.get("/users/alice/sessions").json()
+            assert page == {"sessions": [{"session_id": "s1", "title": "Hi", "message_count": 2,
+                                          "last_active_at": "2024-05-01T00:00:00+00:00"}],
+                            "next_cursor": "next"}
+            assert client.get("/users/alice/sessions", params={"cursor": "next"}).json()["next_cursor"] is None
+            assert client.get("/users/alice/sessions", params={"cursor": "bogus"}).status_code == 400
+            assert client.get("/users/alice/sessions", params={"limit": "-1"}).status_code == 400
+        assert service.created == [("alice", "Trip"), ("alice", None)]
+    
+    def test_search(self):
+        """Test searching one session or all of a user's sessions"""
+        service = StubChatService()
+        with TestClient(create_app(lambda: service)) as client:
+            page = client.get("/sessions/s2/search", params={"q": "hit", "limit": "5"}).json()
+            assert page == {"hits": [{"session_id": "s2", "message_id": 3, "role": "assistant",
+                                      "created_at": "2024-05-01T00:00:00+00:00", "rank": 0.5, "snippet": "**hit**"}],
+                            "next_cursor": "next"}
+            assert client.get("/users/alice/search", params={"q": "hit", "cursor": "next"}).json()["next_cursor"] is None
+            assert client.get("/users/alice/search", params={"q": " "}).status_code == 400
+            assert client.get("/users/alice/search", params={"q": "hit", "cursor": "bogus"}).status_code == 400
+            assert client.get("/users/alice/search", params={"q": "hit", "limit": "0"}).status_code == 400
+        assert service.searches == [("hit", "s2", None, 5), ("hit", None, "alice", 20)]
+
+    def test_shutdown_drains_in_flight_turns(self):
+        """Test shutdown waits for a running turn and new turns get 503 meanwhile"""
+        service = StubChatService()
+        service.release.clear()
+        app = create_app(lambda: service)
+        results = {}
+        with TestClient(app) as client:
+            worker = threading.Thread(
+                target=lambda: results.update(first=client.post("/chat", json={"message": "slow"}))
+            )
+            worker.start()
+            while app.state.drain.in_flight == 0:
+                time.sleep(0.01)
+            client.portal.start_task_soon(app.state.drain.wait, 5)
+            while not app.state.drain.draining:
+                time.sleep(0.01)
+            assert client.post("/chat", json={"message": "late"}).status_code == 503
+            service.release.set()
+            worker.join()
+        assert results["first"].json()["response"] == "echo: slow"
+        assert service.closed
+
+    def test_stream_disconnect_before_first_chunk(self):
+        """Test a stream whose client is gone before the body starts holds no drain slot"""
+        body = json.dumps({"message": "Hi"}).encode()
+        scope = {"type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+                 "method": "POST", "scheme": "http", "path": "/chat/stream", "raw_path": b"/chat/stream",
+                 "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+                 "client": ("testclient", 50000), "server": ("testserver", 80)}
+        
+        async def receive():
+            return {"type": "http.request", "body": body, "more_body": False}
+        
+        async def send(message):
+            raise OSError("client went away")
+        
+        async def request(app):
+            with pytest.raises(Exception):
+                await app(scope, receive, send)
+        
+        service = StubChatService()
+        app = create_app(lambda: service)
+        with TestClient(app) as client:
+            client.portal.call(request, app)
+            assert app.state.drain.in_flight == 0
+            assert service.turns == []
+
+class StubBatchService:
+    """Echo service tracking per-session order and peak concurrency; "boom" fails, "busy" is shed while `busy`"""
+    
+    def __init__(self):
+        self.busy = True
+        self.turns = []
+        self.cleared = []
+        self.active = 0
+        self.peak = 0
+        self.lock = threading.Lock()
+    
+    def chat(self, message, session_id="default", use_cache=True):
+        with self.lock:
+            self.active += 1
+            self.peak = max(self.peak, self.active)
+        time.sleep(0.01)
+        with self.lock:
+            self.active -= 1
+            self.turns.append((session_id, message))
+        if message == "boom":
+            raise RuntimeError("LLM unavailable")
+        if message == "busy" and self.busy:
+            return FailedGeneration("Error: LLM is busy, please try again (queue full)")
+        return f"echo: {message}"
+    
+    def clear_history(self, session_id="default"):
+        self.cleared.append(session_id)
+
+class TestBatchRunner:
+    """Tests batch replay: ordering, concurrency cap, results and resuming"""
+    
+    def test_load_sessions_accepts_both_shapes(self, tmp_path):
+        """Test whole-session and single-turn lines merge in file order"""
+        path = tmp_path / "sessions.jsonl"
+        path.write_text('{"session_id": "a", "turns": ["1", "2"]}\n\n'
+                        '{"session_id": "b", "message": "x"}\n{"session_id": "a", "message": "3"}\n')
+        assert load_sessions(str(path)) == {"a": ["1", "2", "3"], "b": ["x"]}
+        
+        path.write_text('{"session_id": "a"}\n')
+        with pytest.raises(ValueError):
+            load_sessions(str(path))
+    
+    def test_sessions_run_in_parallel_with_ordered_turns(self, tmp_path):
+        """Test turns stay ordered per session while sessions share the concurrency cap"""
+        service = StubBatchService()
+        sessions = {f"s{i}": [f"s{i}-t{turn}" for turn in range(3)] for i in range(6)}
+        output = tmp_path / "results.jsonl"
+        
+        summary = BatchRunner(service, concurrency=3, fresh=True).run(sessions, str(output))
+        
+        assert summary["completed"] == 18 and summary["failed"] == 0 and summary["remaining"] == 0
+        assert service.peak == 3
+        assert sorted(service.cleared) == sorted(sessions)
+        for session_id, turns in sessions.items():
+            assert [m for s, m in service.turns if s == session_id] == turns
+        results = [json.loads(line) for line in output.read_text().splitlines()]
+        assert len(results) == 18
+        assert all(r["response"] == f"echo: {r['message']}" and r["seconds"] > 0 for r in results)
+    
+    def test_resume_from_checkpoint(self, tmp_path):
+        """Test a rerun skips answered turns, retries failed ones and drops a torn last line"""
+        output = tmp_path / "results.jsonl"
+        output.write_text(
+            json.dumps({"session_id": "a", "turn": 0, "response": "echo: a0", "seconds": 0.1}) + "\n"
+            + json.dumps({"session_id": "b", "turn": 0, "error": "RuntimeError: x", "seconds": 0.1}) + "\n"
+            + '{"session_id": "a", "tu'
+        )
+        assert load_checkpoint(str(output)) == {("a", 0)}
+        assert output.read_text().endswith("\n")
+        
+        service = StubBatchService()
+        summary = BatchRunner(service, concurrency=2, fresh=True).run(
+            {"a": ["a0", "a1"], "b": ["b0", "boom", "b2"]}, str(output)
+        )
+        
+        assert ("a", "a0") not in service.turns
+        assert service.cleared == ["b"]
+        assert summary == {**summary, "completed": 2, "skipped": 1, "failed": 1, "remaining": 2}
+        # The session stopped at its failed turn
+        assert ("b", "b2") not in service.turns
+        assert load_checkpoint(str(output)) == {("a", 0), ("a", 1), ("b", 0)}
+
+    def test_failed_generation_is_a_failed_turn(self, tmp_path):
+        """Test a shed reply is recorded as an error, not a response, and retried by the next run"""
+        output = tmp_path / "results.jsonl"
+        service = StubBatchService()
+        sessions = {"c": ["c0", "busy", "c2"]}
+        
+        summary = BatchRunner(service).run(sessions, str(output))
+        
+        assert summary == {**summary, "completed": 1, "failed": 1, "remaining": 2}
+        failed = json.loads(output.read_text().splitlines()[-1])
+        assert failed["error"].startswith("Error: LLM is busy") and "response" not in failed
+        
+        service.busy = False
+        summary = BatchRunner(service).run(sessions, str(output))
+        
+        assert summary == {**summary, "completed": 2, "skipped": 1, "failed": 0, "remaining": 0}
+        assert load_checkpoint(str(output)) == {("c", 0), ("c", 1), ("c", 2)}
 
 if __name__ == "__main__":
-    pytest.main([__file__])
\ No newline at end of file
+    pytest.main([__file__])
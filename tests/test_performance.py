@@ -1,11 +1,18 @@
 import os
 import sys
+import json
 import time
+import asyncio
+import threading
 import concurrent.futures
+from unittest.mock import patch
 
 sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
 
-from backend.chat_service import ChatService
+from backend.chat_service import AsyncChatService, ChatService, get_chat_service
+from backend.generation import Cancellation
+from backend.llm_handler import OllamaLLM
+from tests.benchmark import StubOllama, compare_results, run_benchmark, save_results
 
 def test_response_time():
     """
@@ -49,24 +56,202 @@ def test_concurrent_users():
     Tests system performance under concurrent user load conditions.
     
     Concurrency validation:
-    - Multiple simultaneous chat sessions
+    - Multiple simultaneous chat sessions on one shared service
     - Database connection pool handling
     - Session isolation verification
     - Resource contention and bottleneck identification
     """
     def chat_session(session_id):
-        chat = ChatService()
+        chat = get_chat_service()
         response = chat.chat(f"Hello from session {session_id}", f"concurrent_{session_id}")
         return len(response)
     
     print("Testing concurrent users...")
     
+    start_time = time.time()
     with concurrent.futures.ThreadPoolExecutor(max_workers=5) as executor:
         futures = [executor.submit(chat_session, i) for i in range(5)]
         results = [future.result() for future in concurrent.futures.as_completed(futures)]
+    elapsed = time.time() - start_time
     
-    print(f"✅ Concurrent test completed - {len(results)} sessions handled")
+    print(f"✅ Concurrent test completed - {len(results)} sessions handled in {elapsed:.2f}s")
+
+def test_concurrent_users_async():
+    """
+    Runs the concurrent users scenario on AsyncChatService for comparison.
+    
+    Benchmark comparison with test_concurrent_users:
+    - Same session count and message pattern
+    - One shared service and event loop instead of a thread per session
+    - Total wall time for all sessions
+    """
+    async def run_sessions(session_count):
+        async with AsyncChatService() as chat:
+            responses = await asyncio.gather(*[
+                chat.chat(f"Hello from session {i}", f"concurrent_async_{i}")
+                for i in range(session_count)
+            ])
+        return [len(response) for response in responses]
+    
+    print("Testing concurrent users (async)...")
+    
+    start_time = time.time()
+    results = asyncio.run(run_sessions(5))
+    elapsed = time.time() - start_time
+    
+    print(f"✅ Async concurrent test completed - {len(results)} sessions handled in {elapsed:.2f}s")
+
+def test_scheduler_with_stub_ollama():
+    """
+    Drives OllamaLLM through its scheduler against a local stub Ollama.
+    
+    Scheduler validation:
+    - Concurrent calls never exceed LLM_MAX_IN_FLIGHT at the server
+    - Identical in-flight prompts are coalesced into one generation
+    - Throughput and p50/p99 latency under 16 concurrent clients
+    """
+    stub = StubOllama(latency=0.1, token_rate=0).start()
+    env = {
+        "OLLAMA_BASE_URL": stub.url,
+        "LLM_MAX_IN_FLIGHT": "4",
+        "OLLAMA_MAX_CONNECTIONS": "16",
+        "RESPONSE_CACHE_ENABLED": "0",
+    }
+    with patch.dict(os.environ, env):
+        llm = OllamaLLM()
+    
+    def timed_request(i):
+        # Every other request repeats a popular opening prompt
+        prompt = "Hello, how are you?" if i % 2 else f"Question {i}"
+        start = time.perf_counter()
+        llm.generate_response(prompt, session_id=f"stub_{i % 8}")
+        return time.perf_counter() - start
+    
+    start_time = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=16) as executor:
+        latencies = sorted(executor.map(timed_request, range(64)))
+    elapsed = time.time() - start_time
+    stub.stop()
+    
+    stats = llm.scheduler.get_stats()
+    print(f"Throughput: {len(latencies) / elapsed:.1f} req/s")
+    print(f"Latency p50: {latencies[len(latencies) // 2]:.3f}s, p99: {latencies[int(0.99 * (len(latencies) - 1))]:.3f}s")
+    print(f"Queue wait p99: {stats['wait_p99']:.3f}s, coalesced: {stats['coalesced']}")
+    
+    assert stub.peak <= 4
+    assert stats["coalesced"] > 0
+    assert stats["completed"] + stats["coalesced"] == len(latencies)
+
+def test_cancel_stops_generation():
+    """
+    Cancels streams against a slow local stub Ollama.
+    
+    Cancellation validation:
+    - cancel() from another thread aborts a stream blocked between tokens
+    - The stub stops generating, so the slot frees up at once
+    - A deadline ends a stream that would otherwise run for seconds
+    - num_predict from per-request options bounds the reply
+    """
+    stub = StubOllama(latency=0.05, token_rate=2, reply_tokens=20).start()
+    env = {"OLLAMA_BASE_URL": stub.url, "RESPONSE_CACHE_ENABLED": "0"}
+    with patch.dict(os.environ, env):
+        llm = OllamaLLM()
+    
+    cancel = Cancellation()
+    start = time.perf_counter()
+    threading.Timer(0.8, cancel.cancel).start()
+    parts = list(llm.stream_response("Tell me a long story", cancel=cancel))
+    cancelled_after = time.perf_counter() - start
+    
+    deadline_start = time.perf_counter()
+    list(llm.stream_response("Tell me another", cancel=Cancellation(timeout=0.8)))
+    deadline_after = time.perf_counter() - deadline_start
+    
+    stub.token_rate = 0
+    short = "".join(llm.stream_response("Be brief", options={"max_tokens": 3}))
+    for _ in range(50):
+        if stub.active == 0:
+            break
+        time.sleep(0.05)
+    stub.stop()
+    
+    print(f"Cancelled after {cancelled_after:.2f}s, deadline stream ended after {deadline_after:.2f}s")
+    assert parts == ["token0 "]
+    assert cancelled_after < 1.0
+    assert deadline_after < 1.5
+    assert short == "token0 token1 token2 "
+    assert stub.active == 0
+    assert llm.backends.get_stats()[0]["failures"] == 0
+
+def test_deadline_not_extended_by_retries():
+    """
+    Sends generations with a deadline to a local stub Ollama that fails with 503.
+    
+    Deadline validation:
+    - A request with a Cancellation is sent once, not retried with backoff
+    - It returns well within its deadline, streaming or not
+    - Requests without one still retry on 5xx
+    """
+    stub = StubOllama(latency=0.4, status=503).start()
+    env = {
+        "OLLAMA_BASE_URL": stub.url,
+        "OLLAMA_MAX_RETRIES": "3",
+        "OLLAMA_BACKOFF_FACTOR": "0.1",
+        "RESPONSE_CACHE_ENABLED": "0",
+    }
+    with patch.dict(os.environ, env):
+        llm = OllamaLLM()
+    
+    start = time.perf_counter()
+    response = llm.generate_response("Hello", cancel=Cancellation(timeout=1.0))
+    generate_after = time.perf_counter() - start
+    generate_requests = stub.requests
+    
+    start = time.perf_counter()
+    streamed = "".join(llm.stream_response("Hello again", cancel=Cancellation(timeout=1.0)))
+    stream_after = time.perf_counter() - start
+    stream_requests = stub.requests - generate_requests
+    
+    stub.latency = 0.0
+    llm.generate_response("No deadline")
+    retried_requests = stub.requests - generate_requests - stream_requests
+    stub.stop()
+    llm.close()
+    
+    print(f"Deadline requests ended after {generate_after:.2f}s and {stream_after:.2f}s")
+    assert "503" in response and "503" in streamed
+    assert generate_requests == 1 and stream_requests == 1
+    assert generate_after < 1.0 and stream_after < 1.0
+    assert retried_requests == 4
+
+def test_benchmark_harness(tmp_path):
+    """
+    Runs the benchmark harness at small scale in both load models.
+    
+    Harness validation:
+    - Closed loop (sessions wait for replies) and open loop (Poisson arrivals)
+    - Streaming turns report time-to-first-token
+    - Results are saved as JSON and compare against each other
+    """
+    closed = run_benchmark(sessions=3, turns=2, latency=0.01, token_rate=0)
+    opened = run_benchmark(sessions=3, turns=2, mode="open", rate=50, stream=True, latency=0.01)
+    
+    for results in (closed, opened):
+        assert results["turns"] == 6
+        assert results["errors"] == 0
+        assert results["llm"]["requests"] >= 6
+        assert results["database"]["server_connections_peak"] >= 1
+        assert results["latency"]["p50"] <= results["latency"]["p99"]
+    assert opened["first_token"]["count"] == 6
+    assert any(label.startswith("turn/") for label in closed["stages"])
+    
+    path = tmp_path / "closed.json"
+    save_results(closed, str(path))
+    saved = json.loads(path.read_text())
+    assert compare_results(saved, opened)["latency p50"]["before"] == closed["latency"]["p50"]
 
 if __name__ == "__main__":
     test_response_time()
-    test_concurrent_users()
\ No newline at end of file
+    test_concurrent_users()
+    test_concurrent_users_async()
+    test_scheduler_with_stub_ollama()
\ No newline at end of file